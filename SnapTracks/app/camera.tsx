@@ -12,7 +12,6 @@ export default function CameraScreen() {
   const [facing, setFacing] = useState<CameraType>('back');
   const [permission, requestPermission] = useCameraPermissions();
   const [imageUri, setImageUri] = useState<string | null>(null);
-  const [base64Encoding, setBase64Encoding] = useState<string | null>(null);
   const [isCameraReady, setIsCameraReady] = useState(false);
   const [loading, setLoading] = useState(false); // Add loading state
   const cameraRef = useRef<CameraView | null>(null);
@@ -47,13 +46,10 @@ export default function CameraScreen() {
   async function takePicture() {
     if (cameraRef.current && isCameraReady) {
       try {
-        const photo = await cameraRef.current.takePictureAsync({ base64: true });
+        const photo = await cameraRef.current.takePictureAsync();
         console.log('Photo taken!');
         if (photo) {
           setImageUri(photo.uri);
-          if (photo.base64) {
-            setBase64Encoding(photo.base64);
-          }
         } else {
           console.log('Photo is not ready.');
         }
@@ -72,11 +68,10 @@ export default function CameraScreen() {
   async function handleConfirmPhoto() {
     console.log('Photo confirmed:', imageUri);
     setLoading(true); // Start loading
-    if (base64Encoding) {
-      console.log('Base64 encoding exists!');
+    if (imageUri) {
       try {
         // Describe the image
-        const description = await describeImage(base64Encoding);
+        const description = await describeImage(imageUri);
 
         // Generate music prompt
         const data = await generateMusicPrompt(description);
@@ -88,13 +83,8 @@ export default function CameraScreen() {
         await FileSystem.writeAsStringAsync(fileUri, jsonData);
         console.log('File has been saved as songs.json');
 
-        // Extract and modify the audio URL
-        let audioUrl = data.songs[0].data['audio_url'];
-        const modifiedAudioUrl = modifyAudioUrl(audioUrl);
-        console.log('Modified audio URL:', modifiedAudioUrl);
-
-        // Wait until the URL is ready
-        await waitForUrlReady(modifiedAudioUrl);
+        // Wait until the backend reports the clip is ready
+        await waitForClipReady(data.songs[0].id);
 
         // After the URL is ready, proceed
         setLoading(false); // Stop loading
@@ -104,50 +94,54 @@ export default function CameraScreen() {
         setLoading(false); // Stop loading even on error
       }
     } else {
-      console.log('No base64 encoding available.');
+      console.log('No photo available.');
       setLoading(false);
     }
   }
 
-  function modifyAudioUrl(url: string) {
-    const baseUrl = url.replace('audio/?item_id=', '');
-    const formattedUrl = `${baseUrl}.mp3`;
-    return formattedUrl;
-  }
-
-  async function waitForUrlReady(url: string, timeout = 300000, interval = 5000) {
-    // Wait up to timeout milliseconds, checking every interval milliseconds
+  async function waitForClipReady(clipId: string, timeout = 300000) {
+    // Long-poll the backend, which polls Suno for every pending clip in one place
     const startTime = Date.now();
-  
+
     while (Date.now() - startTime < timeout) {
       try {
-        const response = await fetch(url, { method: 'HEAD' });
-        if (response.ok) {
-          // URL is ready
+        const response = await fetch(
+          `https://eaa3-132-170-212-17.ngrok-free.app/clips/${clipId}?wait=25`
+        );
+        if (response.status === 200) {
+          // Clip is ready
           console.log('Audio URL is ready.');
           return true;
         }
+        if (response.status === 502) {
+          throw new Error('Clip generation failed');
+        }
       } catch (error) {
-        // Ignore errors and continue polling
+        if (error instanceof Error && error.message === 'Clip generation failed') {
+          throw error;
+        }
+        // Ignore network errors and continue waiting
         console.log('Waiting for audio URL to be ready...');
+        await new Promise((resolve) => setTimeout(resolve, 2000));
       }
-      // Wait for interval milliseconds
-      await new Promise((resolve) => setTimeout(resolve, interval));
     }
     // Timed out
     throw new Error('Audio URL did not become ready in time');
-  }  
+  }
 
   // Call the describe image API
-  async function describeImage(base64Image: string) {
+  async function describeImage(photoUri: string) {
+    // Upload the photo file as multipart form data instead of base64 inside JSON
+    const formData = new FormData();
+    formData.append('image', {
+      uri: photoUri,
+      name: 'photo.jpg',
+      type: 'image/jpeg',
+    } as any);
+
     const response = await fetch('https://eaa3-132-170-212-17.ngrok-free.app/describe_image', {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
-        image_base64: base64Image,
-      }),
+      body: formData,
     });
 
     if (!response.ok) {
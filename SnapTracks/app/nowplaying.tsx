@@ -40,15 +40,14 @@ export default function NowPlaying() {
   useEffect(() => {
     if (songData && songData.songs) {
       const song = songData.songs[0];
-      setAlbumCover(song.data['image_url']);
-      setSongTitle(song.data['title']);
+      setAlbumCover(song.image_url);
+      setSongTitle(songData.title);
   
-      // Use your provided code to format the audio URL correctly
-      let audioUrl: string = song.data['audio_url'];
-      const baseUrl = audioUrl.replace('audio/?item_id=', ''); 
-      const formattedUrl = `${baseUrl}.mp3`;
-      console.log(formattedUrl); 
-      setSongURL(formattedUrl);
+      // The backend serves finished clips from its audio cache (with Range
+      // support for seeking) and redirects to Suno while a clip is still streaming
+      const audioUrl = `https://eaa3-132-170-212-17.ngrok-free.app/audio/${song.id}`;
+      console.log(audioUrl);
+      setSongURL(audioUrl);
     } else {
       console.log('Song data not set');
       setAlbumCover('https://www.example.com/default-image.jpg'); // Set a default image URL
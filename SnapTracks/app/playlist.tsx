@@ -1,20 +1,54 @@
+import { useCallback, useEffect, useRef, useState } from 'react';
 import { View, FlatList, StyleSheet, useColorScheme, Image, Text } from 'react-native';
 import { ThemedText } from '@/components/ThemedText';
 import { SafeAreaView } from 'react-native-safe-area-context';
 
+const SONGS_URL = 'https://eaa3-132-170-212-17.ngrok-free.app/songs';
+const PLACEHOLDER_COVER = 'https://via.placeholder.com/50';
+
+type Song = { id: string; title: string; image_url: string | null };
+
 export default function Playlist() {
-  const playlist = [
-    { id: '1', title: 'Current Song - Example Song 1', cover: 'https://via.placeholder.com/50' },
-    { id: '2', title: 'Next Song - Example Song 2', cover: 'https://via.placeholder.com/50' },
-    { id: '3', title: 'Next Song - Example Song 3', cover: 'https://via.placeholder.com/50' },
-  ];
+  const [playlist, setPlaylist] = useState<Song[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const firstPageEtag = useRef<string | null>(null);
 
   const colorScheme = useColorScheme();
   const isDarkMode = colorScheme === 'dark';
 
-  const renderSong = ({ item }) => (
+  // Load one page of the song library; the first page is revalidated with its
+  // ETag so an unchanged library costs a 304 and no body
+  const loadSongs = useCallback(async (cursor: string | null) => {
+    const query = `?fields=id,title,image_url&limit=20${cursor ? `&cursor=${cursor}` : ''}`;
+    const headers: Record<string, string> = {};
+    if (!cursor && firstPageEtag.current) {
+      headers['If-None-Match'] = firstPageEtag.current;
+    }
+    try {
+      const response = await fetch(SONGS_URL + query, { headers });
+      if (response.status === 304 || !response.ok) {
+        return;
+      }
+      const data = await response.json();
+      if (!cursor) {
+        firstPageEtag.current = response.headers.get('ETag');
+        setPlaylist(data.songs);
+      } else {
+        setPlaylist((songs) => [...songs, ...data.songs]);
+      }
+      setNextCursor(data.next_cursor);
+    } catch (error) {
+      console.log('Failed to load songs:', error);
+    }
+  }, []);
+
+  useEffect(() => {
+    loadSongs(null);
+  }, [loadSongs]);
+
+  const renderSong = ({ item }: { item: Song }) => (
     <View style={styles.songContainer}>
-      <Image source={{ uri: item.cover }} style={styles.coverImage}/>
+      <Image source={{ uri: item.image_url || PLACEHOLDER_COVER }} style={styles.coverImage}/>
       <Text style={styles.songTitle}>{item.title}</Text>
     </View>
   );
@@ -26,6 +60,9 @@ export default function Playlist() {
         data={playlist}
         renderItem={renderSong}
         keyExtractor={(item) => item.id}
+        onEndReached={() => nextCursor && loadSongs(nextCursor)}
+        onRefresh={() => loadSongs(null)}
+        refreshing={false}
       />
     </SafeAreaView>
   );
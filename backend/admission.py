@@ -0,0 +1,265 @@
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Admission control for the expensive generation endpoints. Every generation
+# spends an OpenAI completion and a Suno submission (and a Vision/Gemini call
+# for snaps), so before a request starts it must:
+#
+#   1. take a token from its client's bucket (ADMISSION_CLIENT_RATE per minute,
+#      bursts of ADMISSION_CLIENT_BURST), or get a 429 straight away;
+#   2. get a slot under the global cap and under the cap of every upstream host
+#      it will call (ADMISSION_HOST_LIMITS), sized to each provider's limits.
+#
+# A request that cannot start waits in a bounded queue. Each client has its own
+# FIFO and freed slots go to clients round-robin, so one client's burst cannot
+# starve the others. When the queue (or the client's share of it) is full the
+# request is refused at once with 429 and a Retry-After estimate, and a request
+# that waits longer than ADMISSION_QUEUE_TIMEOUT gets a 503, so overload shows
+# up as quick refusals instead of upstream timeouts.
+#
+# State is per worker process. The configured limits are totals for the whole
+# server and are split evenly across the WEB_WORKERS processes. Running and
+# queued requests each hold a request thread, so a worker's share of both must
+# fit in its WEB_THREADS; otherwise overload would stall in the accept backlog
+# instead of being refused (check_config rejects such a setup at startup).
+
+ADMISSION_ACTIVE = metrics._register(metrics.Gauge(
+    "snaptracks_admission_active", "Admitted generations currently running.", ("kind",)))
+ADMISSION_QUEUED = metrics._register(metrics.Gauge(
+    "snaptracks_admission_queued", "Generations waiting for a slot."))
+ADMISSION_REJECTED = metrics._register(metrics.Counter(
+    "snaptracks_admission_rejected_total", "Generations refused by admission control.", ("kind", "reason")))
+ADMISSION_WAIT_SECONDS = metrics._register(metrics.Histogram(
+    "snaptracks_admission_wait_seconds", "Time admitted generations spent queued.", ("kind",)))
+
+# Upstream hosts each kind of request calls
+KINDS = {
+    "generate": ("openai", "suno"),
+    "snap": ("google", "openai", "suno"),
+}
+
+_lock = threading.Lock()
+_active = 0
+_host_active = {}
+_queues = OrderedDict()  # client -> deque of waiting _Ticket, in round-robin order
+_queued = 0
+_buckets = {}  # client -> [tokens, last refill]
+_service_seconds = 10.0  # moving average of how long an admitted generation runs
+_stats = {"admitted": 0, "queued": 0, "rejected_rate": 0, "rejected_queue": 0, "timed_out": 0}
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is refused; retry_after is a whole number of seconds.
+    """
+
+    def __init__(self, message, retry_after, status=429):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+def _share(total):
+    # This worker's part of a server-wide limit
+    return max(1, math.ceil(total / max(config.WEB_WORKERS, 1)))
+
+
+def _host_limit(host):
+    limit = config.ADMISSION_HOST_LIMITS.get(host)
+    return _share(limit) if limit else None
+
+
+def check_config():
+    """
+    Raises ValueError if a worker's running and queued generations could use
+    up all of its request threads.
+    """
+    if not config.ADMISSION:
+        return
+    needed = _share(config.ADMISSION_MAX_CONCURRENT) + _share(config.ADMISSION_QUEUE_SIZE)
+    if needed > config.WEB_THREADS:
+        raise ValueError(
+            f"ADMISSION_MAX_CONCURRENT and ADMISSION_QUEUE_SIZE allow {needed} generations per worker, "
+            f"more than its WEB_THREADS ({config.WEB_THREADS}); lower them or raise WEB_THREADS."
+        )
+
+
+class _Ticket:
+    __slots__ = ("client", "kind", "hosts", "event", "granted", "released", "queued_at", "started_at")
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.hosts = KINDS[kind]
+        self.event = threading.Event()
+        self.granted = False
+        self.released = False
+        self.queued_at = time.monotonic()
+        self.started_at = None
+
+    def release(self):
+        """
+        Frees the ticket's slots for the next waiting request. Safe to call
+        more than once.
+        """
+        global _active, _service_seconds
+        with _lock:
+            if not self.granted or self.released:
+                return
+            self.released = True
+            _active -= 1
+            for host in self.hosts:
+                _host_active[host] -= 1
+            _service_seconds = 0.8 * _service_seconds + 0.2 * (time.monotonic() - self.started_at)
+            _dispatch()
+        ADMISSION_ACTIVE.dec(self.kind)
+
+
+def _fits(ticket):
+    if _active >= _share(config.ADMISSION_MAX_CONCURRENT):
+        return False
+    for host in ticket.hosts:
+        limit = _host_limit(host)
+        if limit is not None and _host_active.get(host, 0) >= limit:
+            return False
+    return True
+
+
+def _grant(ticket):
+    global _active
+    _active += 1
+    for host in ticket.hosts:
+        _host_active[host] = _host_active.get(host, 0) + 1
+    ticket.granted = True
+    ticket.started_at = time.monotonic()
+    ticket.event.set()
+
+
+def _dispatch():
+    """
+    Grants freed slots to waiting requests, taking the head of each client's
+    queue in round-robin order. Called with _lock held.
+    """
+    global _queued
+    progress = True
+    while _queues and progress:
+        progress = False
+        for client in list(_queues):
+            queue = _queues[client]
+            if not _fits(queue[0]):
+                continue
+            _grant(queue.popleft())
+            _queued -= 1
+            progress = True
+            # Served clients go to the back of the line
+            if queue:
+                _queues.move_to_end(client)
+            else:
+                del _queues[client]
+
+
+def _take_token(client, now):
+    """
+    Takes a token from the client's bucket. Returns 0 on success, otherwise
+    the seconds until the next token. Called with _lock held.
+    """
+    rate = config.ADMISSION_CLIENT_RATE / 60 / max(config.WEB_WORKERS, 1)
+    burst = _share(config.ADMISSION_CLIENT_BURST)
+    bucket = _buckets.get(client)
+    if bucket is None:
+        if len(_buckets) >= 10000:
+            _prune_buckets(now, rate, burst)
+        bucket = _buckets[client] = [burst, now]
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0
+    return (1 - bucket[0]) / rate if rate > 0 else 3600
+
+
+def _prune_buckets(now, rate, burst):
+    # Forget clients whose buckets have refilled; they start full anyway
+    for client, (tokens, updated) in list(_buckets.items()):
+        if tokens + (now - updated) * rate >= burst:
+            del _buckets[client]
+
+
+def _retry_after():
+    # Roughly when the queue ahead will have drained
+    capacity = _share(config.ADMISSION_MAX_CONCURRENT)
+    return min(max(math.ceil(_service_seconds * (_queued + 1) / capacity), 1), 120)
+
+
+def acquire(client, kind):
+    """
+    Admits one request of `kind` ("generate" or "snap") for `client`, waiting
+    in the fair queue if every slot is busy. Returns a ticket whose release()
+    must be called when the upstream work is done. Raises Overloaded when the
+    request is refused.
+    """
+    global _queued
+    if not config.ADMISSION:
+        ticket = _Ticket(client, kind)
+        ticket.released = True
+        return ticket
+
+    ticket = _Ticket(client, kind)
+    with _lock:
+        wait = _take_token(client, ticket.queued_at)
+        if wait:
+            _stats["rejected_rate"] += 1
+            ADMISSION_REJECTED.inc(kind, "rate")
+            raise Overloaded("Too many generations; slow down.", math.ceil(wait))
+
+        # Anything still queued is waiting on a busy slot, so a request that
+        # fits now does not jump ahead of a request that could have run
+        if _fits(ticket):
+            _grant(ticket)
+        else:
+            client_queue = _queues.get(client)
+            if _queued >= _share(config.ADMISSION_QUEUE_SIZE) or (
+                    client_queue and len(client_queue) >= config.ADMISSION_CLIENT_QUEUE):
+                # The refused request does not count against the client's rate
+                _buckets[client][0] += 1
+                _stats["rejected_queue"] += 1
+                ADMISSION_REJECTED.inc(kind, "queue_full")
+                raise Overloaded("Server is busy; try again shortly.", _retry_after())
+            _queues.setdefault(client, deque()).append(ticket)
+            _queued += 1
+            _stats["queued"] += 1
+
+    if not ticket.granted:
+        ADMISSION_QUEUED.inc()
+        ticket.event.wait(config.ADMISSION_QUEUE_TIMEOUT)
+        ADMISSION_QUEUED.dec()
+        with _lock:
+            if not ticket.granted:
+                queue = _queues.get(client)
+                queue.remove(ticket)
+                if not queue:
+                    del _queues[client]
+                _queued -= 1
+                _stats["timed_out"] += 1
+                ADMISSION_REJECTED.inc(kind, "timeout")
+                raise Overloaded("Timed out waiting for capacity.", _retry_after(), 503)
+
+    with _lock:
+        _stats["admitted"] += 1
+    ADMISSION_ACTIVE.inc(kind)
+    ADMISSION_WAIT_SECONDS.observe(ticket.started_at - ticket.queued_at, kind)
+    return ticket
+
+
+def stats():
+    with _lock:
+        return dict(_stats, active=_active, queued=_queued, waiting_clients=len(_queues),
+                    hosts=dict(_host_active), service_seconds=round(_service_seconds, 1))
@@ -1,29 +1,54 @@
+import time
+
+# Measure cold start from the very first import
+STARTED_AT = time.monotonic()
+
 import os
 import json
-import base64
-from flask import Flask, request, jsonify
-import requests
-from dotenv import load_dotenv
-from google.cloud import vision
-import vertexai
-from vertexai.generative_models import GenerativeModel
+import hmac
+import hashlib
+import threading
+import concurrent.futures
+from flask import Flask, request, jsonify, Response, stream_with_context, g, redirect
+from werkzeug.http import http_date
 import logging
 
-# Load environment variables from .env file
-load_dotenv()
+from config import (
+    OPENAI_API_KEY,
+    SUNO_API_KEY,
+    GOOGLE_APPLICATION_CREDENTIALS,
+    VERTEX_PROJECT,
+    VERTEX_LOCATION,
+)
+import config
+import music
+import jobs
+import admission
+import warm_pool
+import clip_poller
+import suno_callbacks
+import description
+import description_cache
+import lyrics_memo
+import upstream
+import singleflight
+import song_library
+import audio_cache
+import responses
+import metrics
+import runtime
+import logs
+from preprocess import preprocess_image
+import clients
+from clients import clients_health
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = config.MAX_REQUEST_BYTES
 
-# Configure Logging
-logging.basicConfig(level=logging.INFO)
+# Configure Logging (queued, truncated and sampled; see logs.py)
+logs.configure()
 logger = logging.getLogger(__name__)
-
-# Retrieve API keys and configurations from environment variables
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-SUNO_API_KEY = os.getenv("SUNO_API_KEY")
-GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-VERTEX_PROJECT = os.getenv("VERTEX_PROJECT")
-VERTEX_LOCATION = os.getenv("VERTEX_LOCATION")
+access_logger = logging.getLogger("snaptracks.access")
 
 # Validate environment variables
 if not all([OPENAI_API_KEY, SUNO_API_KEY, GOOGLE_APPLICATION_CREDENTIALS, VERTEX_PROJECT, VERTEX_LOCATION]):
@@ -33,13 +58,166 @@ if not all([OPENAI_API_KEY, SUNO_API_KEY, GOOGLE_APPLICATION_CREDENTIALS, VERTEX
 # Set Google Application Credentials
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_APPLICATION_CREDENTIALS
 
-# Initialize Vertex AI
-try:
-    vertexai.init(project=VERTEX_PROJECT, location=VERTEX_LOCATION)
-    logger.info("Vertex AI initialized successfully.")
-except Exception as e:
-    logger.error(f"Failed to initialize Vertex AI: {e}")
-    exit(1)
+# Vertex AI and the Vision SDK are imported and initialized lazily by clients.py
+# (or warmed in the background, see start_warm_up), so importing the app is fast
+
+# Make sure the job store exists before the first request, and refuse to start
+# with admission limits that need more threads than a worker has
+jobs.init_db()
+admission.check_config()
+
+IMPORT_SECONDS = time.monotonic() - STARTED_AT
+logger.info("App imported in %.3fs.", IMPORT_SECONDS)
+
+# Readiness of this worker process; set once warm-up has built every client
+_warm = {"ready": False, "seconds": None, "errors": {}, "pid": None}
+_warm_lock = threading.Lock()
+
+
+def _warm_up():
+    started = time.monotonic()
+    _warm["errors"] = clients.warm_up([description.DESCRIPTION_MODEL])
+    _warm["seconds"] = round(time.monotonic() - started, 3)
+    _warm["ready"] = True
+    logger.info("Worker %d warm in %.3fs (%.3fs since start).",
+                os.getpid(), _warm["seconds"], time.monotonic() - STARTED_AT)
+
+
+def start_warm_up():
+    """
+    Builds the shared upstream clients in a background thread so the worker can
+    accept connections immediately. /ready reports 503 until it has finished.
+    Called once per worker process (see gunicorn.conf.py).
+    """
+    with _warm_lock:
+        if _warm["pid"] == os.getpid():
+            return
+        _warm.update(ready=False, seconds=None, errors={}, pid=os.getpid())
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_started = time.perf_counter()
+    g.metrics_timings = metrics.start_request_timings()
+    metrics.HTTP_IN_FLIGHT.inc(g.metrics_endpoint)
+    if request.content_length:
+        metrics.HTTP_REQUEST_BYTES.observe(request.content_length, g.metrics_endpoint)
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = g.get("metrics_endpoint")
+    if endpoint is None:
+        return response
+
+    elapsed = time.perf_counter() - g.metrics_started
+    metrics.HTTP_IN_FLIGHT.dec(endpoint)
+    metrics.HTTP_SECONDS.observe(elapsed, endpoint)
+    metrics.HTTP_REQUESTS.inc(endpoint, str(response.status_code))
+    if not response.is_streamed:
+        metrics.HTTP_RESPONSE_BYTES.observe(response.content_length or 0, endpoint)
+
+    timings = metrics.stop_request_timings(g.metrics_timings)
+    if timings and (config.TIMING_HEADERS or request.headers.get("X-Timing") == "1"):
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+
+    # One structured record per request, in place of the server's access log
+    if config.LOG_ACCESS:
+        access_logger.info("request", extra={
+            "method": request.method,
+            "endpoint": endpoint,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 1),
+            "request_bytes": request.content_length or 0,
+            "response_bytes": None if response.is_streamed else response.content_length,
+            "stages": {name: round(seconds * 1000, 1) for name, seconds in timings},
+        })
+    return response
+
+# Endpoints that call the upstreams; their overload and failure responses hold
+# back the warm pool refiller, which cannot see this worker's breakers or queues
+UPSTREAM_ENDPOINTS = {"/generate_music", "/snap_to_song", "/describe_image", "/audio/<clip_id>"}
+
+@app.after_request
+def record_pressure(response):
+    if not config.WARM_POOL or g.get("metrics_endpoint") not in UPSTREAM_ENDPOINTS:
+        return response
+    if response.status_code in (429, 503):
+        kind = "overload"
+    elif response.status_code >= 500:
+        kind = "failure"
+    else:
+        return response
+    try:
+        warm_pool.note_pressure(kind)
+    except Exception as e:
+        logger.warning("Failed to record %s for the warm pool: %s", kind, e)
+    return response
+
+# Registered after the metrics hook so it runs first (Flask runs after_request
+# hooks in reverse) and the recorded response sizes are the compressed ones
+@app.after_request
+def compress_response(response):
+    return responses.compress(response)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Exposes this worker's metrics in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Reports the state of the shared upstream clients in this worker process.
+    """
+    return jsonify({
+        "status": "ok",
+        "clients": clients_health(),
+        "clip_poller": clip_poller.stats(),
+        "description_cache": description_cache.stats(),
+        "lyrics_memo": lyrics_memo.stats(),
+        "upstream": upstream.stats(),
+        "singleflight": singleflight.stats(),
+        "audio_cache": audio_cache.stats(),
+        "admission": admission.stats(),
+        "warm_pool": warm_pool.stats() if config.WARM_POOL else None,
+    }), 200
+
+@app.route('/admin/reset_clients', methods=['POST'])
+def admin_reset_clients():
+    """
+    Closes and discards the upstream clients of the worker that handles the
+    request, so a wedged connection pool can be recovered without a restart;
+    the next upstream call builds fresh ones. Requires ADMIN_TOKEN as a bearer
+    token and is off (404) when it is unset.
+    """
+    if not config.ADMIN_TOKEN:
+        return jsonify({"error": "Not found."}), 404
+    expected = f"Bearer {config.ADMIN_TOKEN}".encode()
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected):
+        return jsonify({"error": "Invalid admin token."}), 401
+
+    clients.reset_clients()
+    return jsonify({"reset": True, "pid": os.getpid()}), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: 200 once this worker's upstream clients are warm, 503 while
+    warm-up is still running. Liveness stays on /health.
+    """
+    body = {
+        "ready": _warm["ready"],
+        "pid": os.getpid(),
+        "import_seconds": round(IMPORT_SECONDS, 3),
+        "warm_seconds": _warm["seconds"],
+        "uptime_seconds": round(time.monotonic() - STARTED_AT, 3),
+    }
+    if _warm["errors"]:
+        body["warm_errors"] = _warm["errors"]
+    return jsonify(body), 200 if _warm["ready"] else 503
 
 @app.route('/generate_music', methods=['POST'])
 def generate_music():
@@ -50,10 +228,20 @@ def generate_music():
     - location (str)
     - weather (str)
     - time_of_day (str)
+    The optional `fields` query parameter selects what is returned, e.g.
+    fields=title,songs.id,songs.audio_url; by default each song is reduced to
+    its id, status, audio_url and image_url (songs.data is the raw Suno payload).
+    With WARM_POOL on, a close enough pre-generated track may be returned
+    instead, with "pooled": true and the "job_id" of the personalized generation.
     """
     data = request.get_json()
     logger.info("Received request to /generate_music with data: %s", data)
 
+    try:
+        fields, song_fields = responses.parse_music_fields(request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     # Extract parameters from request
     setting_description = data.get('setting_description')
     location = data.get('location')
@@ -65,298 +253,550 @@ def generate_music():
         return jsonify({"error": "Missing required parameters."}), 400
 
     try:
-        # Generate music prompt
-        lyrics, title, genre_tags = generate_music_prompt(
-            setting_description, location, weather, time_of_day
+        ticket = admission.acquire(client_id(), "generate")
+    except admission.Overloaded as e:
+        logger.warning("Refused /generate_music: %s", e)
+        return overloaded_response(e)
+
+    try:
+        params = {name: data[name] for name in ("setting_description", "location", "weather", "time_of_day")}
+        if config.WARM_POOL:
+            generate = lambda: _generate_pooled_or_save(params)
+        else:
+            generate = lambda: _generate_and_save(setting_description, location, weather, time_of_day)
+
+        # Run the OpenAI -> Suno chain on the worker's event loop. Identical
+        # requests already in flight (double-taps, retries) share one chain,
+        # including its lyrics and any pooled track it was served.
+        key = singleflight.make_key(
+            "generate_music", *lyrics_memo.make_key(setting_description, location, weather, time_of_day)
         )
-        logger.info("Generated music prompt: Lyrics Length=%d, Title=%s, Genre Tags=%s",
-                    len(lyrics) if lyrics else 0, title, genre_tags)
-
-        if not all([lyrics, title, genre_tags]):
-            logger.error("Failed to generate lyrics, title, or genre tags.")
-            return jsonify({"error": "Failed to generate lyrics, title, or genre tags."}), 500
-
-        # Get generated song IDs
-        song_id_1, song_id_2 = get_generated_song_ids(lyrics, title, genre_tags)
-        logger.info("Generated Song IDs: %s, %s", song_id_1, song_id_2)
-
-        # Fetch song data for each generated song ID
-        song_one_data = get_song_data_from_id(song_id_1)
-        song_two_data = get_song_data_from_id(song_id_2)
-
-        response = {
-            "lyrics": lyrics,
-            "title": title,
-            "genre_tags": genre_tags,
-            "songs": [
-                {"id": song_id_1, "data": song_one_data},
-                {"id": song_id_2, "data": song_two_data}
-            ]
-        }
+        response = singleflight.do(key, generate)
 
-        return jsonify(response), 200
+        # Hand the clips to the readiness poller so clients can wait on /clips/<id>
+        for song in response["songs"]:
+            clip_poller.track(song["id"], song["data"])
+
+        body = responses.project_music(response, fields, song_fields)
+        if response.get("pooled"):
+            body.update(pooled=True, job_id=response["job_id"])
+            return responses.encode(body, headers={"Location": f"/jobs/{response['job_id']}"})
+        return responses.encode(body)
+
+    except ValueError as e:
+        logger.error("%s", e)
+        return jsonify({"error": str(e)}), 500
 
     except Exception as e:
         logger.exception("An error occurred in /generate_music: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/describe_image', methods=['POST'])
-def describe_image():
+    finally:
+        ticket.release()
+
+def client_id():
     """
-    Endpoint to process an image and generate a description.
-    Expects a JSON payload with the following field:
-    - image_base64 (str): The base64-encoded image string.
+    Identifies the caller for admission control: the X-Client-Id header the app
+    sends, else the first X-Forwarded-For hop (the ngrok tunnel forwards the
+    phone's address), else the peer address.
     """
-    data = request.get_json()
-    logger.info("Received request to /describe_image with data: %s", data)
-
-    image_base64 = data.get('image_base64')
-
-    if not image_base64:
-        logger.warning("Missing 'image_base64' parameter in /describe_image request.")
-        return jsonify({"error": "Missing 'image_base64' parameter."}), 400
-
-    try:
-        description = generate_description_from_image_base64(image_base64)
-        logger.info("Generated image description: %s", description)
-        return jsonify({"description": description}), 200
-    except Exception as e:
-        logger.exception("An error occurred in /describe_image: %s", e)
-        return jsonify({"error": str(e)}), 500
-
-def generate_music_prompt(setting_description, location, weather, time_of_day):
+    client = request.headers.get("X-Client-Id")
+    if client:
+        return client[:64]
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.remote_addr or "unknown"
+
+def overloaded_response(error):
+    return (jsonify({"error": str(error), "retry_after": error.retry_after}), error.status,
+            {"Retry-After": str(error.retry_after)})
+
+def _generate_and_save(setting_description, location, weather, time_of_day):
+    response = music.generate_music(setting_description, location, weather, time_of_day)
+    song_library.save_result(response)
+    return response
+
+def _generate_pooled_or_save(params):
     """
-    Calls the OpenAI ChatGPT API to generate music lyrics based on the provided parameters.
+    Writes the lyrics, whose genre picks the warm pool profile, and claims a
+    matching pooled track. On a hit the personalized generation is queued as
+    a job reusing the lyrics, and the pooled result is returned with "pooled"
+    and the "job_id"; on a miss the songs are created from the lyrics here.
     """
-    api_url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
-
-    # Compose the message for ChatGPT
-    messages = [
-        {
-            "role": "system",
-            "content": """You are a helpful assistant that generates music lyrics based on inputted parameters of the user's current setting and surroundings. Write the lyrics in this format with a combination of 6 verses, choruses, and bridges. Also, provide a title for the song and genre tags if possible."""
-        },
-        {
-            "role": "user",
-            "content": (
-                f"The description is: {setting_description}. The location is: {location}. "
-                f"The weather is: {weather}. The current time of day is: {time_of_day}."
-                f"Focus more on the description and be literal about what is happening with minimal creative freedom."
-            )
-        }
-    ]
-
-    # Define the payload for the API call
-    data = {
-        "model": "gpt-4o-mini",  # or "gpt-3.5-turbo" depending on your access
-        "messages": messages,
-        "max_tokens": 400,
-        "temperature": 0.7
-    }
-
-    logger.info("Sending request to OpenAI API for music prompt.")
-
-    # Make the API call
-    response = requests.post(api_url, headers=headers, data=json.dumps(data))
-
-    # Log the response status
-    logger.info("OpenAI API response status: %s", response.status_code)
-
-    # Debugging: Print status code and full response in case of failure
-    if response.status_code != 200:
-        logger.error("Error: Received status code %s from OpenAI API", response.status_code)
-        logger.error("Response: %s", response.text)
-        return None, None, None  # Return None in case of failure
-
-    response_data = response.json()
-    logger.debug("OpenAI API response data: %s", response_data)
-
-    # Extract the generated text from the response
-    if "choices" in response_data and len(response_data["choices"]) > 0:
-        music_prompt = response_data["choices"][0]["message"]["content"].strip()
-        logger.debug("Generated music prompt: %s", music_prompt)
+    lyrics, title, genre_tags = music.generate_music_prompt(
+        params["setting_description"], params["location"], params["weather"], params["time_of_day"]
+    )
+    if not all([lyrics, title, genre_tags]):
+        raise ValueError("Failed to generate lyrics, title, or genre tags.")
 
-        # Initialize variables
-        lyrics = []
-        title = ""
-        genre_tags = []
+    pooled = warm_pool.claim(genre_tags, params["weather"], params["time_of_day"])
+    if pooled is None:
+        response = music.create_songs(lyrics, title, genre_tags)
+        song_library.save_result(response)
+        return response
 
-        # Use basic heuristics to search for title and genre tags in the response
-        lines = music_prompt.splitlines()
+    job_id = jobs.enqueue_job(params, {"lyrics": lyrics, "title": title, "genre_tags": genre_tags})
+    song_library.save_result(pooled)
+    return dict(pooled, pooled=True, job_id=job_id)
 
-        # Search for a line that looks like a title or genre
-        for line in lines:
-            if line.lower().startswith("title:"):
-                title = line.split(":", 1)[1].strip()
-            elif line.lower().startswith("genre:") or line.lower().startswith("tags:"):
-                genre_tags = [tag.strip() for tag in line.split(":", 1)[1].split(",")]
+@app.route('/songs', methods=['GET'])
+def list_songs():
+    """
+    Lists the song library, newest first. Query parameters:
+    - limit (int, default 20, max 100)
+    - cursor (str): next_cursor from the previous page
+    - genre (str): only songs with this genre tag
+    - title (str): only songs whose title starts with this (case-insensitive)
+    - fields (str): comma-separated fields to return
+    Responses carry an ETag; a matching If-None-Match gets a 304.
+    """
+    fields = None
+    if request.args.get("fields"):
+        fields = [field.strip() for field in request.args["fields"].split(",") if field.strip()]
+        unknown = [field for field in fields if field not in song_library.FIELDS]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}."}), 400
 
-            # If the line doesn't look like a title or genre, treat it as lyrics
-            if not (line.lower().startswith("title:") or line.lower().startswith("genre:") or line.lower().startswith("tags:")):
-                lyrics.append(line)
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer."}), 400
+
+    # The ETag covers the library version and the query, so an unchanged
+    # library answers revalidations with one primary-key lookup
+    etag = hashlib.sha1(
+        f"{song_library.version()}?{request.query_string.decode()}".encode()
+    ).hexdigest()[:16]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    # Weak comparison: a compressed listing is sent with a weak ETag
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
 
-        lyrics = "\n".join(lyrics).strip()
+    try:
+        songs, next_cursor = song_library.list_songs(
+            limit=limit,
+            cursor=request.args.get("cursor"),
+            genre=request.args.get("genre"),
+            title=request.args.get("title"),
+            fields=fields,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        # If title or genre tags are not found, return default values
-        if not title:
-            title = "Untitled Song"
-        if not genre_tags:
-            genre_tags = ["Unknown"]
+    return responses.encode({"songs": songs, "next_cursor": next_cursor}, headers=headers)
 
-        logger.info("Parsed Lyrics Length: %d, Title: %s, Genre Tags: %s",
-                    len(lyrics), title, genre_tags)
-        return lyrics, title, genre_tags
-    else:
-        logger.error("OpenAI API response does not contain 'choices' or is empty.")
-        return None, None, None  # Return None in case of an empty response
+@app.route('/songs/<song_id>', methods=['GET'])
+def get_song(song_id):
+    """
+    Endpoint to return one song from the library with all of its fields.
+    """
+    song = song_library.get_song(song_id)
+    if song is None:
+        return jsonify({"error": "Song not found."}), 404
+    return jsonify(song), 200
 
-def get_generated_song_ids(lyrics, title, genre_tags):
+@app.route('/jobs', methods=['POST'])
+def create_job():
     """
-    Calls the Suno API to generate song clips based on the lyrics, title, and genre tags.
-    Returns two generated song clip IDs.
+    Endpoint to queue a song generation job and return immediately.
+    Expects the same JSON payload as /generate_music. The job is picked up by the
+    worker pool (python jobs.py) and its progress is reported by GET /jobs/<id>.
     """
-    api_url = "https://api.aimlapi.com/v2/generate/audio/suno-ai/clip"
-    headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json",
+    data = request.get_json()
+    logger.info("Received request to /jobs with data: %s", data)
+
+    params = {
+        "setting_description": data.get('setting_description'),
+        "location": data.get('location'),
+        "weather": data.get('weather'),
+        "time_of_day": data.get('time_of_day'),
     }
 
-    tags_string = ", ".join(genre_tags)
+    if not all(params.values()):
+        logger.warning("Missing required parameters in /jobs request.")
+        return jsonify({"error": "Missing required parameters."}), 400
 
-    payload = {
-        "prompt": lyrics,
-        "tags": tags_string,  # API expects a string, not an array
-        "title": title
-    }
+    try:
+        job_id = jobs.enqueue_job(params)
+    except Exception as e:
+        logger.exception("An error occurred in /jobs: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-    logger.info("Sending request to Suno API to generate song clips.")
+    return jsonify({"job_id": job_id, "status": jobs.STATUS_QUEUED}), 202, {"Location": f"/jobs/{job_id}"}
 
-    response = requests.post(api_url, headers=headers, json=payload)
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Endpoint to report a job's status, current stage and (partial) results.
+    """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found."}), 404
 
-    # Check for response status code and log error if any
-    if response.status_code != 200:
-        logger.error("Error response from Suno API: %s", response.text)
-        response.raise_for_status()  # Raise the HTTP error with more detail
+    job.pop("params", None)
+    return jsonify(job), 200
 
-    data = response.json()
-    logger.debug("Suno API response data: %s", data)
+@app.route('/clips/<clip_id>', methods=['GET'])
+def get_clip(clip_id):
+    """
+    Long-poll endpoint for clip readiness. Waits up to `wait` seconds (query
+    parameter, default CLIP_WAIT_TIMEOUT, max 60) for the clip to reach
+    "streaming" or "complete". Returns 200 once ready, 202 if still pending
+    when the wait ends, and 502 if generation failed or timed out upstream.
+    Only clips this server generated can be waited on; others get a 404.
+    """
+    try:
+        wait = min(max(float(request.args.get('wait', config.CLIP_WAIT_TIMEOUT)), 0), 60)
+    except ValueError:
+        return jsonify({"error": "Invalid 'wait' parameter."}), 400
+
+    # Tracking a clip starts Suno polls, so made-up ids must not get that far
+    if not audio_cache.valid_clip_id(clip_id):
+        return jsonify({"error": "Clip not found."}), 404
+    if not clip_poller.is_tracked(clip_id):
+        # Generated by another worker (or before a restart): start from what
+        # the library already knows, which may be final
+        song = song_library.get_song(clip_id)
+        if song is None:
+            return jsonify({"error": "Clip not found."}), 404
+        clip_poller.track(clip_id, song["data"])
+
+    clip = clip_poller.wait_for_clip(clip_id, wait)
+    if clip["ready"]:
+        return jsonify(clip), 200
+    if clip["error"]:
+        return jsonify(clip), 502
+    return jsonify(clip), 202
+
+@app.route('/callbacks/suno', methods=['POST'])
+def suno_callback():
+    """
+    Receives clip status updates from Suno (see suno_callbacks.py), records
+    them for the other workers and wakes requests waiting on the clips.
+    """
+    if not suno_callbacks.enabled():
+        return jsonify({"error": "Callbacks are not enabled."}), 404
+    body = request.get_data()
+    if not suno_callbacks.verify(body, request.headers.get(suno_callbacks.SIGNATURE_HEADER),
+                                 request.args.get('token')):
+        return jsonify({"error": "Invalid callback signature."}), 401
 
-    clip_ids = data.get("clip_ids", [])
+    try:
+        updates = suno_callbacks.parse(json.loads(body))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    if len(clip_ids) < 2:
-        logger.error("Insufficient clip IDs returned from Suno API.")
-        raise Exception("Insufficient clip IDs returned from Suno API.")
+    suno_callbacks.record(updates)
+    for clip_id, data in updates:
+        logger.info("Callback for clip %s: %s.", clip_id, data.get("status"))
+        clip_poller.apply_update(clip_id, data)
+    return jsonify({"received": len(updates)}), 200
 
-    return clip_ids[0], clip_ids[1]
+# Finished clips never change, so cached audio may be kept by clients and CDNs
+AUDIO_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
-def get_song_data_from_id(song_id):
+@app.route('/audio/<clip_id>', methods=['GET'])
+def get_audio(clip_id):
     """
-    Retrieves song data from Suno API using the provided song ID.
+    Serves a finished clip's MP3 from the local audio cache, downloading it
+    from Suno's CDN on first use. Supports Range requests for seeking. Clips
+    that are still generating are redirected to the CDN.
     """
-    api_url = "https://api.aimlapi.com/v2/generate/audio/suno-ai/clip"
+    if not audio_cache.valid_clip_id(clip_id):
+        return jsonify({"error": "Clip not found."}), 404
+
+    path = audio_cache.cached_path(clip_id)
+    if path is None:
+        try:
+            song = song_library.get_song(clip_id)
+            data = song["data"] if song else None
+            if not data or data.get("status") != "complete":
+                data = music.get_song_data_from_id(clip_id)
+                song_library.update_clip(clip_id, data)
+            if not data or not data.get("audio_url"):
+                return jsonify({"error": "Clip has no audio yet."}), 404
+            if data.get("status") != "complete":
+                response = redirect(audio_cache.mp3_url(data["audio_url"]), 307)
+                response.headers["Cache-Control"] = "no-store"
+                return response
+            path = audio_cache.fetch(clip_id, data["audio_url"])
+        except upstream.CircuitOpenError as e:
+            return jsonify({"error": str(e)}), 503
+        except Exception as e:
+            logger.exception("An error occurred in /audio: %s", e)
+            return jsonify({"error": str(e)}), 502
+
+    return _send_audio(path, clip_id)
+
+def _send_audio(path, clip_id):
+    """
+    Sends the file (or the requested byte range of it) through the server's
+    wsgi.file_wrapper, so gunicorn can hand it to sendfile() without copying
+    it through Python. The file is positioned at the start of the range and
+    Content-Length bounds how much is sent.
+    """
+    f = open(path, "rb")
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
     headers = {
-        "Authorization": f"Bearer {SUNO_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    params = {
-        "clip_id": song_id,
-        "status": "streaming",
+        "ETag": f'"{clip_id}"',
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": AUDIO_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
     }
+    if request.if_none_match.contains(clip_id):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    status = 200
+    length = size
+    byte_range = request.range
+    # A Range with a stale If-Range validator gets the whole file
+    if_range = request.headers.get("If-Range")
+    if byte_range is not None and (if_range is None or request.if_range.etag == clip_id):
+        span = byte_range.range_for_length(size)
+        if span is None:
+            f.close()
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        start, stop = span
+        f.seek(start)
+        status = 206
+        length = stop - start
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(length)
+
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        body = file_wrapper(f, 256 * 1024)
+    else:
+        body = _read_span(f, length)
+    return Response(body, status=status, mimetype="audio/mpeg", headers=headers, direct_passthrough=True)
+
+def _read_span(f, length):
+    # Fallback for servers without wsgi.file_wrapper (the development server)
+    with f:
+        while length > 0:
+            chunk = f.read(min(256 * 1024, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+# Content types accepted as a raw image request body
+RAW_IMAGE_TYPES = ("image/jpeg", "image/png", "image/heic", "image/webp", "application/octet-stream")
+
+class ImageUploadError(Exception):
+    """
+    Raised when the uploaded image is missing, malformed or too large.
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
 
-    logger.info("Fetching song data for clip ID: %s", song_id)
-
-    response = requests.get(api_url, headers=headers, params=params)
-
-    if response.status_code != 200:
-        logger.error("Error fetching song data for ID %s: %s", song_id, response.text)
-        response.raise_for_status()
+def read_image_upload():
+    """
+    Reads the image from the request in whichever form the client sent it:
+    - a raw image body (Content-Type image/*); other fields come from the query string
+    - multipart/form-data with an "image" file part; other fields are form fields
+    - JSON with an "image_base64" field (older clients); other fields are JSON fields
+    Raw and multipart uploads are read once into a buffer bounded by MAX_IMAGE_BYTES.
+    Returns (image_bytes, fields).
+    """
+    limit = config.MAX_IMAGE_BYTES
+
+    if request.mimetype in RAW_IMAGE_TYPES:
+        length = request.content_length
+        if length is not None and length > limit:
+            raise ImageUploadError("Image is too large.", 413)
+        # Read up to one byte past the limit so an oversized chunked body is detected
+        image_bytes = request.stream.read(limit + 1 if length is None else length)
+        fields = request.args
+
+    elif request.mimetype == "multipart/form-data":
+        upload = request.files.get('image')
+        if upload is None:
+            raise ImageUploadError("Missing 'image' file part.")
+        image_bytes = upload.stream.read(limit + 1)
+        fields = request.form
 
-    data = response.json()
-    logger.debug("Song data for clip ID %s: %s", song_id, data)
-    return data
+    else:
+        data = request.get_json(silent=True) or {}
+        image_base64 = data.get('image_base64')
+        if not image_base64:
+            raise ImageUploadError("Missing 'image_base64' parameter.")
+        if len(image_base64) > limit * 4 // 3 + 4:
+            raise ImageUploadError("Image is too large.", 413)
+        try:
+            image_bytes = description.decode_image_base64(image_base64)
+        except ValueError as e:
+            raise ImageUploadError(str(e)) from e
+        fields = data
+
+    if not image_bytes:
+        raise ImageUploadError("Empty image upload.")
+    if len(image_bytes) > limit:
+        raise ImageUploadError("Image is too large.", 413)
+    return image_bytes, fields
 
-def generate_description_from_image_base64(image_base64):
+@app.route('/describe_image', methods=['POST'])
+def describe_image():
     """
-    Processes a base64-encoded image to generate a description using Google Cloud Vision API
-    and Vertex AI's generative model.
+    Endpoint to process an image and generate a description.
+    Accepts the image as a raw image/jpeg (or other image/*) body, as the "image"
+    part of a multipart/form-data upload, or as a JSON payload with the field:
+    - image_base64 (str): The base64-encoded image string.
+    An optional `mode` field ("two_stage" or "fast") overrides DESCRIPTION_MODE;
+    the mode used is returned alongside the description.
     """
-    logger.info("Starting image description generation.")
-
-    # Decode the base64 image
     try:
-        image_bytes = base64.b64decode(image_base64)
-        logger.debug("Image decoded successfully.")
-    except base64.binascii.Error as e:
-        logger.error("Invalid base64 image data: %s", e)
-        raise ValueError("Invalid base64 image data.") from e
+        image_bytes, fields = read_image_upload()
+        mode = description.resolve_mode(fields.get('mode'))
+    except ImageUploadError as e:
+        logger.warning("Rejected /describe_image upload: %s", e)
+        return jsonify({"error": str(e)}), e.status
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    # Get image descriptions using Google Cloud Vision API
-    descriptions = get_image_description(image_bytes)
-    logger.info("Image descriptions from Vision API: %s", descriptions)
+    logger.info("Received request to /describe_image (%s, %d bytes).", request.mimetype, len(image_bytes))
 
-    # Generate a combined description using Vertex AI's generative model
     try:
-        model = GenerativeModel("gemini-1.0-pro-vision-001")  # Updated model name
-        chat = model.start_chat()
-        logger.info("Vertex AI generative model initialized.")
+        key = singleflight.make_key("describe_image", hashlib.sha256(image_bytes).hexdigest(), mode)
+        result = singleflight.do(key, lambda: description.describe_image_bytes(image_bytes, mode))
+        logger.info("Generated image description: %s", result["description"])
+        return jsonify({"description": result["description"], "mode": result["mode"]}), 200
     except Exception as e:
-        logger.error("Failed to initialize Vertex AI generative model: %s", e)
-        raise
-
-    prompt = (
-        f"The following are key details observed in the image: {', '.join(descriptions)}. "
-        "Describe what is happening in the image and feelings evoked."
-    )
-
-    logger.info("Sending prompt to Vertex AI generative model.")
-
-    model_response = chat.send_message(prompt)
-    logger.debug("Vertex AI response: %s", model_response.text if model_response else "No response")
-
-    return model_response.text if model_response else "No response generated."
+        logger.exception("An error occurred in /describe_image: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-def get_image_description(image_bytes):
+@app.route('/snap_to_song', methods=['POST'])
+def snap_to_song():
     """
-    Uses Google Cloud Vision API to perform label detection on the image and return descriptions.
+    Endpoint to turn a photo into songs in one request, streaming progress as
+    Server-Sent Events. The image is uploaded the same ways as /describe_image,
+    together with the following fields:
+    - location (str)
+    - weather (str)
+    - time_of_day (str)
+    - mode (str, optional): description mode, as for /describe_image
+
+    Emits, in order: labels (two_stage mode only), description, then title,
+    genre_tags and lyric_line events while lyrics are generated, lyrics (the
+    complete lyrics, title and genre_tags), clips (clip ids), songs (clip data), clip_ready (once per clip), done.
+    An error event ends the stream if any stage fails.
     """
-    logger.info("Performing label detection using Google Cloud Vision API.")
+    try:
+        image_bytes, fields = read_image_upload()
+    except ImageUploadError as e:
+        logger.warning("Rejected /snap_to_song upload: %s", e)
+        return jsonify({"error": str(e)}), e.status
 
-    # Initialize Google Cloud Vision client
     try:
-        client = vision.ImageAnnotatorClient()
-        logger.info("Google Cloud Vision client initialized.")
-    except Exception as e:
-        logger.error("Failed to initialize Google Cloud Vision client: %s", e)
-        raise
+        mode = description.resolve_mode(fields.get('mode'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    # Prepare the image for the Vision API
-    image = vision.Image(content=image_bytes)
+    logger.info("Received request to /snap_to_song (%s, %d bytes).", request.mimetype, len(image_bytes))
 
-    # Perform label detection on the image
-    response = client.label_detection(image=image)
-    logger.info("Label detection completed.")
+    location = fields.get('location')
+    weather = fields.get('weather')
+    time_of_day = fields.get('time_of_day')
 
-    # Handle errors in response
-    if response.error.message:
-        logger.error("Google Cloud Vision API Error: %s", response.error.message)
-        raise Exception(f'Google Cloud Vision API Error: {response.error.message}')
+    if not all([location, weather, time_of_day]):
+        logger.warning("Missing required parameters in /snap_to_song request.")
+        return jsonify({"error": "Missing required parameters."}), 400
 
-    # Extract labels (descriptions) from the response
-    descriptions = [label.description for label in response.label_annotations]
+    try:
+        ticket = admission.acquire(client_id(), "snap")
+    except admission.Overloaded as e:
+        logger.warning("Refused /snap_to_song: %s", e)
+        return overloaded_response(e)
+
+    stream = _snap_to_song_events(image_bytes, mode, location, weather, time_of_day, ticket)
+    response = Response(stream_with_context(stream), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Also frees the slot if the client goes away before the stream starts
+    response.call_on_close(ticket.release)
+    return response
+
+def _sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def _snap_to_song_events(image_bytes, mode, location, weather, time_of_day, ticket):
+    """
+    Runs the describe -> lyrics -> Suno chain, yielding an SSE message per stage.
+    The admission ticket is released once the clips are submitted; waiting for
+    them to become playable costs no upstream capacity.
+    """
+    try:
+        cached, cache_key = description_cache.lookup(image_bytes, mode)
+        if cached is not None:
+            labels, setting_description = cached["labels"], cached["description"]
+            if labels:
+                yield _sse("labels", {"labels": labels, "cached": True})
+            yield _sse("description", {"description": setting_description, "mode": mode, "cached": True})
+        else:
+            image_bytes = preprocess_image(image_bytes)
+            if mode == description.MODE_FAST:
+                labels = []
+                setting_description = description.describe_image_fast(image_bytes)
+            else:
+                labels = description.get_image_description(image_bytes)
+                yield _sse("labels", {"labels": labels})
+                setting_description = description.describe_labels(labels)
+
+            description_cache.store(cache_key, labels, setting_description)
+            yield _sse("description", {"description": setting_description, "mode": mode})
+
+        # Stream lyric lines to the client while OpenAI generates them; the parsed
+        # result is final as soon as the stream ends
+        lyrics_stream = music.stream_music_prompt_async(
+            setting_description, location, weather, time_of_day
+        )
+        for event, value in runtime.iterate(lyrics_stream):
+            if event == "done":
+                lyrics, title, genre_tags = value
+            elif event == "lyric":
+                yield _sse("lyric_line", {"line": value})
+            else:
+                yield _sse(event, {event: value})
+        yield _sse("lyrics", {"lyrics": lyrics, "title": title, "genre_tags": genre_tags})
+
+        clip_ids = music.get_generated_song_ids(lyrics, title, genre_tags)
+        yield _sse("clips", {"clip_ids": list(clip_ids)})
+
+        songs = runtime.run(music.get_songs_data_async(clip_ids))
+        ticket.release()
+        song_library.save_songs(songs, lyrics, title, genre_tags)
+        yield _sse("songs", {"songs": songs})
+
+        # Wait for every clip to become playable, reporting each as it lands and
+        # sending keep-alive comments so proxies and tunnels keep the stream open
+        for song in songs:
+            clip_poller.track(song["id"], song["data"])
+        waiting = {
+            runtime.submit(clip_poller.wait_for_clip_async(clip_id, config.CLIP_POLL_MAX_AGE))
+            for clip_id in clip_ids
+        }
+        while waiting:
+            finished, waiting = concurrent.futures.wait(
+                waiting, timeout=15, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if not finished:
+                yield ": keep-alive\n\n"
+            for future in finished:
+                clip = future.result()
+                yield _sse("clip_ready" if clip["ready"] else "clip_failed", clip)
 
-    # Handle the case where no labels are returned
-    if not descriptions:
-        logger.warning("No labels detected in the image.")
-        return ["No discernible objects found."]
+        yield _sse("done", {})
 
-    return descriptions
+    except Exception as e:
+        logger.exception("An error occurred in /snap_to_song: %s", e)
+        yield _sse("error", {"error": str(e)})
 
 if __name__ == "__main__":
-    # Run the Flask app
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py).
+    # The reloader imports the app twice, so debug mode is opt-in.
+    start_warm_up()
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv("FLASK_DEBUG") == "1")
 
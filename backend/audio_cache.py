@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import logging
+import threading
+
+import config
+import runtime
+import upstream
+import singleflight
+import metrics
+from upstream import UpstreamError
+from clients import get_async_session
+
+logger = logging.getLogger(__name__)
+
+# Size-bounded on-disk cache of finished clips' MP3s, so repeat plays and shared
+# songs are served locally instead of from Suno's CDN. Only clips whose status
+# is "complete" are cached; a "streaming" clip's file is still growing. Files
+# are written to a temporary name and renamed into place, so readers never see
+# a partial file. Eviction is least-recently-used by access time, which is set
+# explicitly on every hit (mtime is left alone so Last-Modified stays stable).
+
+_CLIP_ID = re.compile(r"^[A-Za-z0-9-]{1,64}$")
+_CHUNK_BYTES = 256 * 1024
+_PART_MAX_AGE = 3600
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "downloads": 0, "evictions": 0}
+
+
+def valid_clip_id(clip_id):
+    return bool(_CLIP_ID.match(clip_id))
+
+
+def mp3_url(audio_url):
+    """
+    Turns a clip's audio_url (".../audio/?item_id=<id>") into the URL of its
+    MP3 file (".../<id>.mp3").
+    """
+    if "audio/?item_id=" not in audio_url:
+        return audio_url
+    return audio_url.replace("audio/?item_id=", "") + ".mp3"
+
+
+def _path(clip_id):
+    return os.path.join(config.AUDIO_CACHE_DIR, f"{clip_id}.mp3")
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def cached_path(clip_id):
+    """
+    Returns the path of the cached MP3, marking it recently used, or None if
+    the clip is not cached.
+    """
+    path = _path(clip_id)
+    try:
+        stat = os.stat(path)
+        os.utime(path, (time.time(), stat.st_mtime))
+    except FileNotFoundError:
+        return None
+    _count("hits")
+    return path
+
+
+async def _download_async(clip_id, url, path):
+    session = get_async_session("cdn")
+    part = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+
+    async def attempt(timeout):
+        async with session.get(url, timeout=timeout) as response:
+            metrics.count_upstream_response("suno_cdn", response.status)
+            if response.status != 200:
+                raise UpstreamError("Suno CDN", response.status, (await response.text())[:200])
+
+            # Plain file writes of page-cache-sized chunks are quick enough to
+            # do on the loop
+            size = 0
+            with open(part, "wb") as f:
+                async for chunk in response.content.iter_chunked(_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > config.AUDIO_MAX_FILE_BYTES:
+                        raise ValueError(f"Clip {clip_id} is larger than {config.AUDIO_MAX_FILE_BYTES} bytes.")
+                    f.write(chunk)
+            return size
+
+    try:
+        with metrics.stage("download_audio"):
+            size = await upstream.call_async("suno.audio", attempt)
+        os.replace(part, path)
+    finally:
+        if os.path.exists(part):
+            os.unlink(part)
+    return size
+
+
+def _evict(keep):
+    """
+    Deletes least recently used files until the cache fits AUDIO_CACHE_MAX_BYTES,
+    never deleting `keep`. Leftover partial downloads are cleaned up too.
+    """
+    now = time.time()
+    entries = []
+    total = 0
+    with os.scandir(config.AUDIO_CACHE_DIR) as it:
+        for entry in it:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".part"):
+                if now - stat.st_mtime > _PART_MAX_AGE:
+                    os.unlink(entry.path)
+                continue
+            total += stat.st_size
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    if total <= config.AUDIO_CACHE_MAX_BYTES:
+        return
+    # Evict down to 90% so a full cache does not evict on every download
+    target = config.AUDIO_CACHE_MAX_BYTES * 0.9
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        _count("evictions")
+
+
+def fetch(clip_id, audio_url):
+    """
+    Returns the path of the clip's cached MP3, downloading it first if needed.
+    Concurrent requests for the same clip, in this worker or another, share
+    one download.
+    """
+    path = cached_path(clip_id)
+    if path is not None:
+        return path
+
+    def download():
+        path = _path(clip_id)
+        if os.path.exists(path):
+            return path
+        os.makedirs(config.AUDIO_CACHE_DIR, exist_ok=True)
+        started = time.perf_counter()
+        size = runtime.run(_download_async(clip_id, mp3_url(audio_url), path))
+        _count("downloads")
+        logger.info("Cached clip %s (%d bytes) in %.0f ms.", clip_id, size, (time.perf_counter() - started) * 1000)
+        _evict(keep=path)
+        return path
+
+    key = singleflight.make_key("audio", clip_id)
+    path = singleflight.do(key, download)
+    # A path shared by another worker may have been evicted since. Forget that
+    # result and go through the flight again, so concurrent requests still
+    # share one download.
+    if not os.path.exists(path):
+        singleflight.forget(key)
+        path = singleflight.do(key, download)
+    return path
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,302 @@
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import threading
+import concurrent.futures
+
+import config
+import logs
+import description
+import description_cache
+import preprocess
+
+logger = logging.getLogger(__name__)
+
+# Describes whole directories of photos (event dumps, camera rolls) ahead of
+# time, with the same preprocessing, Vision and Gemini calls and the same
+# description cache as the API. Images go through three stages:
+#
+#   1. read, cache lookup and preprocessing (in a process pool), a chunk of up
+#      to 16 images at a time;
+#   2. one Vision batch_annotate_images call per chunk;
+#   3. one Gemini call per image (skipped in "labels" mode).
+#
+# Stages 1-2 and stage 3 run in separate thread pools, and new chunks are only
+# started while the Gemini backlog is short, so memory stays bounded however
+# large the directory is. Each result is appended to the output JSONL as soon as
+# it is ready. The output file is also the checkpoint: a rerun skips every path
+# already recorded with status "ok" and retries the ones that failed.
+#
+#   python batch.py photos/ -o photos.jsonl
+#   python batch.py "dumps/**/*.jpg" -o dumps.jsonl --mode fast --workers 8
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# Vision labels only, no Gemini description
+MODE_LABELS = "labels"
+MODES = description.MODES + (MODE_LABELS,)
+
+NO_LABELS = "No discernible objects found."
+PROGRESS_INTERVAL = 10
+
+# Set on Ctrl-C so in-flight work stops before its next upstream call
+_stopping = threading.Event()
+
+
+def find_images(sources):
+    """
+    Expands directories (recursively) and glob patterns into a sorted list of
+    absolute image paths without duplicates.
+    """
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                paths.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.extend(path for path in sorted(glob.glob(source, recursive=True)) if os.path.isfile(path))
+    return list(dict.fromkeys(os.path.abspath(path) for path in paths))
+
+
+def load_checkpoint(output_path):
+    """
+    Returns the set of paths already described successfully in output_path.
+    A last line cut short by an interrupted run is truncated away, so new
+    results are appended after the last complete one.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+
+    with open(output_path, "rb+") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                logger.warning("Discarding incomplete last line of %s.", output_path)
+                f.truncate(offset)
+                break
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping unreadable line in %s.", output_path)
+                continue
+            if record.get("status") == "ok":
+                done.add(record["path"])
+    return done
+
+
+def _error_record(path, error):
+    return {"path": path, "status": "error", "error": str(error) or type(error).__name__}
+
+
+def _prepare_chunk(paths, mode):
+    """
+    Reads a chunk of images, answers what it can from the description cache
+    and preprocesses and labels the rest. Returns one item per path: either a
+    finished record or the state the describe stage needs.
+    """
+    # Labels-only runs reuse the Vision labels of cached two_stage descriptions
+    cache_mode = description.MODE_TWO_STAGE if mode == MODE_LABELS else mode
+    items = []
+    for path in paths:
+        item = {"path": path, "started": time.perf_counter()}
+        try:
+            with open(path, "rb") as f:
+                image_bytes = f.read()
+            cached, item["key"] = description_cache.lookup(image_bytes, cache_mode)
+        except Exception as e:
+            item["record"] = _error_record(path, e)
+            items.append(item)
+            continue
+
+        if cached is not None:
+            item["labels"] = [{"description": label, "score": None} for label in cached["labels"]]
+            item["description"] = cached["description"]
+            item["cached"] = True
+        else:
+            item["image"] = image_bytes
+        items.append(item)
+
+    misses = [item for item in items if "image" in item]
+    if not misses:
+        return items
+
+    for item, processed in zip(misses, preprocess.preprocess_images([item["image"] for item in misses])):
+        item["image"] = processed
+
+    if mode == description.MODE_FAST:
+        for item in misses:
+            item["labels"] = []
+        return items
+
+    if _stopping.is_set():
+        results = [Exception("Interrupted.")] * len(misses)
+    else:
+        try:
+            results = description.get_image_labels_batch([item["image"] for item in misses])
+        except Exception as e:
+            logger.error("Vision batch of %d images failed: %s", len(misses), e)
+            results = [e] * len(misses)
+    for item, result in zip(misses, results):
+        del item["image"]
+        if isinstance(result, Exception):
+            item["record"] = _error_record(item["path"], result)
+        else:
+            item["labels"] = result
+    return items
+
+
+def _describe(item, mode):
+    """
+    Generates the Gemini description for a prepared item and caches it.
+    """
+    if _stopping.is_set():
+        return _error_record(item["path"], "Interrupted.")
+    try:
+        if mode == description.MODE_FAST:
+            text = description.describe_image_fast(item.pop("image"))
+        else:
+            text = description.describe_labels([label["description"] for label in item["labels"]] or [NO_LABELS])
+        description_cache.store(item["key"], [label["description"] for label in item["labels"]], text)
+    except Exception as e:
+        return _error_record(item["path"], e)
+    item["description"] = text
+    return _record(item, mode)
+
+
+def _record(item, mode):
+    return {
+        "path": item["path"],
+        "sha256": item["key"].sha256,
+        "mode": mode,
+        "labels": item["labels"],
+        "description": item.get("description"),
+        "cached": item.get("cached", False),
+        "elapsed_ms": round((time.perf_counter() - item["started"]) * 1000),
+        "status": "ok",
+    }
+
+
+def _chunks(paths, size):
+    for i in range(0, len(paths), size):
+        yield paths[i:i + size]
+
+
+def run(paths, output_path, mode, batch_size=description.VISION_BATCH_MAX_IMAGES,
+        concurrency=4, describe_concurrency=8):
+    """
+    Describes every path, appending one JSON record per image to output_path.
+    Returns {"ok", "errors", "seconds"}.
+    """
+    batch_size = max(1, min(batch_size, description.VISION_BATCH_MAX_IMAGES))
+    chunks = _chunks(paths, batch_size)
+    counts = {"ok": 0, "errors": 0}
+    started = last_progress = time.monotonic()
+
+    prepare_pool = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix="snaptracks-batch")
+    describe_pool = concurrent.futures.ThreadPoolExecutor(describe_concurrency,
+                                                          thread_name_prefix="snaptracks-describe")
+    preparing = {}  # future -> chunk paths
+    describing = set()
+
+    def fill():
+        # Keep the Gemini backlog short so prepared images do not pile up
+        while len(preparing) < concurrency and len(describing) < describe_concurrency * 2:
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            preparing[prepare_pool.submit(_prepare_chunk, chunk, mode)] = chunk
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            counts["ok" if record["status"] == "ok" else "errors"] += 1
+
+        try:
+            fill()
+            while preparing or describing:
+                done, _ = concurrent.futures.wait(set(preparing) | describing,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in describing:
+                        describing.discard(future)
+                        write(future.result())
+                        continue
+
+                    chunk = preparing.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        logger.exception("Failed to prepare %d images.", len(chunk))
+                        items = [{"record": _error_record(path, e)} for path in chunk]
+                    for item in items:
+                        if "record" in item:
+                            write(item["record"])
+                        elif item.get("cached") or mode == MODE_LABELS:
+                            write(_record(item, mode))
+                        else:
+                            describing.add(describe_pool.submit(_describe, item, mode))
+
+                fill()
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    processed = counts["ok"] + counts["errors"]
+                    logger.info("Processed %d/%d images (%d errors, %.1f images/s).", processed, len(paths),
+                                counts["errors"], processed / (last_progress - started))
+        except KeyboardInterrupt:
+            logger.warning("Interrupted; rerun the same command to resume.")
+            _stopping.set()
+            raise
+        finally:
+            prepare_pool.shutdown(wait=False, cancel_futures=True)
+            describe_pool.shutdown(wait=False, cancel_futures=True)
+            # Without queued preprocessing, the chunk threads finish quickly
+            preprocess.shutdown()
+
+    return dict(counts, seconds=round(time.monotonic() - started, 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Describe every photo in a directory or glob, "
+                                                 "writing one JSON line per image.")
+    parser.add_argument("sources", nargs="+", help="image directories, files or glob patterns")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSONL file results are appended to; also the checkpoint for resuming")
+    parser.add_argument("--mode", choices=MODES, default=config.DESCRIPTION_MODE)
+    parser.add_argument("--batch-size", type=int, default=description.VISION_BATCH_MAX_IMAGES,
+                        help="images per Vision request (at most 16)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Vision batches in flight")
+    parser.add_argument("--describe-concurrency", type=int, default=8, help="Gemini calls in flight")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="preprocessing processes")
+    args = parser.parse_args(argv)
+
+    # Decoding and resizing thousands of photos is CPU-bound, so use processes
+    config.IMAGE_PREPROCESS_EXECUTOR = "process"
+    config.IMAGE_PREPROCESS_WORKERS = args.workers
+    logs.configure()
+
+    paths = find_images(args.sources)
+    done = load_checkpoint(args.output)
+    todo = [path for path in paths if path not in done]
+    logger.info("Found %d images; %d already described, %d to go.", len(paths), len(paths) - len(todo), len(todo))
+    if not todo:
+        return 0
+
+    try:
+        result = run(todo, args.output, args.mode, args.batch_size, args.concurrency, args.describe_concurrency)
+    except KeyboardInterrupt:
+        return 130
+    logger.info("Described %d images (%d errors) in %.1f s.", result["ok"], result["errors"], result["seconds"])
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
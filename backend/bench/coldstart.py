@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+from bench.run import BACKEND_DIR, _free_port, _wait_ready
+from bench.stubs import upstream_env
+
+# Measures how long a fresh server takes to come up: the time until it accepts
+# requests (/health) and until its upstream clients are warm (/ready), plus the
+# import time the app reports about itself. Runs the production server by
+# default; --server dev uses Flask's development server instead.
+#
+#   python -m bench.coldstart
+#   python -m bench.coldstart --runs 5 --workers 4 --preload
+
+
+def start_server(args, port, data_dir, stub_port):
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "bench", "SUNO_API_KEY": "bench",
+        "GOOGLE_APPLICATION_CREDENTIALS": os.devnull,
+        "VERTEX_PROJECT": "bench", "VERTEX_LOCATION": "us-central1",
+        "SNAPTRACKS_DATA_DIR": data_dir,
+    })
+    if stub_port:
+        env.update(upstream_env(stub_port))
+
+    if args.server == "gunicorn":
+        env.update({
+            "BIND": f"127.0.0.1:{port}",
+            "WEB_WORKERS": str(args.workers),
+            "PRELOAD_APP": "1" if args.preload else "0",
+        })
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"]
+    else:
+        command = [sys.executable, "-c",
+                   f"import app; app.start_warm_up(); "
+                   f"app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def _get_json(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            return await response.json()
+
+
+def measure(args, data_dir, stub_port):
+    port = _free_port()
+    started = time.monotonic()
+    server = start_server(args, port, data_dir, stub_port)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        asyncio.run(_wait_ready(base_url + "/health", timeout=args.timeout))
+        listening = time.monotonic() - started
+        asyncio.run(_wait_ready(base_url + "/ready", timeout=args.timeout))
+        ready = time.monotonic() - started
+        # With several workers, /ready may be answered by one still warming up
+        report = asyncio.run(_get_json(base_url + "/ready"))
+        for _ in range(20):
+            if report["warm_seconds"] is not None:
+                break
+            time.sleep(0.1)
+            report = asyncio.run(_get_json(base_url + "/ready"))
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "listening_s": round(listening, 3),
+        "ready_s": round(ready, 3),
+        "import_s": report["import_seconds"],
+        "warm_s": report["warm_seconds"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure SnapTracks backend cold-start time.")
+    parser.add_argument("--server", choices=("gunicorn", "dev"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--preload", action="store_true", help="import the app in the master before forking")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--real-sdk", action="store_true",
+                        help="warm up the real Google SDK clients instead of the local stand-ins")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    stubs = None
+    stub_port = None
+    if not args.real_sdk:
+        stub_port = _free_port()
+        stubs = subprocess.Popen(
+            [sys.executable, "-m", "bench.stubs", "--port", str(stub_port), "--scale", "0"],
+            cwd=BACKEND_DIR,
+        )
+
+    results = []
+    try:
+        if stubs is not None:
+            asyncio.run(_wait_ready(f"http://127.0.0.1:{stub_port}/_stats"))
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory(prefix="snaptracks-coldstart-") as data_dir:
+                results.append(measure(args, data_dir, stub_port))
+    finally:
+        if stubs is not None:
+            stubs.terminate()
+            stubs.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for i, result in enumerate(results, 1):
+            print(f"run {i}: listening {result['listening_s']}s, ready {result['ready_s']}s "
+                  f"(import {result['import_s']}s, warm-up {result['warm_s']}s)")
+        best = min(result["ready_s"] for result in results)
+        print(f"best time to ready: {best}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import base64
+import requests
+from google.cloud import vision
+
+# Drop-in replacements for the Vision and Vertex AI SDK objects used by the
+# backend, talking JSON to the REST stand-in in bench/stubs.py. They are only
+# used when GOOGLE_STUB_URL is set (see clients.py), so benchmarks never need
+# Google credentials.
+
+
+class StubVisionClient:
+    """
+    Mimics vision.ImageAnnotatorClient.label_detection and
+    batch_annotate_images against POST {base}/v1/images:annotate.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def _annotate(self, images, timeout):
+        body = {
+            "requests": [{
+                "image": {"content": base64.b64encode(content).decode("ascii")},
+                "features": [{"type": "LABEL_DETECTION"}],
+            } for content in images]
+        }
+        response = self.session.post(f"{self.base_url}/v1/images:annotate", json=body, timeout=timeout)
+        response.raise_for_status()
+        return [
+            vision.AnnotateImageResponse(
+                label_annotations=[vision.EntityAnnotation(description=label["description"],
+                                                           score=label.get("score", 0))
+                                   for label in result.get("labelAnnotations", [])],
+            )
+            for result in response.json()["responses"]
+        ]
+
+    def label_detection(self, image, timeout=None, **kwargs):
+        return self._annotate([image.content], timeout)[0]
+
+    def batch_annotate_images(self, requests, timeout=None, **kwargs):
+        responses = self._annotate([request.image.content for request in requests], timeout)
+        return vision.BatchAnnotateImagesResponse(responses=responses)
+
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class _StubChat:
+    def __init__(self, model):
+        self.model = model
+
+    def send_message(self, content):
+        return self.model.generate_content(content)
+
+
+class StubGenerativeModel:
+    """
+    Mimics vertexai GenerativeModel.generate_content / start_chat against
+    POST {base}/v1/models/<model>:generateContent.
+    """
+
+    def __init__(self, model_name):
+        import config
+        self.model_name = model_name
+        self.base_url = config.GOOGLE_STUB_URL.rstrip("/")
+        self.session = requests.Session()
+
+    def start_chat(self):
+        return _StubChat(self)
+
+    def generate_content(self, contents):
+        if not isinstance(contents, list):
+            contents = [contents]
+        parts = [{"text": part} if isinstance(part, str) else part.to_dict() for part in contents]
+        response = self.session.post(
+            f"{self.base_url}/v1/models/{self.model_name}:generateContent",
+            json={"contents": [{"role": "user", "parts": parts}]},
+        )
+        response.raise_for_status()
+        candidate = response.json()["candidates"][0]
+        return _StubResponse("".join(part.get("text", "") for part in candidate["content"]["parts"]))
@@ -0,0 +1,302 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+from bench.stubs import upstream_env
+
+# Load test for the backend against the local upstream stubs. Starts the stubs and
+# the app as subprocesses, drives /describe_image and /generate_music at a fixed
+# concurrency, and reports throughput, latency percentiles and the app's memory.
+# With --check the results are compared to bench/baselines.json and the run fails
+# loudly on a regression; --update-baseline records new baselines.
+#
+#   python -m bench.run --check
+#   python -m bench.run --scenario generate_music --concurrency 64 --requests 1000
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_PATH = os.path.join(BACKEND_DIR, "bench", "baselines.json")
+SCENARIOS = ("describe_image", "generate_music")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _make_jpeg():
+    """
+    Builds a phone-sized noisy JPEG (noise keeps it from compressing to nothing).
+    """
+    from PIL import Image
+    image = Image.effect_noise((2016, 1512), 64).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def _rss_mb(pid):
+    """
+    Resident memory of a process and its children, in MB (Linux only).
+    """
+    total = 0
+    pids = [pid]
+    try:
+        children = subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout.split()
+        pids += [int(child) for child in children]
+    except OSError:
+        pass
+    for each in pids:
+        try:
+            with open(f"/proc/{each}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def _wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout}s")
+
+
+def _request_factory(scenario, jpeg):
+    """
+    Returns a function building (method, path, kwargs) for request number i.
+    Inputs are unique per request so caches and coalescing stay out of the way
+    unless they are explicitly enabled.
+    """
+    if scenario == "describe_image":
+        def build(i):
+            # Bytes after the JPEG end marker are ignored by decoders but change the hash
+            body = jpeg + random.randbytes(16)
+            return "POST", "/describe_image", {"data": body, "headers": {"Content-Type": "image/jpeg"}}
+    else:
+        def build(i):
+            return "POST", "/generate_music", {"json": {
+                "setting_description": f"A student walking across campus, snap {i} {random.random()}",
+                "location": "Orlando",
+                "weather": "Sunny",
+                "time_of_day": "Middle of afternoon",
+            }}
+    return build
+
+
+async def drive(base_url, scenario, concurrency, total, app_pid, jpeg):
+    build = _request_factory(scenario, jpeg)
+    latencies = []
+    errors = 0
+    peak_rss = 0.0
+    next_index = 0
+
+    async def worker(session):
+        nonlocal next_index, errors
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            method, path, kwargs = build(index)
+            started = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, **kwargs) as response:
+                    await response.read()
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    async def sample_memory(stop):
+        nonlocal peak_rss
+        while not stop.is_set():
+            peak_rss = max(peak_rss, _rss_mb(app_pid))
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Warm up connections and lazily created clients
+        saved_total, total = total, min(concurrency, total)
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        total, next_index, errors = saved_total, 0, 0
+        latencies.clear()
+
+        stop = asyncio.Event()
+        sampler = asyncio.ensure_future(sample_memory(stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+        "p90_ms": round(_percentile(latencies, 0.90) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+
+
+def start_processes(args, data_dir):
+    stub_port, app_port = _free_port(), _free_port()
+    stubs = subprocess.Popen(
+        [sys.executable, "-m", "bench.stubs", "--port", str(stub_port), "--scale", str(args.scale),
+         "--clip-ready-after", "0", "--seed", "1"]
+        + [f"--error-rate={rate}" for rate in args.error_rate or []],
+        cwd=BACKEND_DIR,
+    )
+
+    env = dict(os.environ, **upstream_env(stub_port))
+    env.update({
+        "OPENAI_API_KEY": "bench", "SUNO_API_KEY": "bench",
+        "GOOGLE_APPLICATION_CREDENTIALS": os.devnull,
+        "VERTEX_PROJECT": "bench", "VERTEX_LOCATION": "us-central1",
+        "SNAPTRACKS_DATA_DIR": data_dir,
+        # Every simulated request comes from this one client, so per-client
+        # admission limits would refuse nearly all of them; the bench measures
+        # the generation path itself
+        "ADMISSION": "0",
+    })
+    if not args.with_caches:
+        env.update({"DESCRIPTION_CACHE": "0", "LYRICS_MEMO_ENTRIES": "0"})
+    app = subprocess.Popen(
+        [sys.executable, "-c",
+         f"import logging, app; logging.disable(logging.INFO); "
+         f"app.app.run(host='127.0.0.1', port={app_port}, threaded=True)"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return stubs, app, f"http://127.0.0.1:{stub_port}", f"http://127.0.0.1:{app_port}"
+
+
+def settings_of(args):
+    return {"concurrency": args.concurrency, "requests": args.requests, "scale": args.scale,
+            "with_caches": args.with_caches, "error_rate": sorted(args.error_rate or [])}
+
+
+def check(results, baselines, tolerance):
+    """
+    Compares results to baselines and returns a list of regression messages.
+    """
+    failures = []
+    for scenario, result in results.items():
+        base = baselines.get(scenario)
+        if base is None:
+            failures.append(f"{scenario}: no baseline recorded (run with --update-baseline)")
+            continue
+        if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            failures.append(f"{scenario}: throughput {result['throughput_rps']} rps < baseline {base['throughput_rps']}")
+        for key in ("p50_ms", "p99_ms", "peak_rss_mb"):
+            if result[key] > base[key] * (1 + tolerance):
+                failures.append(f"{scenario}: {key} {result[key]} > baseline {base[key]}")
+        if result["error_rate"] > base["error_rate"] + 0.01:
+            failures.append(f"{scenario}: error rate {result['error_rate']} > baseline {base['error_rate']}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SnapTracks backend against local stub upstreams.")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--scale", type=float, default=0.1, help="stub latency multiplier")
+    parser.add_argument("--error-rate", action="append", metavar="ENDPOINT=RATE", help="passed to the stubs")
+    parser.add_argument("--with-caches", action="store_true", help="leave the description/lyrics caches on")
+    parser.add_argument("--check", action="store_true", help="fail if results regress against the baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression fraction for --check")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    jpeg = _make_jpeg()
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix="snaptracks-bench-") as data_dir:
+        stubs, app, stub_url, app_url = start_processes(args, data_dir)
+        try:
+            asyncio.run(_wait_ready(stub_url + "/_stats"))
+            asyncio.run(_wait_ready(app_url + "/health"))
+            for scenario in scenarios:
+                results[scenario] = asyncio.run(
+                    drive(app_url, scenario, args.concurrency, args.requests, app.pid, jpeg)
+                )
+        finally:
+            app.terminate()
+            stubs.terminate()
+            app.wait()
+            stubs.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for scenario, result in results.items():
+            print(f"{scenario}: {result['throughput_rps']} req/s, p50 {result['p50_ms']} ms, "
+                  f"p90 {result['p90_ms']} ms, p99 {result['p99_ms']} ms, "
+                  f"errors {result['error_rate'] * 100:.1f}%, peak RSS {result['peak_rss_mb']} MB")
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines.update(results)
+        baselines["settings"] = settings_of(args)
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baselines written to {BASELINES_PATH}")
+
+    if args.check:
+        if baselines.get("settings") != settings_of(args):
+            print(f"WARNING: baselines were recorded with {baselines.get('settings')}, "
+                  f"this run used {settings_of(args)}", file=sys.stderr)
+        failures = check(results, baselines, args.tolerance)
+        if failures:
+            print("\nPERFORMANCE REGRESSION:", file=sys.stderr)
+            for failure in failures:
+                print(f"  {failure}", file=sys.stderr)
+            return 1
+        print("No regressions against baselines.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+import hmac
+import json
+import time
+import hashlib
+import random
+import asyncio
+import argparse
+import logging
+import uuid
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Local stand-ins for every upstream the backend calls, for load tests that must
+# not spend OpenAI/Suno/Google money. Each endpoint answers after a latency drawn
+# from a log-normal distribution (median and sigma configurable) and fails with a
+# 503 at a configurable rate. Routes mirror the real APIs' request/response shapes:
+#
+#   POST /openai/v1/chat/completions          (stream and non-stream)
+#   POST /suno/clip, GET /suno/clip?clip_id=   (clips turn "streaming" after --clip-ready-after,
+#                                               "complete" after --clip-complete-after)
+#                                              A submission with a callback_url also gets a POST
+#                                              to it at each of those points (--callback-drop-rate
+#                                              of them are dropped, to exercise polling fallback)
+#   GET /cdn/<clip_id>.mp3                     (Suno's audio CDN)
+#   POST /google/v1/images:annotate            (Vision label detection)
+#   POST /google/v1/models/<model>:generateContent   (Gemini)
+
+# endpoint -> (median latency in ms, log-normal sigma)
+DEFAULT_LATENCY = {
+    "openai": (2500, 0.35),
+    "suno_submit": (1200, 0.3),
+    "suno_fetch": (250, 0.4),
+    "vision": (400, 0.3),
+    "gemini": (1500, 0.35),
+    "cdn": (300, 0.3),
+}
+
+# Stand-in MP3 body served for every clip
+AUDIO_BYTES = random.Random(0).randbytes(1024 * 1024)
+
+LYRICS = """Title: Afternoon Steps
+Genre: indie pop, acoustic
+[Verse]
+Walking past the windows in the light
+Backpack on my shoulders feeling right
+[Chorus]
+Every step a song beneath the sky
+Every face a story passing by
+[Verse 2]
+Bricks and benches warming in the sun
+Quiet little moments one by one
+[Bridge]
+Hold this place a little while
+Carry home a campus smile"""
+
+
+class StubConfig:
+    def __init__(self, latency=None, error_rates=None, scale=1.0, clip_ready_after=30.0, seed=None,
+                 clip_complete_after=90.0, callback_secret=None, callback_drop_rate=0.0):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.error_rates = error_rates or {}
+        self.scale = scale
+        self.clip_ready_after = clip_ready_after
+        self.clip_complete_after = clip_complete_after
+        self.callback_secret = callback_secret
+        self.callback_drop_rate = callback_drop_rate
+        self.callbacks = {"sent": 0, "dropped": 0, "failed": 0}
+        self.random = random.Random(seed)
+        self.requests = {name: 0 for name in DEFAULT_LATENCY}
+
+    async def delay(self, endpoint):
+        """
+        Sleeps for the endpoint's sampled latency; returns True if this call
+        should fail.
+        """
+        self.requests[endpoint] += 1
+        median, sigma = self.latency[endpoint]
+        await asyncio.sleep(median / 1000 * self.scale * self.random.lognormvariate(0, sigma))
+        return self.random.random() < self.error_rates.get(endpoint, 0.0)
+
+
+def _unavailable():
+    return web.json_response({"error": "stub: simulated upstream failure"}, status=503)
+
+
+async def openai_chat(request):
+    stub = request.app["stub"]
+    body = await request.json()
+    if await stub.delay("openai"):
+        return _unavailable()
+
+    if not body.get("stream"):
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": LYRICS}}]})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for line in LYRICS.splitlines(keepends=True):
+        chunk = {"choices": [{"delta": {"content": line}}]}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await asyncio.sleep(0.01 * stub.scale)
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+def _clip_payload(host, clip_id, status):
+    return {
+        "id": clip_id,
+        "status": status,
+        "title": "Afternoon Steps",
+        "audio_url": f"http://{host}/cdn/audio/?item_id={clip_id}",
+        "metadata": {"tags": "indie pop, acoustic", "prompt": LYRICS},
+    }
+
+
+async def _send_callbacks(app, host, clip_id, callback_url):
+    # Reports "streaming" and then "complete" the way Suno's task callbacks do
+    stub = app["stub"]
+    created = app["clips"][clip_id]
+    for status, after in (("streaming", stub.clip_ready_after), ("complete", stub.clip_complete_after)):
+        await asyncio.sleep(max(created + after - time.time(), 0))
+        if stub.random.random() < stub.callback_drop_rate:
+            stub.callbacks["dropped"] += 1
+            continue
+        body = json.dumps({"callbackType": status, "data": [_clip_payload(host, clip_id, status)]}).encode()
+        headers = {"Content-Type": "application/json"}
+        if stub.callback_secret:
+            digest = hmac.new(stub.callback_secret.encode(), body, hashlib.sha256).hexdigest()
+            headers["X-Suno-Signature"] = f"sha256={digest}"
+        try:
+            async with app["http"].post(callback_url, data=body, headers=headers) as response:
+                if response.status != 200:
+                    raise ValueError(f"status {response.status}")
+            stub.callbacks["sent"] += 1
+        except Exception as e:
+            stub.callbacks["failed"] += 1
+            logger.warning("Callback for clip %s failed: %s", clip_id, e)
+
+
+async def suno_submit(request):
+    stub = request.app["stub"]
+    body = await request.json()
+    if await stub.delay("suno_submit"):
+        return _unavailable()
+    clip_ids = [uuid.uuid4().hex, uuid.uuid4().hex]
+    now = time.time()
+    for clip_id in clip_ids:
+        request.app["clips"][clip_id] = now
+        if body.get("callback_url"):
+            task = asyncio.create_task(_send_callbacks(request.app, request.host, clip_id, body["callback_url"]))
+            request.app["callback_tasks"].add(task)
+            task.add_done_callback(request.app["callback_tasks"].discard)
+    return web.json_response({"clip_ids": clip_ids})
+
+
+async def suno_fetch(request):
+    stub = request.app["stub"]
+    clip_id = request.query.get("clip_id", "")
+    if await stub.delay("suno_fetch"):
+        return _unavailable()
+    created = request.app["clips"].setdefault(clip_id, time.time())
+    age = time.time() - created
+    if age >= stub.clip_complete_after:
+        status = "complete"
+    elif age >= stub.clip_ready_after:
+        status = "streaming"
+    else:
+        status = "queued"
+    return web.json_response(_clip_payload(request.host, clip_id, status))
+
+
+async def cdn_audio(request):
+    stub = request.app["stub"]
+    if await stub.delay("cdn"):
+        return _unavailable()
+    return web.Response(body=AUDIO_BYTES, content_type="audio/mpeg")
+
+
+async def vision_annotate(request):
+    stub = request.app["stub"]
+    body = await request.json()
+    if await stub.delay("vision"):
+        return _unavailable()
+    labels = ["Sky", "Building", "Tree", "Person", "Backpack", "Campus"]
+    return web.json_response({
+        "responses": [{"labelAnnotations": [{"description": label, "score": 0.9} for label in labels]}
+                      for _ in body.get("requests", [])]
+    })
+
+
+async def gemini_generate(request):
+    stub = request.app["stub"]
+    await request.json()
+    if await stub.delay("gemini"):
+        return _unavailable()
+    text = ("A student walks across a sunny college campus with a backpack, "
+            "surrounded by trees and brick buildings. The scene feels calm and hopeful.")
+    return web.json_response({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]})
+
+
+async def stats(request):
+    stub = request.app["stub"]
+    return web.json_response(dict(stub.requests, callbacks=stub.callbacks))
+
+
+async def _http_session(app):
+    app["http"] = aiohttp.ClientSession()
+    yield
+    for task in list(app["callback_tasks"]):
+        task.cancel()
+    await app["http"].close()
+
+
+def make_app(stub):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app["stub"] = stub
+    app["clips"] = {}
+    app["callback_tasks"] = set()
+    app.cleanup_ctx.append(_http_session)
+    app.add_routes([
+        web.post("/openai/v1/chat/completions", openai_chat),
+        web.post("/suno/clip", suno_submit),
+        web.get("/suno/clip", suno_fetch),
+        web.get(r"/cdn/{clip_id}.mp3", cdn_audio),
+        web.post("/google/v1/images:annotate", vision_annotate),
+        web.post(r"/google/v1/models/{model}:generateContent", gemini_generate),
+        web.get("/_stats", stats),
+    ])
+    return app
+
+
+def upstream_env(port):
+    """
+    Environment variables that point the backend at stubs running on port.
+    """
+    base = f"http://127.0.0.1:{port}"
+    return {
+        "OPENAI_CHAT_URL": f"{base}/openai/v1/chat/completions",
+        "SUNO_CLIP_URL": f"{base}/suno/clip",
+        "GOOGLE_STUB_URL": f"{base}/google",
+    }
+
+
+def _parse_pairs(values, convert):
+    result = {}
+    for value in values or []:
+        name, _, setting = value.partition("=")
+        result[name] = convert(setting)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run local stand-ins for the SnapTracks upstream APIs.")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every latency by this factor")
+    parser.add_argument("--latency", action="append", metavar="ENDPOINT=MEDIAN_MS:SIGMA",
+                        help=f"override latency for one of {', '.join(DEFAULT_LATENCY)}")
+    parser.add_argument("--error-rate", action="append", metavar="ENDPOINT=RATE",
+                        help="fraction of calls to the endpoint that fail with 503")
+    parser.add_argument("--clip-ready-after", type=float, default=30.0,
+                        help="seconds before a submitted clip reports 'streaming'")
+    parser.add_argument("--clip-complete-after", type=float, default=90.0,
+                        help="seconds before a submitted clip reports 'complete'")
+    parser.add_argument("--callback-secret", help="sign clip callbacks with this SUNO_CALLBACK_SECRET")
+    parser.add_argument("--callback-drop-rate", type=float, default=0.0,
+                        help="fraction of clip callbacks that are never sent")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    latency = _parse_pairs(args.latency, lambda v: tuple(float(x) for x in v.split(":")))
+    stub = StubConfig(latency, _parse_pairs(args.error_rate, float), args.scale, args.clip_ready_after, args.seed,
+                      args.clip_complete_after, args.callback_secret, args.callback_drop_rate)
+    logging.basicConfig(level=logging.WARNING)
+    web.run_app(make_app(stub), host="127.0.0.1", port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Process-wide registry of upstream clients. Everything here is created lazily on
+# first use and then shared by every request handled by this worker process, so
+# TLS sessions and gRPC channels are reused instead of being rebuilt per snap.
+_lock = threading.Lock()
+_async_sessions = {}
+_models = {}
+_vision_client = None
+_vertexai_ready = False
+_owner_pid = os.getpid()
+
+# Default headers for each named upstream session
+_SESSION_HEADERS = {
+    "openai": lambda: {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config.OPENAI_API_KEY}",
+    },
+    "suno": lambda: {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config.SUNO_API_KEY}",
+    },
+    # Suno's audio CDN; public URLs, so no credentials are sent
+    "cdn": lambda: {},
+}
+
+
+def _check_pid():
+    """
+    Drops clients inherited from a parent process. Sockets and gRPC channels must
+    not be shared across a fork, so a forked worker builds its own on first use.
+    Must be called with the registry lock held.
+    """
+    global _vision_client, _owner_pid
+    if os.getpid() != _owner_pid:
+        logger.info("Process fork detected; discarding inherited upstream clients.")
+        _async_sessions.clear()
+        _models.clear()
+        _vision_client = None
+        _owner_pid = os.getpid()
+
+
+def get_async_session(name):
+    """
+    Returns the shared keep-alive aiohttp.ClientSession for the named upstream.
+    Must be called from the worker's background event loop (see runtime.py);
+    the session is bound to that loop and reused by every coroutine on it.
+    """
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    entry = _async_sessions.get(name)
+    if entry is not None and entry[0] is loop and not entry[1].closed:
+        return entry[1]
+
+    with _lock:
+        _check_pid()
+        entry = _async_sessions.get(name)
+        if entry is None or entry[0] is not loop or entry[1].closed:
+            if name not in _SESSION_HEADERS:
+                raise ValueError(f"Unknown upstream session: {name}")
+            connector = aiohttp.TCPConnector(
+                limit=config.HTTP_POOL_MAXSIZE,
+                keepalive_timeout=60,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                headers=_SESSION_HEADERS[name](),
+            )
+            _async_sessions[name] = (loop, session)
+            logger.info("Created shared async HTTP session for %s (pool size %d).",
+                        name, config.HTTP_POOL_MAXSIZE)
+        return _async_sessions[name][1]
+
+
+def get_vision_client():
+    """
+    Returns the shared Google Cloud Vision ImageAnnotatorClient.
+    """
+    global _vision_client
+    client = _vision_client
+    if client is not None and os.getpid() == _owner_pid:
+        return client
+
+    # Import the SDK before taking the lock; it is slow and must not stall the
+    # other getters or /health
+    if config.GOOGLE_STUB_URL:
+        from bench.google_shims import StubVisionClient
+    else:
+        from google.cloud import vision
+
+    with _lock:
+        _check_pid()
+        if _vision_client is None:
+            if config.GOOGLE_STUB_URL:
+                _vision_client = StubVisionClient(config.GOOGLE_STUB_URL)
+                logger.info("Using Vision stand-in at %s.", config.GOOGLE_STUB_URL)
+            else:
+                _vision_client = vision.ImageAnnotatorClient()
+                logger.info("Google Cloud Vision client initialized.")
+        return _vision_client
+
+
+def _init_vertexai():
+    """
+    Initializes the Vertex AI SDK once per process. Importing vertexai takes
+    seconds, so it is deferred until the first model is needed instead of
+    happening when the app module is imported. Must be called with the registry
+    lock held.
+    """
+    global _vertexai_ready
+    if _vertexai_ready or config.GOOGLE_STUB_URL:
+        return
+    import vertexai  # already imported by get_generative_model
+    vertexai.init(project=config.VERTEX_PROJECT, location=config.VERTEX_LOCATION)
+    _vertexai_ready = True
+    logger.info("Vertex AI initialized successfully.")
+
+
+def get_generative_model(model_name):
+    """
+    Returns the shared Vertex AI GenerativeModel for the given model name.
+    """
+    model = _models.get(model_name)
+    if model is not None and os.getpid() == _owner_pid:
+        return model
+
+    if config.GOOGLE_STUB_URL:
+        from bench.google_shims import StubGenerativeModel as GenerativeModel
+    else:
+        from vertexai.generative_models import GenerativeModel
+
+    with _lock:
+        _check_pid()
+        model = _models.get(model_name)
+        if model is None:
+            _init_vertexai()
+            model = GenerativeModel(model_name)
+            _models[model_name] = model
+            logger.info("Vertex AI generative model %s initialized.", model_name)
+        return model
+
+
+def preload():
+    """
+    Imports the Google SDK modules without creating any clients. Called in the
+    server's master process before it forks (see gunicorn.conf.py), so workers
+    share the imported code pages and skip the import cost. No sockets or
+    channels are opened, so nothing unsafe is inherited across the fork.
+    """
+    if config.GOOGLE_STUB_URL:
+        return
+    started = time.perf_counter()
+    from google.cloud import vision  # noqa: F401
+    from vertexai.generative_models import GenerativeModel, Part  # noqa: F401
+    logger.info("Preloaded Google SDK modules in %.2fs.", time.perf_counter() - started)
+
+
+def warm_up(model_names=()):
+    """
+    Builds every shared client this worker will need: the Vision client, the
+    named generative models and the keep-alive aiohttp sessions. Meant to run in
+    the background right after a worker starts, so the first snap does not pay
+    for SDK imports and client construction. A client that fails to build is
+    skipped (its getter retries on first use); returns {client: error}.
+    """
+    import runtime
+
+    async def open_async_sessions():
+        for name in _SESSION_HEADERS:
+            get_async_session(name)
+
+    steps = [("vision", get_vision_client)]
+    steps += [(model_name, lambda m=model_name: get_generative_model(m)) for model_name in model_names]
+    steps.append(("async_sessions", lambda: runtime.run(open_async_sessions(), timeout=30)))
+
+    errors = {}
+    for name, build in steps:
+        try:
+            build()
+        except Exception as e:
+            logger.warning("Warm-up of %s failed: %s", name, e)
+            errors[name] = str(e)
+    return errors
+
+
+def clients_health():
+    """
+    Reports which shared clients have been created in this worker process.
+    """
+    with _lock:
+        _check_pid()
+        return {
+            "pid": _owner_pid,
+            "async_sessions": sorted(_async_sessions),
+            "models": sorted(_models),
+            "vision": _vision_client is not None,
+            "vertexai": _vertexai_ready,
+            "pool_maxsize": config.HTTP_POOL_MAXSIZE,
+        }
+
+
+def reset_clients():
+    """
+    Closes and discards every shared client in this worker process. The next
+    call to a getter builds a fresh one, which is how a worker recovers from a
+    wedged connection pool (see POST /admin/reset_clients).
+    """
+    global _vision_client
+    with _lock:
+        _check_pid()
+        for name, (loop, session) in _async_sessions.items():
+            if not session.closed and not loop.is_closed():
+                asyncio.run_coroutine_threadsafe(session.close(), loop)
+        _async_sessions.clear()
+        _models.clear()
+        if _vision_client is not None:
+            transport = getattr(_vision_client, "transport", None)
+            try:
+                if transport is not None:
+                    transport.close()
+            except Exception as e:
+                logger.warning("Failed to close Vision client transport: %s", e)
+        _vision_client = None
+    logger.info("Shared upstream clients reset.")
@@ -0,0 +1,297 @@
+import time
+import asyncio
+import logging
+
+import config
+import runtime
+import music
+import song_library
+import suno_callbacks
+
+logger = logging.getLogger(__name__)
+
+# Clip statuses that mean the audio URL can be played
+READY_STATUSES = ("streaming", "complete")
+# Terminal statuses that will never become ready
+FAILED_STATUSES = ("error", "failed", "expired")
+
+# One scheduler per worker process tracks every pending Suno clip and polls them
+# in batches on the background event loop, instead of every phone running its own
+# HEAD loop against the CDN. With Suno callbacks on (see suno_callbacks.py),
+# pushed updates finish clips as soon as they arrive and polling slows to a
+# fallback for missed callbacks. All state below is only touched from that loop.
+_clips = {}
+_wakeup = None
+_task = None
+_pushed = 0
+
+
+class _Clip:
+    __slots__ = ("id", "status", "data", "error", "first_seen", "next_poll",
+                 "interval", "polls", "waiters", "finished_at", "callback_seq")
+
+    def __init__(self, clip_id, now):
+        self.id = clip_id
+        self.status = "pending"
+        self.data = None
+        self.error = None
+        self.first_seen = now
+        self.next_poll = now
+        self.interval = _min_interval()
+        self.polls = 0
+        self.waiters = []
+        self.finished_at = None
+        self.callback_seq = 0
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "ready": self.status in READY_STATUSES,
+            "audio_url": (self.data or {}).get("audio_url"),
+            "polls": self.polls,
+            "age": round(time.time() - self.first_seen, 1),
+            "error": self.error,
+            "data": self.data,
+        }
+
+
+def _min_interval():
+    # Callbacks report progress, so polling only has to catch the missed ones
+    if suno_callbacks.enabled():
+        return max(config.CLIP_POLL_MIN_INTERVAL, config.CLIP_CALLBACK_POLL_INTERVAL)
+    return config.CLIP_POLL_MIN_INTERVAL
+
+
+def _ensure_started():
+    global _wakeup, _task
+    if _task is None or _task.done():
+        _wakeup = asyncio.Event()
+        _task = asyncio.get_running_loop().create_task(_scheduler())
+
+
+def _finish(clip, now):
+    clip.finished_at = now
+    for waiter in clip.waiters:
+        if not waiter.done():
+            waiter.set_result(clip)
+    clip.waiters.clear()
+    if clip.data:
+        asyncio.get_running_loop().run_in_executor(None, _save_to_library, clip.id, clip.data)
+
+
+def _save_to_library(clip_id, data):
+    # Keep the song library's status and audio URL current without another
+    # Suno fetch when a playlist is loaded
+    try:
+        song_library.update_clip(clip_id, data)
+    except Exception as e:
+        logger.warning("Failed to update clip %s in the song library: %s", clip_id, e)
+
+
+def _update(clip, data, now):
+    """
+    Applies a fetched or pushed clip payload and schedules the next poll. The
+    interval grows while the clip shows no progress, resets when its status
+    changes, and is pushed to the maximum for clips that are much older than a
+    typical generation.
+    """
+    status = (data or {}).get("status") or "unknown"
+    clip.data = data
+
+    if status in READY_STATUSES:
+        clip.status = status
+        logger.info("Clip %s is %s after %.1fs and %d poll(s).",
+                    clip.id, status, now - clip.first_seen, clip.polls)
+        _finish(clip, now)
+        return
+    if status in FAILED_STATUSES:
+        clip.status = status
+        clip.error = f"Clip generation {status}."
+        _finish(clip, now)
+        return
+
+    if status != clip.status:
+        clip.interval = _min_interval()
+    else:
+        clip.interval = min(clip.interval * 1.5, config.CLIP_POLL_MAX_INTERVAL)
+    if now - clip.first_seen > config.CLIP_POLL_MAX_AGE / 4:
+        clip.interval = config.CLIP_POLL_MAX_INTERVAL
+    clip.status = status
+    clip.next_poll = now + clip.interval
+
+
+async def _poll(clip):
+    clip.polls += 1
+    try:
+        data = await music.get_song_data_from_id_async(clip.id)
+    except Exception as e:
+        now = time.time()
+        clip.interval = min(clip.interval * 2, config.CLIP_POLL_MAX_INTERVAL)
+        clip.next_poll = now + clip.interval
+        logger.warning("Polling clip %s failed (retrying in %.0fs): %s", clip.id, clip.interval, e)
+        return
+    _update(clip, data, time.time())
+
+
+def _apply_pushed(clip, data, now):
+    global _pushed
+    _pushed += 1
+    if not clip.finished:
+        _update(clip, data, now)
+    elif clip.status == "streaming" and (data or {}).get("status") == "complete":
+        # A clip that became playable while streaming has finished now; keep
+        # its stored audio URL current
+        clip.status = "complete"
+        clip.data = data
+        asyncio.get_running_loop().run_in_executor(None, _save_to_library, clip.id, data)
+
+
+async def _check_callbacks(pending):
+    # Pick up callbacks that were received by other workers
+    after = {clip.id: clip.callback_seq for clip in pending}
+    try:
+        updates = await asyncio.get_running_loop().run_in_executor(None, suno_callbacks.latest, list(after), after)
+    except Exception as e:
+        logger.warning("Checking for clip callbacks failed: %s", e)
+        return
+    now = time.time()
+    for clip_id, (seq, data) in updates.items():
+        clip = _clips.get(clip_id)
+        if clip is not None:
+            clip.callback_seq = seq
+            _apply_pushed(clip, data, now)
+
+
+async def _scheduler():
+    last_callback_check = 0
+    while True:
+        now = time.time()
+
+        # Expire clips that never became ready and forget old finished ones
+        for clip in list(_clips.values()):
+            if clip.finished:
+                if not clip.waiters and now - clip.finished_at > config.CLIP_READY_RETENTION:
+                    del _clips[clip.id]
+            elif now - clip.first_seen > config.CLIP_POLL_MAX_AGE:
+                clip.status = "timeout"
+                clip.error = "Clip did not become ready in time."
+                _finish(clip, now)
+
+        pending = [clip for clip in _clips.values() if not clip.finished]
+        callbacks = suno_callbacks.enabled() and pending
+        if callbacks and now - last_callback_check >= config.CLIP_CALLBACK_CHECK_INTERVAL:
+            last_callback_check = now
+            await _check_callbacks(pending)
+            continue
+
+        due = sorted((clip for clip in pending if clip.next_poll <= now),
+                     key=lambda clip: clip.next_poll)
+
+        # Poll the most overdue clips in one concurrent batch
+        if due:
+            await asyncio.gather(*(_poll(clip) for clip in due[:config.CLIP_POLL_BATCH_SIZE]))
+            continue
+
+        # Sleep until the next clip is due, the next callback check, or a new
+        # clip is tracked
+        delay = min((clip.next_poll for clip in pending), default=now + 60) - now
+        if callbacks:
+            delay = min(delay, last_callback_check + config.CLIP_CALLBACK_CHECK_INTERVAL - now)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), max(delay, 0.05))
+        except asyncio.TimeoutError:
+            pass
+
+
+async def track_async(clip_id, data=None):
+    """
+    Starts tracking a clip (no-op if it is already tracked). If data from an
+    earlier fetch is given it is applied immediately, saving one poll.
+    """
+    _ensure_started()
+    clip = _clips.get(clip_id)
+    if clip is None:
+        now = time.time()
+        clip = _Clip(clip_id, now)
+        _clips[clip_id] = clip
+        if data is not None:
+            clip.polls += 1
+            _update(clip, data, now)
+        _wakeup.set()
+    return clip
+
+
+async def apply_update_async(clip_id, data):
+    """
+    Applies a clip update pushed by a Suno callback, waking any requests
+    waiting on the clip. Returns None for clips this worker is not tracking.
+    """
+    clip = _clips.get(clip_id)
+    if clip is None:
+        # The update is already recorded for the other workers (and for a later
+        # wait on the clip here); tracking it would only start fallback polls
+        # for a clip nobody in this worker is waiting on
+        if (data or {}).get("status") in READY_STATUSES:
+            asyncio.get_running_loop().run_in_executor(None, _save_to_library, clip_id, data)
+        return None
+    _apply_pushed(clip, data, time.time())
+    return clip
+
+
+async def wait_for_clip_async(clip_id, timeout=None):
+    """
+    Waits until the clip is ready (or has failed) for at most timeout seconds and
+    returns its state dict; the state is returned as-is if the wait times out.
+    """
+    clip = await track_async(clip_id)
+    if not clip.finished:
+        waiter = asyncio.get_running_loop().create_future()
+        clip.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, config.CLIP_WAIT_TIMEOUT if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            if waiter in clip.waiters:
+                clip.waiters.remove(waiter)
+    return clip.to_dict()
+
+
+async def _is_tracked(clip_id):
+    return clip_id in _clips
+
+
+async def _stats():
+    pending = [clip for clip in _clips.values() if not clip.finished]
+    return {
+        "tracked": len(_clips),
+        "pending": len(pending),
+        "waiters": sum(len(clip.waiters) for clip in pending),
+        "pushed_updates": _pushed,
+    }
+
+
+# Blocking wrappers for Flask request threads
+
+def track(clip_id, data=None):
+    runtime.run(track_async(clip_id, data))
+
+
+def is_tracked(clip_id):
+    return runtime.run(_is_tracked(clip_id))
+
+
+def wait_for_clip(clip_id, timeout=None):
+    return runtime.run(wait_for_clip_async(clip_id, timeout))
+
+
+def apply_update(clip_id, data):
+    runtime.run(apply_update_async(clip_id, data))
+
+
+def stats():
+    return runtime.run(_stats())
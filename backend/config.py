@@ -0,0 +1,164 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Retrieve API keys and configurations from environment variables
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+SUNO_API_KEY = os.getenv("SUNO_API_KEY")
+GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+VERTEX_PROJECT = os.getenv("VERTEX_PROJECT")
+VERTEX_LOCATION = os.getenv("VERTEX_LOCATION")
+
+# Upstream endpoints (overridable so benchmarks can point them at local stubs)
+OPENAI_CHAT_URL = os.getenv("OPENAI_CHAT_URL", "https://api.openai.com/v1/chat/completions")
+SUNO_CLIP_URL = os.getenv("SUNO_CLIP_URL", "https://api.aimlapi.com/v2/generate/audio/suno-ai/clip")
+# When set, Vision and Gemini calls go to this REST stand-in (bench/stubs.py)
+# instead of Google Cloud
+GOOGLE_STUB_URL = os.getenv("GOOGLE_STUB_URL")
+
+# Connection pool sizing for the shared upstream HTTP sessions (per worker process).
+# HTTP_POOL_MAXSIZE is the number of keep-alive connections kept per host.
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+
+# Add a Server-Timing header with per-stage timings to every response
+# (clients can also ask for it per request with "X-Timing: 1")
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "0") == "1"
+
+# Local state (job queue, caches, song library) lives under this directory
+DATA_DIR = os.getenv("SNAPTRACKS_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+
+# Song generation job queue
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(DATA_DIR, "jobs.db"))
+SONG_LIBRARY_DB_PATH = os.getenv("SONG_LIBRARY_DB_PATH", os.path.join(DATA_DIR, "songs.db"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # worker processes
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "8"))  # in-flight jobs per worker process
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+
+# Server-side clip readiness poller
+CLIP_POLL_BATCH_SIZE = int(os.getenv("CLIP_POLL_BATCH_SIZE", "16"))  # clips fetched concurrently per tick
+CLIP_POLL_MIN_INTERVAL = float(os.getenv("CLIP_POLL_MIN_INTERVAL", "2"))
+CLIP_POLL_MAX_INTERVAL = float(os.getenv("CLIP_POLL_MAX_INTERVAL", "20"))
+CLIP_POLL_MAX_AGE = float(os.getenv("CLIP_POLL_MAX_AGE", "600"))  # give up on a clip after this many seconds
+CLIP_READY_RETENTION = float(os.getenv("CLIP_READY_RETENTION", "1800"))  # keep finished clip state this long
+CLIP_WAIT_TIMEOUT = float(os.getenv("CLIP_WAIT_TIMEOUT", "25"))  # default long-poll wait
+
+# Suno completion callbacks (see suno_callbacks.py). SUNO_CALLBACK_URL is the
+# public URL of this server's /callbacks/suno; callbacks are on when it and
+# SUNO_CALLBACK_SECRET (the HMAC signing key) or SUNO_CALLBACK_TOKEN are set.
+SUNO_CALLBACK_URL = os.getenv("SUNO_CALLBACK_URL")
+SUNO_CALLBACK_SECRET = os.getenv("SUNO_CALLBACK_SECRET")
+# Opt-in fallback for providers that cannot sign: a separate random value sent
+# as ?token= on the callback URL, so it shows up in access logs. Never reuse the secret.
+SUNO_CALLBACK_TOKEN = os.getenv("SUNO_CALLBACK_TOKEN")
+SUNO_CALLBACK_DB_PATH = os.getenv("SUNO_CALLBACK_DB_PATH", os.path.join(DATA_DIR, "suno_callbacks.db"))
+CLIP_CALLBACK_CHECK_INTERVAL = float(os.getenv("CLIP_CALLBACK_CHECK_INTERVAL", "0.25"))  # other workers' callbacks
+CLIP_CALLBACK_POLL_INTERVAL = float(os.getenv("CLIP_CALLBACK_POLL_INTERVAL", "15"))  # fallback polling
+
+# Image uploads: largest accepted decoded image, and the overall request body cap
+# (large enough for the same image sent base64-encoded inside JSON)
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(15 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(MAX_IMAGE_BYTES * 4 // 3 + 1024 * 1024)))
+
+# Image preprocessing before Vision label detection
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+IMAGE_TARGET_LONG_EDGE = int(os.getenv("IMAGE_TARGET_LONG_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_PREPROCESS_EXECUTOR = os.getenv("IMAGE_PREPROCESS_EXECUTOR", "thread")  # "thread" or "process"
+
+# Image description cache
+DESCRIPTION_CACHE = os.getenv("DESCRIPTION_CACHE", "1") == "1"
+DESCRIPTION_CACHE_DB_PATH = os.getenv("DESCRIPTION_CACHE_DB_PATH", os.path.join(DATA_DIR, "description_cache.db"))
+DESCRIPTION_CACHE_MEMORY_ENTRIES = int(os.getenv("DESCRIPTION_CACHE_MEMORY_ENTRIES", "512"))
+DESCRIPTION_CACHE_TTL = float(os.getenv("DESCRIPTION_CACHE_TTL", str(24 * 3600)))
+# Max Hamming distance between perceptual hashes for a near-duplicate hit (-1 disables)
+DESCRIPTION_CACHE_PHASH_DISTANCE = int(os.getenv("DESCRIPTION_CACHE_PHASH_DISTANCE", "3"))
+
+# Memoization of generated lyrics/title/genre for repeated scene contexts
+LYRICS_MEMO_ENTRIES = int(os.getenv("LYRICS_MEMO_ENTRIES", "256"))  # 0 disables
+LYRICS_MEMO_TTL = float(os.getenv("LYRICS_MEMO_TTL", "900"))
+LYRICS_MEMO_VARIANTS = int(os.getenv("LYRICS_MEMO_VARIANTS", "1"))  # variants kept and rotated per context
+
+# Image description mode: "two_stage" (Vision labels, then Gemini on the labels)
+# or "fast" (one multimodal Gemini call on the image itself)
+DESCRIPTION_MODE = os.getenv("DESCRIPTION_MODE", "two_stage")
+
+# Single-flight deduplication of identical in-flight requests
+SINGLEFLIGHT_DB_PATH = os.getenv("SINGLEFLIGHT_DB_PATH", os.path.join(DATA_DIR, "singleflight.db"))
+SINGLEFLIGHT_SHARED = os.getenv("SINGLEFLIGHT_SHARED", "1") == "1"  # coalesce across worker processes
+SINGLEFLIGHT_RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", "30"))  # late duplicates still get the result
+SINGLEFLIGHT_STALE_SECONDS = float(os.getenv("SINGLEFLIGHT_STALE_SECONDS", "900"))  # take over from a dead leader
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.25"))
+
+# Logging: records are handed to a background writer thread through a queue
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records beyond this are dropped, not waited on
+LOG_MAX_ARG_CHARS = int(os.getenv("LOG_MAX_ARG_CHARS", "512"))  # longer log arguments are truncated
+LOG_REDACT_KEYS = tuple(
+    key.strip().lower()
+    for key in os.getenv("LOG_REDACT_KEYS", "image_base64,authorization,api_key,audio_url,image_url").split(",")
+    if key.strip()
+)
+LOG_SAMPLE_PER_SECOND = int(os.getenv("LOG_SAMPLE_PER_SECOND", "20"))  # per INFO/DEBUG message template; 0 disables
+LOG_ACCESS = os.getenv("LOG_ACCESS", "1") == "1"  # one structured record per request
+
+# On-disk cache of finished clips' MP3s, served by /audio/<clip_id>
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", os.path.join(DATA_DIR, "audio"))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # LRU-evicted beyond this
+AUDIO_MAX_FILE_BYTES = int(os.getenv("AUDIO_MAX_FILE_BYTES", str(64 * 1024 ** 2)))  # refuse larger downloads
+
+# Response compression (brotli when installed and accepted, else gzip)
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "1") == "1"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))  # smaller bodies are sent as-is
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+# Bearer token for the /admin endpoints; they are off (404) when it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Web server processes and request threads per process (gunicorn.conf.py)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "2"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "16"))
+
+# Admission control for /generate_music and /snap_to_song (see admission.py).
+# Limits are totals for the server, split across the WEB_WORKERS processes. A
+# worker's share of running plus queued generations must fit in WEB_THREADS.
+ADMISSION = os.getenv("ADMISSION", "1") == "1"
+# By default half of the request threads may run generations and a quarter
+# may wait for one, leaving the rest for polls, playlists and audio
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", str(WEB_WORKERS * WEB_THREADS // 2)))
+ADMISSION_HOST_LIMITS = {  # per upstream host, e.g. "openai=16,suno=8,google=16"
+    host.strip(): int(limit)
+    for host, _, limit in (
+        pair.partition("=") for pair in os.getenv("ADMISSION_HOST_LIMITS", "openai=16,suno=8,google=16").split(",")
+    )
+    if host.strip() and limit
+}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", str(WEB_WORKERS * WEB_THREADS // 4)))
+ADMISSION_CLIENT_QUEUE = int(os.getenv("ADMISSION_CLIENT_QUEUE", "4"))  # of which one client may hold
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))  # then 503
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "10"))  # generations per minute per client
+ADMISSION_CLIENT_BURST = int(os.getenv("ADMISSION_CLIENT_BURST", "5"))
+
+# Speculative warm pool of finished tracks for common scene profiles (see
+# warm_pool.py). The refiller runs with the job workers (python jobs.py).
+WARM_POOL = os.getenv("WARM_POOL", "0") == "1"
+WARM_POOL_DB_PATH = os.getenv("WARM_POOL_DB_PATH", os.path.join(DATA_DIR, "warm_pool.db"))
+WARM_POOL_MAX_PER_PROFILE = int(os.getenv("WARM_POOL_MAX_PER_PROFILE", "3"))  # ready + generating tracks
+WARM_POOL_MAX_PROFILES = int(os.getenv("WARM_POOL_MAX_PROFILES", "20"))  # busiest profiles pooled
+WARM_POOL_MIN_RATE = float(os.getenv("WARM_POOL_MIN_RATE", "2"))  # requests per hour before a profile is pooled
+WARM_POOL_COVER_SECONDS = float(os.getenv("WARM_POOL_COVER_SECONDS", "1800"))  # of a profile's demand to keep ready
+WARM_POOL_DECAY_SECONDS = float(os.getenv("WARM_POOL_DECAY_SECONDS", "21600"))  # request rate averaging window
+WARM_POOL_MAX_MISMATCH = int(os.getenv("WARM_POOL_MAX_MISMATCH", "1"))  # of weather and time of day (0-2)
+WARM_POOL_MAX_AGE = float(os.getenv("WARM_POOL_MAX_AGE", "86400"))  # pooled tracks are dropped after this
+WARM_POOL_CONCURRENCY = int(os.getenv("WARM_POOL_CONCURRENCY", "2"))  # tracks generated at once
+WARM_POOL_MAX_PER_HOUR = int(os.getenv("WARM_POOL_MAX_PER_HOUR", "30"))  # speculative generations
+WARM_POOL_IDLE_MAX_JOBS = int(os.getenv("WARM_POOL_IDLE_MAX_JOBS", "0"))  # queued/running jobs that still count as idle
+WARM_POOL_IDLE_MAX_REQUESTS = float(os.getenv("WARM_POOL_IDLE_MAX_REQUESTS", "5"))  # /generate_music per minute
+WARM_POOL_IDLE_QUIET_SECONDS = float(os.getenv("WARM_POOL_IDLE_QUIET_SECONDS", "300"))  # since the last overload or upstream failure
+WARM_POOL_CHECK_INTERVAL = float(os.getenv("WARM_POOL_CHECK_INTERVAL", "30"))
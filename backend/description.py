@@ -0,0 +1,225 @@
+import base64
+import logging
+
+import config
+import description_cache
+import upstream
+import metrics
+from preprocess import preprocess_image
+from clients import get_vision_client, get_generative_model
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTION_MODEL = "gemini-1.0-pro-vision-001"
+
+# Description modes
+MODE_TWO_STAGE = "two_stage"
+MODE_FAST = "fast"
+MODES = (MODE_TWO_STAGE, MODE_FAST)
+
+FAST_PROMPT = "Describe what is happening in the image and feelings evoked."
+
+
+def decode_image_base64(image_base64):
+    """
+    Decodes a base64-encoded image, raising ValueError on invalid data.
+    """
+    try:
+        image_bytes = base64.b64decode(image_base64)
+        logger.debug("Image decoded successfully.")
+    except base64.binascii.Error as e:
+        logger.error("Invalid base64 image data: %s", e)
+        raise ValueError("Invalid base64 image data.") from e
+    return image_bytes
+
+
+def generate_description_from_image_base64(image_base64):
+    """
+    Processes a base64-encoded image to generate a description using Google Cloud Vision API
+    and Vertex AI's generative model.
+    """
+    return generate_description_from_image_bytes(decode_image_base64(image_base64))
+
+
+def generate_description_from_image_bytes(image_bytes, mode=None):
+    """
+    Generates a description of raw image bytes and returns its text.
+    """
+    return describe_image_bytes(image_bytes, mode)["description"]
+
+
+def resolve_mode(mode=None):
+    """
+    Returns the description mode to use, defaulting to DESCRIPTION_MODE.
+    Raises ValueError for an unknown mode.
+    """
+    mode = mode or config.DESCRIPTION_MODE
+    if mode not in MODES:
+        raise ValueError(f"Unknown description mode: {mode}")
+    return mode
+
+
+def describe_image_bytes(image_bytes, mode=None):
+    """
+    Describes raw image bytes. In "two_stage" mode the preprocessed image goes
+    through Vision label detection and the labels are described by Gemini; in
+    "fast" mode the preprocessed image is sent straight to Gemini in one call.
+    Returns {"description", "labels", "mode", "cached"}.
+    """
+    mode = resolve_mode(mode)
+    logger.info("Starting image description generation (%s mode).", mode)
+
+    # Repeat and near-duplicate snaps are answered from the cache
+    cached, cache_key = description_cache.lookup(image_bytes, mode)
+    if cached is not None:
+        logger.info("Image description served from cache.")
+        return {"description": cached["description"], "labels": cached["labels"],
+                "mode": mode, "cached": True}
+
+    # Downscale and normalize the image before sending it upstream
+    image_bytes = preprocess_image(image_bytes)
+
+    if mode == MODE_FAST:
+        descriptions = []
+        text = describe_image_fast(image_bytes)
+    else:
+        # Get image descriptions using Google Cloud Vision API
+        descriptions = get_image_description(image_bytes)
+        logger.info("Image descriptions from Vision API: %s", descriptions)
+        text = describe_labels(descriptions)
+
+    description_cache.store(cache_key, descriptions, text)
+    return {"description": text, "labels": descriptions, "mode": mode, "cached": False}
+
+
+def _image_mime_type(image_bytes):
+    if image_bytes.startswith(b"\x89PNG"):
+        return "image/png"
+    if image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+@metrics.timed("gemini_describe")
+def describe_image_fast(image_bytes):
+    """
+    Describes an image with a single stateless multimodal Gemini call, skipping
+    Vision label detection.
+    """
+    from vertexai.generative_models import Part
+
+    model = get_generative_model(DESCRIPTION_MODEL)
+    image_part = Part.from_data(data=image_bytes, mime_type=_image_mime_type(image_bytes))
+
+    logger.info("Sending image to Vertex AI generative model.")
+
+    model_response = upstream.call_sync(
+        "gemini.describe", lambda timeout: model.generate_content([image_part, FAST_PROMPT])
+    )
+    logger.debug("Vertex AI response: %s", model_response.text if model_response else "No response")
+
+    return model_response.text if model_response else "No response generated."
+
+
+@metrics.timed("gemini_describe")
+def describe_labels(descriptions):
+    """
+    Asks Vertex AI's generative model to describe a scene from its Vision labels.
+    """
+    # Generate a combined description using the shared Vertex AI generative model
+    try:
+        model = get_generative_model(DESCRIPTION_MODEL)
+    except Exception as e:
+        logger.error("Failed to initialize Vertex AI generative model: %s", e)
+        raise
+
+    prompt = (
+        f"The following are key details observed in the image: {', '.join(descriptions)}. "
+        "Describe what is happening in the image and feelings evoked."
+    )
+
+    logger.info("Sending prompt to Vertex AI generative model.")
+
+    # Each attempt gets its own chat so retries and hedges do not share history
+    model_response = upstream.call_sync(
+        "gemini.describe", lambda timeout: model.start_chat().send_message(prompt)
+    )
+    logger.debug("Vertex AI response: %s", model_response.text if model_response else "No response")
+
+    return model_response.text if model_response else "No response generated."
+
+
+@metrics.timed("get_image_description")
+def get_image_description(image_bytes):
+    """
+    Uses Google Cloud Vision API to perform label detection on the image and return descriptions.
+    """
+    logger.info("Performing label detection using Google Cloud Vision API.")
+
+    # Get the shared Google Cloud Vision client
+    try:
+        client = get_vision_client()
+    except Exception as e:
+        logger.error("Failed to initialize Google Cloud Vision client: %s", e)
+        raise
+
+    # Prepare the image for the Vision API
+    from google.cloud import vision
+    image = vision.Image(content=image_bytes)
+
+    # Perform label detection on the image
+    response = upstream.call_sync(
+        "vision.labels", lambda timeout: client.label_detection(image=image, timeout=timeout)
+    )
+    logger.info("Label detection completed.")
+
+    # Handle errors in response
+    if response.error.message:
+        logger.error("Google Cloud Vision API Error: %s", response.error.message)
+        raise Exception(f'Google Cloud Vision API Error: {response.error.message}')
+
+    # Extract labels (descriptions) from the response
+    descriptions = [label.description for label in response.label_annotations]
+
+    # Handle the case where no labels are returned
+    if not descriptions:
+        logger.warning("No labels detected in the image.")
+        return ["No discernible objects found."]
+
+    return descriptions
+
+
+# Vision's synchronous batch endpoint accepts at most this many images per call
+VISION_BATCH_MAX_IMAGES = 16
+
+
+@metrics.timed("get_image_labels_batch")
+def get_image_labels_batch(images):
+    """
+    Runs label detection on up to VISION_BATCH_MAX_IMAGES images in a single
+    Vision batch_annotate_images call. Returns one entry per image, in order:
+    a list of {"description", "score"} labels, or the Exception for an image
+    Vision could not annotate.
+    """
+    if len(images) > VISION_BATCH_MAX_IMAGES:
+        raise ValueError(f"At most {VISION_BATCH_MAX_IMAGES} images can be annotated per batch.")
+
+    client = get_vision_client()
+    from google.cloud import vision
+    feature = vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION)
+    requests = [vision.AnnotateImageRequest(image=vision.Image(content=image_bytes), features=[feature])
+                for image_bytes in images]
+
+    response = upstream.call_sync(
+        "vision.batch_labels", lambda timeout: client.batch_annotate_images(requests=requests, timeout=timeout)
+    )
+    logger.info("Batch label detection completed for %d images.", len(images))
+
+    results = []
+    for image_response in response.responses:
+        if image_response.error.message:
+            results.append(Exception(f'Google Cloud Vision API Error: {image_response.error.message}'))
+        else:
+            results.append([{"description": label.description, "score": round(label.score, 4)}
+                            for label in image_response.label_annotations])
+    return results
@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import config
+from preprocess import perceptual_hash
+
+logger = logging.getLogger(__name__)
+
+# Cache of image descriptions (Vision labels + Gemini description), keyed on the
+# SHA-256 of the uploaded bytes and the description mode that produced them, so
+# a "fast" description is never served for a "two_stage" request or vice versa.
+# On an exact miss the image's 64-bit perceptual hash is compared against stored
+# hashes, so a re-snap of the same scene can hit too. Lookups go through an
+# in-memory LRU first, then a SQLite tier shared by all worker processes.
+# Entries expire after DESCRIPTION_CACHE_TTL seconds.
+#
+# Near-duplicate search on disk splits each hash into four 16-bit bands stored in
+# indexed columns. Two hashes within Hamming distance 3 always share at least one
+# band exactly, so candidate rows are found by index; larger distances still work
+# but may miss some matches.
+_BANDS = 4
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mode_descriptions (
+    sha256 TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    phash INTEGER,
+    band0 INTEGER, band1 INTEGER, band2 INTEGER, band3 INTEGER,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (sha256, mode)
+);
+CREATE INDEX IF NOT EXISTS mode_descriptions_band0 ON mode_descriptions (band0);
+CREATE INDEX IF NOT EXISTS mode_descriptions_band1 ON mode_descriptions (band1);
+CREATE INDEX IF NOT EXISTS mode_descriptions_band2 ON mode_descriptions (band2);
+CREATE INDEX IF NOT EXISTS mode_descriptions_band3 ON mode_descriptions (band3);
+CREATE INDEX IF NOT EXISTS mode_descriptions_created ON mode_descriptions (created_at);
+"""
+
+# Migrations run once per database, in order, tracked by PRAGMA user_version.
+# 1: drop the descriptions table of the cache that was not keyed on the mode.
+_MIGRATIONS = (
+    "DROP TABLE IF EXISTS descriptions",
+)
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # (sha256, mode) -> (phash, value, created_at)
+_stats = {"memory_hits": 0, "disk_hits": 0, "near_hits": 0, "misses": 0, "stores": 0}
+_initialized = False
+
+
+class CacheKey:
+    """
+    Identifies an uploaded image and description mode for cache lookups and
+    stores. The perceptual hash is only computed when an exact lookup misses.
+    """
+    __slots__ = ("sha256", "mode", "phash")
+
+    def __init__(self, sha256, mode, phash=None):
+        self.sha256 = sha256
+        self.mode = mode
+        self.phash = phash
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(config.DESCRIPTION_CACHE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.DESCRIPTION_CACHE_DB_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _initialized:
+        conn.executescript(_SCHEMA)
+        _migrate(conn)
+        _initialized = True
+    return conn
+
+
+def _migrate(conn):
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(_MIGRATIONS):
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Re-read under the write lock; another process may have just migrated
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for statement in _MIGRATIONS[version:]:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {max(version, len(_MIGRATIONS))}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _bands(phash):
+    return [(phash >> (16 * i)) & 0xFFFF for i in range(_BANDS)]
+
+
+def _to_signed(phash):
+    # SQLite integers are signed 64-bit
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+
+def _from_signed(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def _remember(sha256, mode, phash, value, created_at):
+    with _lock:
+        _memory[sha256, mode] = (phash, value, created_at)
+        _memory.move_to_end((sha256, mode))
+        while len(_memory) > config.DESCRIPTION_CACHE_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _lookup_exact(sha256, mode, now):
+    with _lock:
+        entry = _memory.get((sha256, mode))
+        if entry is not None:
+            if now - entry[2] <= config.DESCRIPTION_CACHE_TTL:
+                _memory.move_to_end((sha256, mode))
+                _stats["memory_hits"] += 1
+                return entry[1]
+            del _memory[sha256, mode]
+
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT phash, value, created_at FROM mode_descriptions "
+            "WHERE sha256 = ? AND mode = ? AND created_at >= ?",
+            (sha256, mode, now - config.DESCRIPTION_CACHE_TTL),
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+
+    value = json.loads(row[1])
+    phash = _from_signed(row[0]) if row[0] is not None else None
+    _remember(sha256, mode, phash, value, row[2])
+    _count("disk_hits")
+    return value
+
+
+def _lookup_near(phash, mode, now):
+    distance = config.DESCRIPTION_CACHE_PHASH_DISTANCE
+
+    # Scan the memory tier first; it is small and already decoded
+    with _lock:
+        for key, (candidate, value, created_at) in reversed(_memory.items()):
+            if key[1] != mode or candidate is None or now - created_at > config.DESCRIPTION_CACHE_TTL:
+                continue
+            if bin(candidate ^ phash).count("1") <= distance:
+                _memory.move_to_end(key)
+                _stats["near_hits"] += 1
+                return value
+
+    bands = _bands(phash)
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT sha256, phash, value, created_at FROM mode_descriptions "
+            "WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND mode = ? AND created_at >= ?",
+            (*bands, mode, now - config.DESCRIPTION_CACHE_TTL),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    for sha256, candidate, value, created_at in rows:
+        candidate = _from_signed(candidate)
+        if bin(candidate ^ phash).count("1") <= distance:
+            value = json.loads(value)
+            _remember(sha256, mode, candidate, value, created_at)
+            _count("near_hits")
+            return value
+    return None
+
+
+def lookup(image_bytes, mode):
+    """
+    Looks up the description of an uploaded image made in the given mode.
+    Returns (value, key): value is the cached {"labels", "description"} dict or
+    None on a miss, and key should be passed to store() after a miss.
+    """
+    key = CacheKey(hashlib.sha256(image_bytes).hexdigest(), mode)
+    if not config.DESCRIPTION_CACHE:
+        return None, key
+
+    now = time.time()
+    try:
+        value = _lookup_exact(key.sha256, mode, now)
+        if value is not None:
+            return value, key
+
+        if config.DESCRIPTION_CACHE_PHASH_DISTANCE >= 0:
+            key.phash = perceptual_hash(image_bytes)
+            if key.phash is not None:
+                value = _lookup_near(key.phash, mode, now)
+                if value is not None:
+                    return value, key
+    except sqlite3.Error as e:
+        logger.warning("Description cache lookup failed: %s", e)
+
+    _count("misses")
+    return None, key
+
+
+def store(key, labels, description):
+    """
+    Stores the labels and description generated for an image in key's mode.
+    """
+    if not config.DESCRIPTION_CACHE:
+        return
+
+    value = {"labels": labels, "description": description}
+    now = time.time()
+    _remember(key.sha256, key.mode, key.phash, value, now)
+
+    bands = _bands(key.phash) if key.phash is not None else [None] * _BANDS
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO mode_descriptions "
+            "(sha256, mode, phash, band0, band1, band2, band3, value, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (key.sha256, key.mode, _to_signed(key.phash) if key.phash is not None else None,
+             *bands, json.dumps(value), now),
+        )
+        # Evict expired rows opportunistically
+        conn.execute("DELETE FROM mode_descriptions WHERE created_at < ?", (now - config.DESCRIPTION_CACHE_TTL,))
+    except sqlite3.Error as e:
+        logger.warning("Description cache store failed: %s", e)
+    finally:
+        conn.close()
+    _count("stores")
+
+
+def stats():
+    """
+    Returns hit/miss counters for this worker process.
+    """
+    with _lock:
+        return dict(_stats, memory_entries=len(_memory))
@@ -0,0 +1,48 @@
+import os
+
+# Imported by name: every module-level name here is read as a gunicorn setting,
+# and "config" is one of them
+from config import WEB_WORKERS, WEB_THREADS
+
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+#
+# Each worker is a separate process with its own background asyncio loop,
+# upstream clients and caches. Threaded (gthread) workers are the default: the
+# blocking request handlers hand their upstream calls to that loop, so a thread
+# per in-flight request is cheap. gevent workers are not recommended, because
+# monkey-patching does not play well with the loop thread in runtime.py.
+
+bind = os.getenv("BIND", "0.0.0.0:5001")
+workers = WEB_WORKERS
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+threads = WEB_THREADS
+
+# Streaming endpoints (/snap_to_song, /clips/<id>?wait=) hold a request open for
+# minutes, sending keep-alives, so the worker timeout only catches a wedged worker
+timeout = int(os.getenv("WEB_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+
+# With preload_app the app (and, via clients.preload, the Google SDK modules) is
+# imported once in the master and shared copy-on-write by every worker. No
+# clients or loops exist yet at that point; each worker builds its own after
+# the fork.
+preload_app = os.getenv("PRELOAD_APP", "0") == "1"
+
+# Requests are logged by the app itself (structured, off the request thread; see
+# logs.py), so gunicorn's own access log is off unless ACCESS_LOG is set
+accesslog = os.getenv("ACCESS_LOG") or None
+errorlog = "-"
+
+
+def on_starting(server):
+    if preload_app:
+        import clients
+        clients.preload()
+
+
+def post_worker_init(worker):
+    # Build this worker's upstream clients in the background; /ready flips to
+    # 200 once they are warm
+    import app
+    app.start_warm_up()
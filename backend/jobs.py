@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import sqlite3
+import asyncio
+import logging
+import multiprocessing
+
+import config
+import music
+import logs
+import song_library
+
+logger = logging.getLogger(__name__)
+
+# Job lifecycle: queued -> running -> succeeded | failed.
+# While running, "stage" records how far through the chain the job has got:
+# lyrics -> submitting -> fetching_clips -> done. Partial results are written
+# after every stage, so a job reclaimed after a crash resumes from the last
+# completed stage instead of paying for OpenAI or Suno again.
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    params TEXT NOT NULL,
+    result TEXT NOT NULL DEFAULT '{}',
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+def _connect():
+    """
+    Opens a connection to the job store. Connections are cheap and are not shared
+    between threads or processes; WAL mode lets readers run alongside a writer.
+    """
+    os.makedirs(os.path.dirname(config.JOBS_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db():
+    conn = _connect()
+    try:
+        conn.executescript(_SCHEMA)
+    finally:
+        conn.close()
+
+
+def _row_to_job(row):
+    return {
+        "id": row["id"],
+        "status": row["status"],
+        "stage": row["stage"],
+        "params": json.loads(row["params"]),
+        "result": json.loads(row["result"]),
+        "error": row["error"],
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def enqueue_job(params, result=None):
+    """
+    Stores a new generation job and returns its id. A partial result (e.g.
+    lyrics already generated) skips the stages it covers.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, status, stage, params, result, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, STATUS_QUEUED, "lyrics" if result else "queued", json.dumps(params),
+             json.dumps(result or {}), now, now),
+        )
+    finally:
+        conn.close()
+    logger.info("Enqueued job %s.", job_id)
+    return job_id
+
+
+def get_job(job_id):
+    """
+    Returns the job as a dict, or None if it does not exist.
+    """
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+
+def count_active():
+    """
+    Returns the number of jobs queued or running.
+    """
+    conn = _connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                            (STATUS_QUEUED, STATUS_RUNNING)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def claim_job(worker_id):
+    """
+    Atomically takes the oldest queued job, or a running job whose worker's lease
+    has expired, and marks it running for this worker. Returns None when idle.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = ? "
+            "OR (status = ? AND lease_expires < ?) "
+            "ORDER BY created_at LIMIT 1",
+            (STATUS_QUEUED, STATUS_RUNNING, now),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, "
+            "lease_expires = ?, updated_at = ? WHERE id = ?",
+            (STATUS_RUNNING, worker_id, now + config.JOB_LEASE_SECONDS, now, row["id"]),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    job = _row_to_job(row)
+    job["attempts"] += 1
+    return job
+
+
+def update_stage(job_id, stage, result):
+    """
+    Records stage progress and partial results, and renews the job's lease.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET stage = ?, result = ?, lease_expires = ?, updated_at = ? WHERE id = ?",
+            (stage, json.dumps(result), now + config.JOB_LEASE_SECONDS, now, job_id),
+        )
+    finally:
+        conn.close()
+
+
+def finish_job(job_id, result):
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, stage = ?, result = ?, error = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE id = ?",
+            (STATUS_SUCCEEDED, "done", json.dumps(result), now, job_id),
+        )
+    finally:
+        conn.close()
+
+
+def fail_job(job_id, error, attempts):
+    """
+    Puts the job back in the queue, or marks it failed once it has used up
+    JOB_MAX_ATTEMPTS.
+    """
+    status = STATUS_FAILED if attempts >= config.JOB_MAX_ATTEMPTS else STATUS_QUEUED
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, updated_at = ? WHERE id = ?",
+            (status, error, now, job_id),
+        )
+    finally:
+        conn.close()
+    return status
+
+
+async def run_job(job):
+    """
+    Runs the generate_music_prompt -> get_generated_song_ids -> get_song_data_from_id
+    chain for a claimed job, skipping any stage already recorded in its result.
+    """
+    job_id = job["id"]
+    params = job["params"]
+    result = dict(job["result"])
+
+    if "lyrics" not in result:
+        lyrics, title, genre_tags = await music.generate_music_prompt_async(
+            params["setting_description"], params["location"],
+            params["weather"], params["time_of_day"],
+        )
+        if not all([lyrics, title, genre_tags]):
+            raise ValueError("Failed to generate lyrics, title, or genre tags.")
+        result.update({"lyrics": lyrics, "title": title, "genre_tags": genre_tags})
+        await asyncio.to_thread(update_stage, job_id, "lyrics", result)
+
+    if "clip_ids" not in result:
+        await asyncio.to_thread(update_stage, job_id, "submitting", result)
+        song_id_1, song_id_2 = await music.get_generated_song_ids_async(
+            result["lyrics"], result["title"], result["genre_tags"]
+        )
+        result["clip_ids"] = [song_id_1, song_id_2]
+        await asyncio.to_thread(update_stage, job_id, "fetching_clips", result)
+
+    result["songs"] = await music.get_songs_data_async(result["clip_ids"])
+    await asyncio.to_thread(song_library.save_result, result)
+    return result
+
+
+async def _worker_slot(worker_id, stop):
+    while not stop.is_set():
+        job = await asyncio.to_thread(claim_job, worker_id)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), config.JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.info("Worker %s running job %s (attempt %d).", worker_id, job["id"], job["attempts"])
+        try:
+            result = await run_job(job)
+        except Exception as e:
+            status = await asyncio.to_thread(fail_job, job["id"], str(e), job["attempts"])
+            logger.exception("Job %s failed (now %s): %s", job["id"], status, e)
+        else:
+            await asyncio.to_thread(finish_job, job["id"], result)
+            logger.info("Job %s succeeded.", job["id"])
+
+
+async def _worker_main(worker_id):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await asyncio.gather(*(_worker_slot(worker_id, stop) for _ in range(config.JOB_CONCURRENCY)))
+
+
+def worker_process(index):
+    """
+    Entry point of one worker process. Each process runs JOB_CONCURRENCY job
+    slots on its own event loop.
+    """
+    logs.configure()
+    worker_id = f"{os.uname().nodename}:{os.getpid()}:{index}"
+    logger.info("Job worker %s started.", worker_id)
+    asyncio.run(_worker_main(worker_id))
+    logger.info("Job worker %s stopped.", worker_id)
+
+
+def start_workers(count=None):
+    """
+    Starts the job worker pool, plus the warm pool refiller when WARM_POOL is
+    on, and returns the list of processes.
+    """
+    init_db()
+    count = config.JOB_WORKERS if count is None else count
+    processes = []
+    for index in range(count):
+        process = multiprocessing.Process(target=worker_process, args=(index,),
+                                          name=f"snaptracks-job-worker-{index}")
+        process.start()
+        processes.append(process)
+
+    if config.WARM_POOL:
+        # Imported here: warm_pool uses this module to check the queue is idle
+        import warm_pool
+        processes.append(warm_pool.start_refiller())
+    return processes
+
+
+if __name__ == "__main__":
+    # Run the worker pool on its own, independently of the web tier:
+    #   python jobs.py [worker_count]
+    logs.configure()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else config.JOB_WORKERS
+    workers = start_workers(count)
+    logger.info("Started %d job worker process(es).", len(workers))
+
+    def _stop(signum, frame):
+        for process in workers:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for process in workers:
+        process.join()
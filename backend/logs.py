@@ -0,0 +1,242 @@
+import os
+import json
+import atexit
+import time
+import queue
+import reprlib
+import logging
+import threading
+import logging.handlers
+
+import config
+import metrics
+
+# Logging pipeline for the backend. Request threads only trim a record's
+# arguments and put it on a queue; a background listener thread formats it and
+# writes it out, so a slow stderr or a burst of log lines never stalls a
+# request. Large arguments (base64 images, upstream payloads) are truncated and
+# secret-looking fields redacted before the message is built, and repetitive
+# INFO/DEBUG lines are sampled per message template.
+
+LOG_RECORDS_DROPPED = metrics._register(metrics.Counter(
+    "snaptracks_log_records_dropped_total", "Log records dropped because the log queue was full."))
+LOG_RECORDS_SAMPLED = metrics._register(metrics.Counter(
+    "snaptracks_log_records_sampled_total", "Log records suppressed by per-template sampling."))
+
+_lock = threading.Lock()
+_queue = None
+_listener = None
+_handler = None
+
+# Attributes every LogRecord has; anything else was passed via extra= and is
+# included in JSON output
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class _Repr(reprlib.Repr):
+    """
+    Bounded repr for log arguments: limits container sizes and string lengths
+    and replaces the values of sensitive keys.
+    """
+
+    def __init__(self, max_chars):
+        super().__init__()
+        self.maxstring = max_chars
+        self.maxother = max_chars
+        self.maxlist = self.maxtuple = self.maxset = self.maxdict = 20
+        self.maxlevel = 4
+
+    def repr_dict(self, value, level):
+        if level <= 0:
+            return "{...}"
+        items = []
+        for i, (key, item) in enumerate(value.items()):
+            if i >= self.maxdict:
+                items.append("...")
+                break
+            if isinstance(key, str) and key.lower() in config.LOG_REDACT_KEYS:
+                shown = f"<redacted {len(item) if isinstance(item, (str, bytes)) else 1} chars>"
+            else:
+                shown = self.repr1(item, level - 1)
+            items.append(f"{self.repr1(key, level - 1)}: {shown}")
+        return "{" + ", ".join(items) + "}"
+
+    def repr_bytes(self, value, level):
+        return f"<{len(value)} bytes>"
+
+
+_repr = _Repr(config.LOG_MAX_ARG_CHARS)
+
+
+def _trim(value):
+    if isinstance(value, str):
+        if len(value) <= config.LOG_MAX_ARG_CHARS:
+            return value
+        return f"{value[:config.LOG_MAX_ARG_CHARS]}... <{len(value)} chars>"
+    if isinstance(value, (int, float, bool, type(None))):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, (dict, list, tuple, set)):
+        return _repr.repr(value)
+    return _trim(str(value))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that bounds the size of every record before queueing it and
+    drops (and counts) records instead of blocking when the queue is full.
+    Unlike the stock handler it does not format the record here: the trimmed
+    arguments are plain strings and numbers, so the listener can build the
+    message and any traceback text later.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            if isinstance(record.args, dict):
+                # logger.info("%s", some_dict) stores the dict itself as args
+                if "%(" in str(record.msg):
+                    record.args = {key: _trim(value) for key, value in record.args.items()}
+                else:
+                    record.args = (_trim(record.args),)
+            else:
+                record.args = tuple(_trim(arg) for arg in record.args)
+        if not isinstance(record.msg, str) or len(record.msg) > config.LOG_MAX_ARG_CHARS * 4:
+            # logger.info(some_object) is stringified now, while it still holds
+            # the value that was logged
+            record.msg = _trim(record.msg)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through at most `per_second` INFO/DEBUG records per message template
+    each second. Warnings and errors are never sampled. When a window had
+    suppressed records, the next record through notes how many.
+    """
+
+    # Loggers whose records are never sampled
+    exempt = ("snaptracks.access",)
+
+    def __init__(self, per_second):
+        super().__init__()
+        self.per_second = per_second
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.per_second <= 0 or record.levelno >= logging.WARNING or record.name in self.exempt:
+            return True
+        # logger.info(some_dict) has an unhashable msg; sample those per type
+        msg = record.msg if isinstance(record.msg, str) else type(record.msg).__name__
+        key = (record.name, msg)
+        now = int(time.monotonic())
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or window[0] != now:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if len(self.windows) > 4096:
+                    self.windows = {key: self.windows[key]}
+                if suppressed:
+                    record.sampled_out = suppressed
+                return True
+            window[1] += 1
+            if window[1] <= self.per_second:
+                return True
+            window[2] += 1
+        LOG_RECORDS_SAMPLED.inc()
+        return False
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(process)d]: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with any extra= fields as top-level keys.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        return json.dumps(entry, default=str)
+
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+def _start_listener():
+    global _queue, _listener
+    _queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    _handler.queue = _queue
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if config.LOG_FORMAT == "json" else TextFormatter())
+    _listener = logging.handlers.QueueListener(_queue, stream, respect_handler_level=False)
+    _listener.start()
+
+
+def configure():
+    """
+    Routes the root logger through the queue and starts the writer thread.
+    Safe to call more than once; later calls do nothing.
+    """
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+        _handler = _QueueHandler(None)
+        _handler.addFilter(SamplingFilter(config.LOG_SAMPLE_PER_SECOND))
+        _start_listener()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+        root.setLevel(config.LOG_LEVEL.upper())
+
+
+def _stop_listener():
+    # Write out whatever is still queued before the process exits. Objects that
+    # log from __del__ during interpreter shutdown then go to logging's
+    # last-resort stderr handler, since this module may already be torn down.
+    with _lock:
+        if _handler is not None:
+            logging.getLogger().removeHandler(_handler)
+        if _listener is not None:
+            _listener.stop()
+
+
+def _restart_in_child():
+    # The writer thread does not survive a fork; give the child its own queue
+    # and thread (records the parent had queued stay with the parent)
+    global _lock
+    _lock = threading.Lock()
+    if _handler is not None:
+        _start_listener()
+
+
+os.register_at_fork(after_in_child=_restart_in_child)
+atexit.register(_stop_listener)
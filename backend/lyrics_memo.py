@@ -0,0 +1,93 @@
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Memoizes parsed (lyrics, title, genre_tags) results per scene context, so retries
+# and a second user at the same event do not pay for another OpenAI completion.
+# Up to LYRICS_MEMO_VARIANTS results are kept per context: until a context has that
+# many, a miss is reported so the caller generates another one, and once it is full
+# the stored variants are handed out in rotation.
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> _Entry
+_stats = {"hits": 0, "misses": 0}
+
+_WHITESPACE = re.compile(r"\s+")
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+class _Entry:
+    __slots__ = ("variants", "created_at", "next_variant")
+
+    def __init__(self, now):
+        self.variants = []
+        self.created_at = now
+        self.next_variant = 0
+
+
+def _normalize(value):
+    value = _PUNCTUATION.sub(" ", str(value or "").lower())
+    return _WHITESPACE.sub(" ", value).strip()
+
+
+def make_key(setting_description, location, weather, time_of_day):
+    """
+    Builds the memo key for a scene context. Case, punctuation and whitespace
+    differences do not produce different keys.
+    """
+    return tuple(_normalize(value) for value in (setting_description, location, weather, time_of_day))
+
+
+def get(key):
+    """
+    Returns a memoized (lyrics, title, genre_tags) for the key, or None if the
+    caller should generate a new one.
+    """
+    if config.LYRICS_MEMO_ENTRIES <= 0:
+        return None
+
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and now - entry.created_at > config.LYRICS_MEMO_TTL:
+            del _entries[key]
+            entry = None
+        if entry is None or len(entry.variants) < config.LYRICS_MEMO_VARIANTS:
+            _stats["misses"] += 1
+            return None
+
+        _entries.move_to_end(key)
+        variant = entry.variants[entry.next_variant % len(entry.variants)]
+        entry.next_variant += 1
+        _stats["hits"] += 1
+        return variant
+
+
+def put(key, lyrics, title, genre_tags):
+    """
+    Stores a generated result as one of the key's variants.
+    """
+    if config.LYRICS_MEMO_ENTRIES <= 0:
+        return
+
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _Entry(now)
+            _entries[key] = entry
+        _entries.move_to_end(key)
+        if len(entry.variants) < config.LYRICS_MEMO_VARIANTS:
+            entry.variants.append((lyrics, title, list(genre_tags)))
+        while len(_entries) > config.LYRICS_MEMO_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, entries=len(_entries))
@@ -0,0 +1,207 @@
+import os
+import time
+import bisect
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+
+# In-process metrics for the hot path, rendered in the Prometheus text format on
+# /metrics. Recording is a dict lookup and a few additions under one lock, so it
+# is cheap enough to leave on everywhere. Each worker process keeps and serves its
+# own numbers (every sample carries a "pid" label so scrapes of different workers
+# do not collide).
+
+_lock = threading.Lock()
+_metrics = {}
+_pid = str(os.getpid())
+
+# Stage timings of the current request, for the optional Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class _Metric:
+    def __init__(self, name, help_text, kind, label_names):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.values = {}
+
+    def _render_labels(self, labels, extra=()):
+        pairs = list(zip(self.label_names, labels)) + list(extra) + [("pid", _pid)]
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Counter(_Metric):
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, "counter", label_names)
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        return [f"{self.name}{self._render_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    def __init__(self, name, help_text, label_names=()):
+        _Metric.__init__(self, name, help_text, "gauge", label_names)
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+
+class Histogram(_Metric):
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, "histogram", label_names)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self._render_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._render_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._render_labels(labels)} {count}")
+        return lines
+
+
+def _register(metric):
+    _metrics[metric.name] = metric
+    return metric
+
+
+STAGE_SECONDS = _register(Histogram(
+    "snaptracks_stage_seconds", "Time spent in each pipeline stage.", ("stage",)))
+STAGE_IN_FLIGHT = _register(Gauge(
+    "snaptracks_stage_in_flight", "Pipeline stage calls currently running.", ("stage",)))
+STAGE_ERRORS = _register(Counter(
+    "snaptracks_stage_errors_total", "Pipeline stage calls that raised.", ("stage",)))
+UPSTREAM_RESPONSES = _register(Counter(
+    "snaptracks_upstream_responses_total", "Upstream responses by service and status code.",
+    ("service", "status")))
+HTTP_REQUESTS = _register(Counter(
+    "snaptracks_http_requests_total", "HTTP requests by endpoint and status code.", ("endpoint", "status")))
+HTTP_IN_FLIGHT = _register(Gauge(
+    "snaptracks_http_in_flight", "HTTP requests currently being handled.", ("endpoint",)))
+HTTP_SECONDS = _register(Histogram(
+    "snaptracks_http_request_seconds", "Time to produce the response (headers for streams).", ("endpoint",)))
+HTTP_REQUEST_BYTES = _register(Histogram(
+    "snaptracks_http_request_bytes", "Request body size.", ("endpoint",), SIZE_BUCKETS))
+HTTP_RESPONSE_BYTES = _register(Histogram(
+    "snaptracks_http_response_bytes", "Response body size (non-streamed responses).", ("endpoint",), SIZE_BUCKETS))
+
+
+def count_upstream_response(service, status):
+    UPSTREAM_RESPONSES.inc(service, str(status))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a block as pipeline stage `name`: updates the stage histogram and
+    in-flight gauge, and adds the timing to the current request's Server-Timing.
+    """
+    STAGE_IN_FLIGHT.inc(name)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_IN_FLIGHT.dec(name)
+        STAGE_SECONDS.observe(elapsed, name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def timed(name):
+    """
+    Decorator form of stage() for plain and async functions.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request_timings():
+    """
+    Starts collecting stage timings for the current request; returns a token for
+    stop_request_timings().
+    """
+    return _request_timings.set([])
+
+
+def stop_request_timings(token):
+    """
+    Stops collecting and returns the request's stage timings as a list of
+    (stage, seconds).
+    """
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return timings
+
+
+def server_timing(timings):
+    """
+    Formats stage timings as a Server-Timing header value.
+    """
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings)
+
+
+def render():
+    """
+    Renders every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for metric in _metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _reset_pid():
+    global _pid, _lock
+    _pid = str(os.getpid())
+    # The parent's lock may have been held by another thread at fork time
+    _lock = threading.Lock()
+    for metric in _metrics.values():
+        metric.values.clear()
+
+
+# A forked worker starts with clean metrics under its own pid
+os.register_at_fork(after_in_child=_reset_pid)
@@ -0,0 +1,394 @@
+import json
+import asyncio
+import logging
+
+import config
+import runtime
+import lyrics_memo
+import suno_callbacks
+import upstream
+import metrics
+from upstream import UpstreamError, CircuitOpenError
+from clients import get_async_session
+
+logger = logging.getLogger(__name__)
+
+
+def build_music_prompt_request(setting_description, location, weather, time_of_day):
+    """
+    Builds the OpenAI chat completion payload used to generate lyrics.
+    """
+    # Compose the message for ChatGPT
+    messages = [
+        {
+            "role": "system",
+            "content": """You are a helpful assistant that generates music lyrics based on inputted parameters of the user's current setting and surroundings. Write the lyrics in this format with a combination of 6 verses, choruses, and bridges. Also, provide a title for the song and genre tags if possible."""
+        },
+        {
+            "role": "user",
+            "content": (
+                f"The description is: {setting_description}. The location is: {location}. "
+                f"The weather is: {weather}. The current time of day is: {time_of_day}."
+                f"Focus more on the description and be literal about what is happening with minimal creative freedom."
+            )
+        }
+    ]
+
+    # Define the payload for the API call
+    return {
+        "model": "gpt-4o-mini",  # or "gpt-3.5-turbo" depending on your access
+        "messages": messages,
+        "max_tokens": 400,
+        "temperature": 0.7
+    }
+
+
+class MusicPromptParser:
+    """
+    Incrementally splits generated text into lyrics, title and genre tags.
+    feed() takes text chunks as they arrive and returns the events completed by
+    each one: ("title", str), ("genre_tags", list) or ("lyric", line).
+    finish() flushes the last line and returns (lyrics, title, genre_tags).
+    """
+
+    def __init__(self):
+        self.lyrics = []
+        self.title = ""
+        self.genre_tags = []
+        self._buffer = ""
+        self._started = False
+
+    def feed(self, chunk):
+        if not self._started:
+            # Leading whitespace of the whole text is ignored
+            chunk = chunk.lstrip()
+            if not chunk:
+                return []
+            self._started = True
+
+        self._buffer += chunk
+        lines = self._buffer.splitlines(keepends=True)
+        # Keep an unterminated last line until more text arrives
+        if lines and not lines[-1].endswith(("\n", "\r")):
+            self._buffer = lines.pop()
+        else:
+            self._buffer = ""
+        return [self._parse_line(line.rstrip("\r\n")) for line in lines]
+
+    def _parse_line(self, line):
+        # Use basic heuristics to search for title and genre tags in the response
+        if line.lower().startswith("title:"):
+            self.title = line.split(":", 1)[1].strip()
+            return ("title", self.title)
+        if line.lower().startswith("genre:") or line.lower().startswith("tags:"):
+            self.genre_tags = [tag.strip() for tag in line.split(":", 1)[1].split(",")]
+            return ("genre_tags", self.genre_tags)
+
+        # If the line doesn't look like a title or genre, treat it as lyrics
+        self.lyrics.append(line)
+        return ("lyric", line)
+
+    def finish(self):
+        events = []
+        if self._buffer.strip():
+            events.append(self._parse_line(self._buffer.rstrip()))
+        self._buffer = ""
+
+        lyrics = "\n".join(self.lyrics).strip()
+
+        # If title or genre tags are not found, return default values
+        title = self.title or "Untitled Song"
+        genre_tags = self.genre_tags or ["Unknown"]
+
+        return events, (lyrics, title, genre_tags)
+
+
+def parse_music_prompt(music_prompt):
+    """
+    Splits the generated text into (lyrics, title, genre_tags).
+    """
+    parser = MusicPromptParser()
+    parser.feed(music_prompt.strip())
+    _, result = parser.finish()
+    return result
+
+
+async def generate_music_prompt_async(setting_description, location, weather, time_of_day):
+    """
+    Returns (lyrics, title, genre_tags) for the scene, from the lyrics memo when the
+    same context was seen recently, otherwise by calling OpenAI.
+    """
+    key = lyrics_memo.make_key(setting_description, location, weather, time_of_day)
+    memoized = lyrics_memo.get(key)
+    if memoized is not None:
+        logger.info("Music prompt served from lyrics memo.")
+        return memoized
+
+    lyrics, title, genre_tags = await request_music_prompt_async(
+        setting_description, location, weather, time_of_day
+    )
+    if all([lyrics, title, genre_tags]):
+        lyrics_memo.put(key, lyrics, title, genre_tags)
+    return lyrics, title, genre_tags
+
+
+@metrics.timed("generate_music_prompt")
+async def request_music_prompt_async(setting_description, location, weather, time_of_day):
+    """
+    Calls the OpenAI ChatGPT API to generate music lyrics based on the provided parameters.
+    """
+    data = build_music_prompt_request(setting_description, location, weather, time_of_day)
+
+    logger.info("Sending request to OpenAI API for music prompt.")
+
+    # Make the API call
+    session = get_async_session("openai")
+
+    async def attempt(timeout):
+        async with session.post(config.OPENAI_CHAT_URL, json=data, timeout=timeout) as response:
+            # Log the response status
+            logger.info("OpenAI API response status: %s", response.status)
+            metrics.count_upstream_response("openai", response.status)
+
+            if response.status != 200:
+                raise UpstreamError("OpenAI", response.status, await response.text())
+            return await response.json()
+
+    try:
+        response_data = await upstream.call_async("openai.chat", attempt)
+    except (UpstreamError, CircuitOpenError) as e:
+        # Debugging: Log the failure and return None like an empty response
+        logger.error("OpenAI API request failed: %s", e)
+        return None, None, None  # Return None in case of failure
+
+    logger.debug("OpenAI API response data: %s", response_data)
+
+    # Extract the generated text from the response
+    if "choices" in response_data and len(response_data["choices"]) > 0:
+        music_prompt = response_data["choices"][0]["message"]["content"].strip()
+        logger.debug("Generated music prompt: %s", music_prompt)
+
+        lyrics, title, genre_tags = parse_music_prompt(music_prompt)
+
+        logger.info("Parsed Lyrics Length: %d, Title: %s, Genre Tags: %s",
+                    len(lyrics), title, genre_tags)
+        return lyrics, title, genre_tags
+    else:
+        logger.error("OpenAI API response does not contain 'choices' or is empty.")
+        return None, None, None  # Return None in case of an empty response
+
+
+async def stream_music_prompt_async(setting_description, location, weather, time_of_day):
+    """
+    Streams lyrics generation from OpenAI. Yields ("title", str),
+    ("genre_tags", list) and ("lyric", line) events as soon as each line is
+    complete, then a final ("done", (lyrics, title, genre_tags)) event. Memoized
+    contexts are replayed from the lyrics memo without calling OpenAI.
+    """
+    key = lyrics_memo.make_key(setting_description, location, weather, time_of_day)
+    memoized = lyrics_memo.get(key)
+    if memoized is not None:
+        logger.info("Music prompt served from lyrics memo.")
+        lyrics, title, genre_tags = memoized
+        yield ("title", title)
+        yield ("genre_tags", genre_tags)
+        for line in lyrics.splitlines():
+            yield ("lyric", line)
+        yield ("done", memoized)
+        return
+
+    data = build_music_prompt_request(setting_description, location, weather, time_of_day)
+    data["stream"] = True
+
+    logger.info("Sending streaming request to OpenAI API for music prompt.")
+
+    parser = MusicPromptParser()
+    session = get_async_session("openai")
+    # A partially streamed completion cannot be retried transparently, so the
+    # stream only gets the breaker and connect/stall timeouts
+    async with upstream.guard("openai.chat_stream") as policy:
+        with metrics.stage("generate_music_prompt"):
+            async with session.post(config.OPENAI_CHAT_URL, json=data, timeout=policy.client_timeout()) as response:
+                logger.info("OpenAI API response status: %s", response.status)
+                metrics.count_upstream_response("openai", response.status)
+
+                if response.status != 200:
+                    body = await response.text()
+                    logger.error("Error: Received status code %s from OpenAI API", response.status)
+                    logger.error("Response: %s", body)
+                    raise UpstreamError("OpenAI", response.status, body)
+
+                # The body is a server-sent event stream of "data: {chunk}" lines
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    choices = chunk.get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        for event in parser.feed(delta):
+                            yield event
+
+    events, result = parser.finish()
+    for event in events:
+        yield event
+
+    lyrics, title, genre_tags = result
+    if not lyrics:
+        raise ValueError("Failed to generate lyrics, title, or genre tags.")
+
+    logger.info("Parsed Lyrics Length: %d, Title: %s, Genre Tags: %s",
+                len(lyrics), title, genre_tags)
+    lyrics_memo.put(key, lyrics, title, genre_tags)
+    yield ("done", result)
+
+
+@metrics.timed("get_generated_song_ids")
+async def get_generated_song_ids_async(lyrics, title, genre_tags):
+    """
+    Calls the Suno API to generate song clips based on the lyrics, title, and genre tags.
+    Returns two generated song clip IDs.
+    """
+    tags_string = ", ".join(genre_tags)
+
+    payload = {
+        "prompt": lyrics,
+        "tags": tags_string,  # API expects a string, not an array
+        "title": title
+    }
+    # Ask Suno to report progress to /callbacks/suno instead of waiting to be polled
+    callback_url = suno_callbacks.callback_url()
+    if callback_url:
+        payload["callback_url"] = callback_url
+
+    logger.info("Sending request to Suno API to generate song clips.")
+
+    session = get_async_session("suno")
+
+    async def attempt(timeout):
+        async with session.post(config.SUNO_CLIP_URL, json=payload, timeout=timeout) as response:
+            metrics.count_upstream_response("suno", response.status)
+            # Check for response status code and log error if any
+            if response.status != 200:
+                body = await response.text()
+                logger.error("Error response from Suno API: %s", body)
+                raise UpstreamError("Suno", response.status, body)
+
+            return await response.json()
+
+    data = await upstream.call_async("suno.submit", attempt)
+
+    logger.debug("Suno API response data: %s", data)
+
+    clip_ids = data.get("clip_ids", [])
+
+    if len(clip_ids) < 2:
+        logger.error("Insufficient clip IDs returned from Suno API.")
+        raise Exception("Insufficient clip IDs returned from Suno API.")
+
+    return clip_ids[0], clip_ids[1]
+
+
+@metrics.timed("get_song_data_from_id")
+async def get_song_data_from_id_async(song_id):
+    """
+    Retrieves song data from Suno API using the provided song ID.
+    """
+    params = {
+        "clip_id": song_id,
+        "status": "streaming",
+    }
+
+    logger.info("Fetching song data for clip ID: %s", song_id)
+
+    session = get_async_session("suno")
+
+    async def attempt(timeout):
+        async with session.get(config.SUNO_CLIP_URL, params=params, timeout=timeout) as response:
+            metrics.count_upstream_response("suno", response.status)
+            if response.status != 200:
+                body = await response.text()
+                logger.error("Error fetching song data for ID %s: %s", song_id, body)
+                raise UpstreamError("Suno", response.status, body)
+
+            return await response.json()
+
+    # Fetching is idempotent, so it is retried and hedged
+    data = await upstream.call_async("suno.fetch", attempt)
+
+    logger.debug("Song data for clip ID %s: %s", song_id, data)
+    return data
+
+
+async def get_songs_data_async(clip_ids):
+    """
+    Fetches song data for every clip ID concurrently.
+    Returns a list of {"id": ..., "data": ...} entries in clip ID order.
+    """
+    song_datas = await asyncio.gather(*(get_song_data_from_id_async(clip_id) for clip_id in clip_ids))
+    return [{"id": clip_id, "data": data} for clip_id, data in zip(clip_ids, song_datas)]
+
+
+async def generate_music_async(setting_description, location, weather, time_of_day):
+    """
+    Runs the full OpenAI -> Suno chain and returns the /generate_music response body.
+    Raises ValueError if no lyrics could be generated.
+    """
+    # Generate music prompt
+    lyrics, title, genre_tags = await generate_music_prompt_async(
+        setting_description, location, weather, time_of_day
+    )
+    logger.info("Generated music prompt: Lyrics Length=%d, Title=%s, Genre Tags=%s",
+                len(lyrics) if lyrics else 0, title, genre_tags)
+
+    if not all([lyrics, title, genre_tags]):
+        raise ValueError("Failed to generate lyrics, title, or genre tags.")
+
+    return await create_songs_async(lyrics, title, genre_tags)
+
+
+async def create_songs_async(lyrics, title, genre_tags):
+    """
+    Submits finished lyrics to Suno and returns the /generate_music response body.
+    """
+    # Get generated song IDs
+    song_id_1, song_id_2 = await get_generated_song_ids_async(lyrics, title, genre_tags)
+    logger.info("Generated Song IDs: %s, %s", song_id_1, song_id_2)
+
+    # Fetch song data for both generated song IDs concurrently
+    songs = await get_songs_data_async([song_id_1, song_id_2])
+
+    return {
+        "lyrics": lyrics,
+        "title": title,
+        "genre_tags": genre_tags,
+        "songs": songs
+    }
+
+
+# Blocking wrappers for callers that are not running on the event loop
+# (Flask request threads, job workers, scripts). They run the coroutine on the
+# worker's background loop so every caller shares the same connection pools.
+
+def generate_music_prompt(setting_description, location, weather, time_of_day):
+    return runtime.run(generate_music_prompt_async(setting_description, location, weather, time_of_day))
+
+
+def get_generated_song_ids(lyrics, title, genre_tags):
+    return runtime.run(get_generated_song_ids_async(lyrics, title, genre_tags))
+
+
+def get_song_data_from_id(song_id):
+    return runtime.run(get_song_data_from_id_async(song_id))
+
+
+def generate_music(setting_description, location, weather, time_of_day):
+    return runtime.run(generate_music_async(setting_description, location, weather, time_of_day))
+
+
+def create_songs(lyrics, title, genre_tags):
+    return runtime.run(create_songs_async(lyrics, title, genre_tags))
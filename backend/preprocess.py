@@ -0,0 +1,162 @@
+import io
+import time
+import signal
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from PIL import Image, ImageOps
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Label detection does not need a 12 MP photo. Before an image goes to Vision it is
+# rotated upright from its EXIF orientation, stripped of metadata, downscaled to
+# IMAGE_TARGET_LONG_EDGE and re-encoded as JPEG. The work runs in a small pool so
+# decoding and resizing never happen on a request thread.
+_lock = threading.Lock()
+_executor = None
+
+
+def _ignore_interrupts():
+    # Ctrl-C reaches the whole process group; leave shutting the pool down to
+    # the parent instead of having each worker die mid-task
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                if config.IMAGE_PREPROCESS_EXECUTOR == "process":
+                    _executor = concurrent.futures.ProcessPoolExecutor(
+                        config.IMAGE_PREPROCESS_WORKERS, initializer=_ignore_interrupts
+                    )
+                else:
+                    _executor = concurrent.futures.ThreadPoolExecutor(
+                        config.IMAGE_PREPROCESS_WORKERS, thread_name_prefix="snaptracks-preprocess"
+                    )
+    return _executor
+
+
+def preprocess_image_sync(image_bytes, long_edge=None, quality=None):
+    """
+    Normalizes an image for label detection and returns the new JPEG bytes.
+    The original bytes are returned if the image cannot be decoded, or if it is
+    already small enough that re-encoding would not make it smaller.
+    """
+    long_edge = long_edge or config.IMAGE_TARGET_LONG_EDGE
+    quality = quality or config.IMAGE_JPEG_QUALITY
+
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        original_size = image.size
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft("RGB", (long_edge, long_edge))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((long_edge, long_edge), Image.LANCZOS)
+
+        # Saving without exif/icc arguments drops all metadata
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending original image: %s", e)
+        return image_bytes
+
+    processed = output.getvalue()
+    if len(processed) >= len(image_bytes) and max(original_size) <= long_edge:
+        return image_bytes
+    return processed
+
+
+def _log_reduction(before, after, started):
+    logger.info("Preprocessed image: %d -> %d bytes (%.0f%% smaller) in %.0f ms.",
+                before, len(after), 100 * (1 - len(after) / before) if before else 0,
+                (time.perf_counter() - started) * 1000)
+
+
+@metrics.timed("preprocess_image")
+def preprocess_image(image_bytes):
+    """
+    Runs preprocess_image_sync in the preprocessing pool and waits for the result.
+    Returns the input unchanged when IMAGE_PREPROCESS is disabled.
+    """
+    if not config.IMAGE_PREPROCESS:
+        return image_bytes
+    started = time.perf_counter()
+    processed = _get_executor().submit(preprocess_image_sync, image_bytes).result()
+    _log_reduction(len(image_bytes), processed, started)
+    return processed
+
+
+def preprocess_images(images):
+    """
+    Preprocesses several images in parallel in the preprocessing pool and
+    returns the results in order.
+    """
+    if not config.IMAGE_PREPROCESS:
+        return list(images)
+    executor = _get_executor()
+    return [future.result() for future in [executor.submit(preprocess_image_sync, image_bytes)
+                                           for image_bytes in images]]
+
+
+@metrics.timed("preprocess_image")
+async def preprocess_image_async(image_bytes):
+    """
+    Async variant of preprocess_image for code running on the event loop.
+    """
+    if not config.IMAGE_PREPROCESS:
+        return image_bytes
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    processed = await loop.run_in_executor(_get_executor(), preprocess_image_sync, image_bytes)
+    _log_reduction(len(image_bytes), processed, started)
+    return processed
+
+
+def perceptual_hash_sync(image_bytes):
+    """
+    Computes a 64-bit difference hash (dHash) of the image, or None if it cannot
+    be decoded. Visually similar images get hashes a small Hamming distance apart.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("L", (64, 64))
+        image = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.LANCZOS)
+    except Exception as e:
+        logger.warning("Could not compute perceptual hash: %s", e)
+        return None
+
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def perceptual_hash(image_bytes):
+    """
+    Runs perceptual_hash_sync in the preprocessing pool and waits for the result.
+    """
+    return _get_executor().submit(perceptual_hash_sync, image_bytes).result()
+
+
+def shutdown():
+    """
+    Cancels queued work and stops the preprocessing pool, waiting only for the
+    images already being processed. The next call starts a new pool.
+    """
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
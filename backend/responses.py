@@ -0,0 +1,144 @@
+import gzip
+import json
+
+from flask import Response, request
+
+import config
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used instead
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # optional; JSON only
+    msgpack = None
+
+# Response shaping shared by the API endpoints: field projection for
+# /generate_music results, JSON or MessagePack encoding picked from the Accept
+# header, and gzip/brotli compression picked from Accept-Encoding.
+
+# /generate_music fields. Songs are reduced to the fields the app plays from
+# unless more (or the raw Suno payload, "songs.data") are asked for.
+MUSIC_FIELDS = ("lyrics", "title", "genre_tags", "songs")
+SONG_FIELDS = ("id", "status", "title", "audio_url", "image_url", "video_url", "duration", "created_at", "data")
+DEFAULT_SONG_FIELDS = ("id", "status", "audio_url", "image_url")
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+COMPRESSIBLE_TYPES = ("application/json",) + MSGPACK_TYPES
+
+
+def parse_music_fields(value):
+    """
+    Parses a fields= parameter such as "title,songs.id,songs.audio_url" into
+    (top-level fields, song fields). "songs" alone selects the default song
+    fields. Raises ValueError on unknown fields.
+    """
+    if not value:
+        return MUSIC_FIELDS, DEFAULT_SONG_FIELDS
+
+    top, song_fields, unknown = [], [], []
+    for field in (part.strip() for part in value.split(",")):
+        if not field:
+            continue
+        if field.startswith("songs."):
+            name = field[len("songs."):]
+            if name in SONG_FIELDS:
+                song_fields.append(name)
+            else:
+                unknown.append(field)
+            if "songs" not in top:
+                top.append("songs")
+        elif field in MUSIC_FIELDS:
+            if field not in top:
+                top.append(field)
+        else:
+            unknown.append(field)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    return tuple(top), tuple(song_fields) or DEFAULT_SONG_FIELDS
+
+
+def _project_song(song, fields):
+    data = song.get("data") or {}
+    projected = {}
+    for field in fields:
+        if field == "id":
+            projected["id"] = song["id"]
+        elif field == "data":
+            projected["data"] = data
+        elif field == "duration":
+            projected["duration"] = (data.get("metadata") or {}).get("duration")
+        else:
+            projected[field] = data.get(field)
+    return projected
+
+
+def project_music(result, fields, song_fields):
+    """
+    Returns the /generate_music result with only the selected fields.
+    """
+    projected = {field: result[field] for field in fields if field != "songs"}
+    if "songs" in fields:
+        projected["songs"] = [_project_song(song, song_fields) for song in result["songs"]]
+    return projected
+
+
+def encode(payload, status=200, headers=None):
+    """
+    Builds a response for payload in the client's preferred encoding: JSON by
+    default, MessagePack when the Accept header asks for it (and msgpack is
+    installed).
+    """
+    if msgpack is not None:
+        best = request.accept_mimetypes.best_match(("application/json",) + MSGPACK_TYPES)
+        if best in MSGPACK_TYPES:
+            body = msgpack.packb(payload, use_bin_type=True)
+            response = Response(body, status=status, mimetype="application/msgpack", headers=headers)
+            response.vary.add("Accept")
+            return response
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    response = Response(body, status=status, mimetype="application/json", headers=headers)
+    if msgpack is not None:
+        response.vary.add("Accept")
+    return response
+
+
+def _best_encoding():
+    offered = ("br", "gzip") if brotli is not None else ("gzip",)
+    return request.accept_encodings.best_match(offered)
+
+
+def compress(response):
+    """
+    Compresses a buffered JSON/MessagePack response with brotli or gzip when
+    the client accepts it and the body is at least COMPRESSION_MIN_BYTES.
+    Streams (SSE, audio) and partial or empty responses are left alone.
+    """
+    if (not config.RESPONSE_COMPRESSION or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < config.COMPRESSION_MIN_BYTES:
+        return response
+    encoding = _best_encoding()
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=config.BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(body, compresslevel=config.GZIP_LEVEL)
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+
+    # The compressed bytes are a different representation of the same resource
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
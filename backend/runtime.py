@@ -0,0 +1,98 @@
+import os
+import asyncio
+import contextvars
+import concurrent.futures
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each worker process runs a single background asyncio event loop that owns all
+# non-blocking upstream I/O. Flask request threads (and any other blocking code)
+# hand coroutines to it with run() and wait for the result, so one worker can keep
+# many generations in flight while the loop multiplexes their HTTP calls.
+_lock = threading.Lock()
+_loop = None
+_thread = None
+_owner_pid = None
+
+
+def get_loop():
+    """
+    Returns the worker's background event loop, starting it on first use (and
+    again after a fork, since the loop thread does not survive into the child).
+    """
+    global _loop, _thread, _owner_pid
+    if _loop is not None and _owner_pid == os.getpid():
+        return _loop
+
+    with _lock:
+        if _loop is None or _owner_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,),
+                                      name="snaptracks-async", daemon=True)
+            thread.start()
+            _loop, _thread, _owner_pid = loop, thread, os.getpid()
+            logger.info("Started background event loop in process %d.", _owner_pid)
+        return _loop
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def submit(coro):
+    """
+    Schedules a coroutine on the background loop and returns a
+    concurrent.futures.Future for its result. The coroutine runs in a copy of the
+    caller's contextvars context, so per-request state (e.g. stage timings)
+    follows it onto the loop.
+    """
+    loop = get_loop()
+    context = contextvars.copy_context()
+    future = concurrent.futures.Future()
+
+    def _copy_result(task):
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _start():
+        if not future.set_running_or_notify_cancel():
+            coro.close()
+            return
+        task = loop.create_task(coro, context=context)
+        task.add_done_callback(_copy_result)
+
+    loop.call_soon_threadsafe(_start)
+    return future
+
+
+def run(coro, timeout=None):
+    """
+    Runs a coroutine on the background loop and blocks the calling thread until
+    it finishes. Must not be called from the loop thread itself.
+    """
+    if threading.current_thread() is _thread:
+        coro.close()
+        raise RuntimeError("runtime.run() cannot be called from the event loop thread.")
+    return submit(coro).result(timeout)
+
+
+def iterate(agen):
+    """
+    Iterates an async generator from a blocking caller, running each step on the
+    background loop. Closing the returned generator closes the async one too.
+    """
+    try:
+        while True:
+            try:
+                yield run(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run(agen.aclose())
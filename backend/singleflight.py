@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import concurrent.futures
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Request coalescing: concurrent calls with the same key share one computation.
+# Within a worker, followers wait on the leader thread's Future. Across workers,
+# the leader claims the key in a SQLite table and publishes the result there;
+# followers in other processes poll the row. Results are kept for
+# SINGLEFLIGHT_RESULT_TTL seconds so a duplicate that arrives just after the
+# leader finished (a double-tap, a retry after a tunnel hiccup) still attaches.
+# Results must be JSON-serializable.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
+
+SINGLEFLIGHT_COALESCED = metrics._register(metrics.Counter(
+    "snaptracks_singleflight_coalesced_total",
+    "Requests that attached to an identical in-flight call instead of running their own.",
+    ("namespace", "scope")))
+
+_lock = threading.Lock()
+_local = {}
+_stats = {"leaders": 0, "coalesced_local": 0, "coalesced_shared": 0}
+_initialized = False
+
+
+class CoalescedError(Exception):
+    """
+    Raised to followers when the computation they attached to failed.
+    """
+
+
+def make_key(namespace, *parts):
+    """
+    Builds a compact key from a namespace and any JSON-serializable parts.
+    """
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+def _namespace(key):
+    return key.partition(":")[0]
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(config.SINGLEFLIGHT_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.SINGLEFLIGHT_DB_PATH, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _initialized:
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _claim(conn, key, owner):
+    """
+    Claims the key for this process. Returns None if claimed, otherwise the
+    current row (status, result, error) of the flight owned by someone else.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT status, result, error, started_at, finished_at FROM flights WHERE key = ?",
+                           (key,)).fetchone()
+        reusable = row is not None and (
+            (row[0] == "running" and now - row[3] < config.SINGLEFLIGHT_STALE_SECONDS)
+            or (row[0] == "done" and now - row[4] < config.SINGLEFLIGHT_RESULT_TTL)
+        )
+        if reusable:
+            conn.execute("COMMIT")
+            return row[:3]
+        conn.execute(
+            "INSERT OR REPLACE INTO flights (key, owner, status, started_at) VALUES (?, ?, 'running', ?)",
+            (key, owner, now),
+        )
+        # Forget finished flights that nobody can attach to any more
+        conn.execute("DELETE FROM flights WHERE status != 'running' AND finished_at < ?",
+                     (now - config.SINGLEFLIGHT_RESULT_TTL,))
+        conn.execute("COMMIT")
+        return None
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _publish(key, owner, result=None, error=None):
+    conn = _connect()
+    try:
+        if error is None:
+            conn.execute(
+                "UPDATE flights SET status = 'done', result = ?, finished_at = ? WHERE key = ? AND owner = ?",
+                (json.dumps(result), time.time(), key, owner),
+            )
+        else:
+            # Failures are not kept: the next request should try again
+            conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, owner))
+    finally:
+        conn.close()
+
+
+def _wait_shared(key, row, timeout):
+    deadline = time.monotonic() + timeout
+    conn = _connect()
+    try:
+        while True:
+            status, result, error = row
+            if status == "done":
+                return json.loads(result)
+            if time.monotonic() >= deadline:
+                raise CoalescedError(f"Timed out waiting for in-flight request {key}.")
+            time.sleep(config.SINGLEFLIGHT_POLL_INTERVAL)
+            row = conn.execute("SELECT status, result, error FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                raise CoalescedError("The in-flight request this one was attached to failed.")
+    finally:
+        conn.close()
+
+
+def _run_shared(key, func, timeout):
+    if not config.SINGLEFLIGHT_SHARED:
+        return func()
+
+    owner = f"{os.getpid()}:{threading.get_ident()}"
+    try:
+        conn = _connect()
+        try:
+            row = _claim(conn, key, owner)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("Single-flight store unavailable, running %s uncoalesced: %s", key, e)
+        return func()
+
+    if row is not None:
+        _count("coalesced_shared")
+        SINGLEFLIGHT_COALESCED.inc(_namespace(key), "shared")
+        logger.info("Attached to in-flight request %s in another worker.", key)
+        return _wait_shared(key, row, timeout)
+
+    try:
+        result = func()
+    except BaseException as e:
+        _publish(key, owner, error=str(e) or type(e).__name__)
+        raise
+    _publish(key, owner, result=result)
+    return result
+
+
+def do(key, func, timeout=600):
+    """
+    Runs func() for the key unless an identical call is already in flight in
+    this worker or another one, in which case that call's result is returned.
+    Followers wait at most timeout seconds.
+    """
+    with _lock:
+        future = _local.get(key)
+        leader = future is None
+        if leader:
+            future = _local[key] = concurrent.futures.Future()
+            _stats["leaders"] += 1
+        else:
+            _stats["coalesced_local"] += 1
+
+    if not leader:
+        SINGLEFLIGHT_COALESCED.inc(_namespace(key), "local")
+        logger.info("Attached to in-flight request %s.", key)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as e:
+            raise CoalescedError(f"Timed out waiting for in-flight request {key}.") from e
+
+    try:
+        result = _run_shared(key, func, timeout)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            _local.pop(key, None)
+
+
+def forget(key):
+    """
+    Drops the kept result of a finished call for the key, so the next do()
+    runs func again. For results that went stale, e.g. a file since deleted.
+    A call still in flight is left alone.
+    """
+    if not config.SINGLEFLIGHT_SHARED:
+        return
+    try:
+        conn = _connect()
+        try:
+            conn.execute("DELETE FROM flights WHERE key = ? AND status = 'done'", (key,))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("Single-flight store unavailable, could not forget %s: %s", key, e)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, in_flight=len(_local))
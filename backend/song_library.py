@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import base64
+import logging
+import sqlite3
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Library of every generated song, so playlist screens can list them with one
+# indexed query instead of asking Suno for clip metadata again. Songs are keyed
+# by Suno clip id and saved when a generation finishes; the clip poller keeps
+# status and audio_url current. Each genre tag gets a row in song_tags so
+# filtering by tag is an index range scan. Any write bumps library_meta.version
+# (via triggers), which is what listing ETags are derived from.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    title_key TEXT,
+    genre_tags TEXT NOT NULL DEFAULT '[]',
+    lyrics TEXT,
+    status TEXT,
+    audio_url TEXT,
+    image_url TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_created ON songs (created_at, id);
+CREATE INDEX IF NOT EXISTS songs_title ON songs (title_key, created_at);
+
+CREATE TABLE IF NOT EXISTS song_tags (
+    tag TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    song_id TEXT NOT NULL,
+    PRIMARY KEY (tag, created_at, song_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS library_meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO library_meta (id, version) VALUES (0, 0);
+
+CREATE TRIGGER IF NOT EXISTS songs_insert AFTER INSERT ON songs
+BEGIN UPDATE library_meta SET version = version + 1 WHERE id = 0; END;
+CREATE TRIGGER IF NOT EXISTS songs_update AFTER UPDATE ON songs
+BEGIN UPDATE library_meta SET version = version + 1 WHERE id = 0; END;
+CREATE TRIGGER IF NOT EXISTS songs_delete AFTER DELETE ON songs
+BEGIN UPDATE library_meta SET version = version + 1 WHERE id = 0; END;
+"""
+
+# Fields a listing can project, and the ones returned when none are asked for
+FIELDS = ("id", "title", "genre_tags", "lyrics", "status", "audio_url", "image_url",
+          "created_at", "updated_at", "data")
+DEFAULT_FIELDS = ("id", "title", "genre_tags", "status", "audio_url", "image_url", "created_at")
+_JSON_FIELDS = ("genre_tags", "data")
+
+MAX_PAGE_SIZE = 100
+
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(config.SONG_LIBRARY_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.SONG_LIBRARY_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _initialized:
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+def _tags(genre_tags):
+    return sorted({tag.strip().lower() for tag in genre_tags or [] if tag and tag.strip()})
+
+
+def save_songs(songs, lyrics, title, genre_tags):
+    """
+    Saves the clips of one generation. Saving a clip again (a retried job, a
+    coalesced duplicate request) refreshes it but keeps its creation time.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for song in songs:
+            data = song.get("data") or {}
+            conn.execute(
+                "INSERT INTO songs (id, title, title_key, genre_tags, lyrics, status, audio_url, "
+                "image_url, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET status = excluded.status, audio_url = excluded.audio_url, "
+                "image_url = excluded.image_url, data = excluded.data, updated_at = excluded.updated_at",
+                (song["id"], title, (title or "").lower(), json.dumps(genre_tags or []), lyrics,
+                 data.get("status"), data.get("audio_url"), data.get("image_url"),
+                 json.dumps(data), now, now),
+            )
+            created_at = conn.execute("SELECT created_at FROM songs WHERE id = ?", (song["id"],)).fetchone()[0]
+            conn.executemany(
+                "INSERT OR IGNORE INTO song_tags (tag, created_at, song_id) VALUES (?, ?, ?)",
+                [(tag, created_at, song["id"]) for tag in _tags(genre_tags)],
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def update_clip(clip_id, data):
+    """
+    Records the latest Suno payload for a clip (status, playable audio URL).
+    Does nothing for clips that are not in the library.
+    """
+    data = data or {}
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE songs SET status = ?, audio_url = COALESCE(?, audio_url), "
+            "image_url = COALESCE(?, image_url), data = ?, updated_at = ? WHERE id = ?",
+            (data.get("status"), data.get("audio_url"), data.get("image_url"),
+             json.dumps(data), time.time(), clip_id),
+        )
+    finally:
+        conn.close()
+
+
+def save_result(result):
+    """
+    Saves a /generate_music style result, logging instead of raising so a
+    library failure never fails the generation itself.
+    """
+    try:
+        save_songs(result["songs"], result["lyrics"], result["title"], result["genre_tags"])
+    except Exception as e:
+        logger.warning("Failed to save songs to the library: %s", e)
+
+
+def version():
+    """
+    Returns the library's change counter; it increases on every write.
+    """
+    conn = _connect()
+    try:
+        return conn.execute("SELECT version FROM library_meta WHERE id = 0").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def encode_cursor(created_at, song_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, song_id]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Returns (created_at, song_id) from a listing cursor; raises ValueError if
+    the cursor is malformed.
+    """
+    try:
+        created_at, song_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(created_at), str(song_id)
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+
+def list_songs(limit=20, cursor=None, genre=None, title=None, fields=None):
+    """
+    Returns (songs, next_cursor), newest first. Pages are keyset-paginated on
+    (created_at, id), so a page costs the same however deep it is. `genre`
+    filters on one tag, `title` on a case-insensitive title prefix, and
+    `fields` picks the columns returned.
+    """
+    fields = tuple(fields or DEFAULT_FIELDS)
+    columns = ", ".join(f"s.{field}" for field in dict.fromkeys(fields + ("created_at", "id")))
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    if genre:
+        query = f"SELECT {columns} FROM song_tags t JOIN songs s ON s.id = t.song_id WHERE t.tag = ?"
+        params = [genre.strip().lower()]
+        order_columns = ("t.created_at", "t.song_id")
+    else:
+        query = f"SELECT {columns} FROM songs s WHERE 1 = 1"
+        params = []
+        order_columns = ("s.created_at", "s.id")
+
+    if title:
+        prefix = title.lower()
+        query += " AND s.title_key >= ? AND s.title_key < ?"
+        params += [prefix, prefix + "\uffff"]
+    if cursor:
+        created_at, song_id = decode_cursor(cursor)
+        query += f" AND ({order_columns[0]}, {order_columns[1]}) < (?, ?)"
+        params += [created_at, song_id]
+    query += f" ORDER BY {order_columns[0]} DESC, {order_columns[1]} DESC LIMIT ?"
+    params.append(limit + 1)
+
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+    songs = []
+    for row in rows:
+        song = {}
+        for field in fields:
+            value = row[field]
+            song[field] = json.loads(value) if field in _JSON_FIELDS and value is not None else value
+        songs.append(song)
+    return songs, next_cursor
+
+
+def get_song(song_id):
+    """
+    Returns one song with every field, or None if it is not in the library.
+    """
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute("SELECT * FROM songs WHERE id = ?", (song_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    song = {field: row[field] for field in FIELDS}
+    for field in _JSON_FIELDS:
+        song[field] = json.loads(song[field])
+    return song
@@ -0,0 +1,165 @@
+import os
+import hmac
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+from urllib.parse import urlencode
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Clip status updates pushed by Suno. When SUNO_CALLBACK_URL is set, clips are
+# submitted with a callback URL and Suno POSTs to /callbacks/suno as a clip
+# moves through its statuses. The worker that receives a callback applies it to
+# its own clip poller straight away; every callback is also appended to a
+# SQLite table that the other workers' pollers check every
+# CLIP_CALLBACK_CHECK_INTERVAL seconds, so a request waiting on a clip in any
+# worker is woken within a fraction of a second. Upstream polling continues at
+# CLIP_CALLBACK_POLL_INTERVAL as a fallback for callbacks that never arrive.
+#
+# Callbacks are authenticated by an HMAC-SHA256 of the body, keyed with
+# SUNO_CALLBACK_SECRET, in the SIGNATURE_HEADER header ("sha256=<hex>"). For
+# providers that cannot sign requests, SUNO_CALLBACK_TOKEN opts in to a
+# `token` query parameter on the callback URL instead. It is a separate value,
+# because URLs end up in access and proxy logs.
+
+SIGNATURE_HEADER = "X-Suno-Signature"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clip_updates (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    clip_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS clip_updates_clip ON clip_updates (clip_id, seq);
+CREATE INDEX IF NOT EXISTS clip_updates_received ON clip_updates (received_at);
+"""
+
+_initialized = False
+
+
+def enabled():
+    return bool(config.SUNO_CALLBACK_URL and (config.SUNO_CALLBACK_SECRET or config.SUNO_CALLBACK_TOKEN))
+
+
+def callback_url():
+    """
+    Returns the URL clips are submitted with, carrying the token if one is
+    configured, or None when callbacks are off.
+    """
+    if not enabled():
+        return None
+    if not config.SUNO_CALLBACK_TOKEN:
+        return config.SUNO_CALLBACK_URL
+    separator = "&" if "?" in config.SUNO_CALLBACK_URL else "?"
+    return config.SUNO_CALLBACK_URL + separator + urlencode({"token": config.SUNO_CALLBACK_TOKEN})
+
+
+def sign(body):
+    return "sha256=" + hmac.new(config.SUNO_CALLBACK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify(body, signature=None, token=None):
+    """
+    Returns True if the callback carries a valid signature or token.
+    Malformed values (e.g. non-ASCII headers) are simply invalid.
+    """
+    if not enabled():
+        return False
+    if signature and config.SUNO_CALLBACK_SECRET:
+        return _matches(signature, sign(body))
+    if token and config.SUNO_CALLBACK_TOKEN:
+        return _matches(token, config.SUNO_CALLBACK_TOKEN)
+    return False
+
+
+def _matches(given, expected):
+    try:
+        return hmac.compare_digest(given.encode(), expected.encode())
+    except (TypeError, UnicodeError):
+        return False
+
+
+def parse(payload):
+    """
+    Extracts [(clip_id, data)] from a callback body: a single clip object, or
+    an envelope with a list of clips under "data" (possibly nested once more
+    under "data", as Suno's task callbacks do). Raises ValueError if no clip
+    can be found.
+    """
+    clips = payload
+    for _ in range(2):
+        if isinstance(clips, dict) and "data" in clips and not ("id" in clips or "clip_id" in clips):
+            clips = clips["data"]
+    if isinstance(clips, dict):
+        clips = [clips]
+    if not isinstance(clips, list):
+        raise ValueError("Callback body has no clips.")
+
+    updates = []
+    for clip in clips:
+        clip_id = isinstance(clip, dict) and (clip.get("id") or clip.get("clip_id"))
+        if not clip_id or not isinstance(clip_id, str):
+            raise ValueError("Callback clip has no id.")
+        updates.append((clip_id, clip))
+    if not updates:
+        raise ValueError("Callback body has no clips.")
+    return updates
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(config.SUNO_CALLBACK_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.SUNO_CALLBACK_DB_PATH, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _initialized:
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+def record(updates):
+    """
+    Appends clip updates for the other workers' pollers to pick up.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO clip_updates (clip_id, data, received_at) VALUES (?, ?, ?)",
+            [(clip_id, json.dumps(data), now) for clip_id, data in updates],
+        )
+        # Nobody waits on a clip longer than CLIP_POLL_MAX_AGE
+        conn.execute("DELETE FROM clip_updates WHERE received_at < ?", (now - config.CLIP_POLL_MAX_AGE,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def latest(clip_ids, after=None):
+    """
+    Returns {clip_id: (seq, data)} with the newest recorded update of each
+    clip, skipping updates at or below after[clip_id].
+    """
+    if not clip_ids:
+        return {}
+    after = after or {}
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT clip_id, MAX(seq), data FROM clip_updates WHERE clip_id IN (%s) GROUP BY clip_id"
+            % ",".join("?" * len(clip_ids)),
+            list(clip_ids),
+        ).fetchall()
+    finally:
+        conn.close()
+    return {clip_id: (seq, json.loads(data)) for clip_id, seq, data in rows if seq > after.get(clip_id, 0)}
@@ -0,0 +1,396 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextlib
+import concurrent.futures
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Shared policy for every upstream call: per-endpoint connect/read deadlines,
+# jittered retries for calls that are safe to repeat, a circuit breaker per
+# upstream host, and optional hedging (a duplicate request fired once the first
+# has been running longer than the endpoint's observed p95 latency).
+
+
+class UpstreamError(Exception):
+    """
+    Raised when an upstream API returns a non-200 response.
+    """
+    def __init__(self, service, status, body):
+        super().__init__(f"{service} API returned status {status}: {body}")
+        self.service = service
+        self.status = status
+        self.body = body
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling upstream while the host's circuit breaker is open.
+    """
+    def __init__(self, host, retry_after):
+        super().__init__(f"{host} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class Policy:
+    """
+    Call policy for one upstream endpoint. Every field can be overridden from the
+    environment as UPSTREAM_<ENDPOINT>_<FIELD>, e.g. UPSTREAM_SUNO_FETCH_READ_TIMEOUT.
+    """
+    __slots__ = ("name", "host", "connect_timeout", "read_timeout", "retries", "hedge")
+
+    def __init__(self, name, host, connect_timeout, read_timeout, retries=0, hedge=False):
+        prefix = "UPSTREAM_" + name.upper().replace(".", "_") + "_"
+        self.name = name
+        self.host = host
+        self.connect_timeout = float(os.getenv(prefix + "CONNECT_TIMEOUT", connect_timeout))
+        self.read_timeout = float(os.getenv(prefix + "READ_TIMEOUT", read_timeout))
+        self.retries = int(os.getenv(prefix + "RETRIES", retries))
+        self.hedge = os.getenv(prefix + "HEDGE", "1" if hedge else "0") == "1"
+
+    @property
+    def deadline(self):
+        """
+        Overall deadline for one attempt, used where only a total timeout applies.
+        """
+        return self.connect_timeout + self.read_timeout
+
+    def client_timeout(self):
+        """
+        Returns the aiohttp timeout for one attempt. The read timeout applies per
+        socket read, so a streaming response only fails if it stalls.
+        """
+        import aiohttp
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+                                     sock_read=self.read_timeout)
+
+
+# Suno clip submission creates (and bills) new clips, so it is never retried or
+# hedged; everything else is free of side effects.
+POLICIES = {
+    policy.name: policy for policy in (
+        Policy("openai.chat", "openai", 5, 60, retries=1),
+        Policy("openai.chat_stream", "openai", 5, 20),
+        Policy("suno.submit", "suno", 5, 60),
+        Policy("suno.fetch", "suno", 3, 15, retries=3, hedge=True),
+        Policy("suno.audio", "suno_cdn", 5, 30, retries=2),
+        Policy("vision.labels", "google", 5, 20, retries=2, hedge=True),
+        Policy("vision.batch_labels", "google", 5, 60, retries=2),
+        Policy("gemini.describe", "google", 5, 45, retries=1),
+    )
+}
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.25"))
+RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "4"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+
+_lock = threading.Lock()
+_breakers = {}
+_latencies = {}
+_sync_executor = None
+
+
+class _Breaker:
+    """
+    Consecutive-failure circuit breaker. After BREAKER_FAILURE_THRESHOLD failures
+    in a row the circuit opens for BREAKER_RESET_SECONDS; then a single trial call
+    is let through, which closes the circuit on success or re-opens it on failure.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def before_call(self):
+        with _lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + BREAKER_RESET_SECONDS - time.monotonic()
+            if remaining > 0 or self.trial_in_flight:
+                raise CircuitOpenError(self.host, max(remaining, 0))
+            self.trial_in_flight = True
+
+    def record(self, success):
+        with _lock:
+            self.trial_in_flight = False
+            if success:
+                if self.opened_at is not None:
+                    logger.info("Circuit for %s closed.", self.host)
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                if self.opened_at is None:
+                    logger.warning("Circuit for %s opened after %d failures.", self.host, self.failures)
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Ends a call that neither succeeded nor failed (e.g. it was cancelled).
+        """
+        with _lock:
+            self.trial_in_flight = False
+
+    def state(self):
+        with _lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS else "open"
+
+
+def _breaker(host):
+    with _lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = _Breaker(host)
+        return breaker
+
+
+def _record_latency(name, seconds):
+    with _lock:
+        samples = _latencies.get(name)
+        if samples is None:
+            samples = _latencies[name] = deque(maxlen=200)
+        samples.append(seconds)
+
+
+def p95(name):
+    """
+    Returns the endpoint's p95 latency over recent successful calls, or None
+    until enough samples have been collected.
+    """
+    with _lock:
+        samples = sorted(_latencies.get(name, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[int(len(samples) * 0.95) - 1]
+
+
+def is_retryable(error):
+    """
+    Timeouts, connection failures, 429s and 5xx responses are worth retrying.
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, UpstreamError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, (asyncio.TimeoutError, concurrent.futures.TimeoutError,
+                          TimeoutError, ConnectionError, OSError)):
+        return True
+    try:
+        import aiohttp
+        if isinstance(error, aiohttp.ClientError):
+            return True
+    except ImportError:
+        pass
+    try:
+        from google.api_core import exceptions as google_exceptions
+        if isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                              google_exceptions.InternalServerError, google_exceptions.TooManyRequests)):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+def _backoff(attempt):
+    # Full jitter: uniform between 0 and the capped exponential delay
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+@contextlib.asynccontextmanager
+async def guard(name):
+    """
+    Applies the host's circuit breaker and records latency around a call that
+    manages its own timeouts and does not retry (e.g. a streaming response).
+    Yields the endpoint's Policy.
+    """
+    policy = POLICIES[name]
+    breaker = _breaker(policy.host)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        yield policy
+    except Exception as e:
+        breaker.record(not is_retryable(e))
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    breaker.record(True)
+    _record_latency(name, time.monotonic() - started)
+
+
+async def _attempt_async(policy, attempt_func):
+    breaker = _breaker(policy.host)
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        metrics.count_upstream_response(policy.host, "circuit_open")
+        raise
+    started = time.monotonic()
+    try:
+        result = await asyncio.wait_for(attempt_func(policy.client_timeout()), policy.deadline)
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        metrics.count_upstream_response(policy.host, "timeout")
+        breaker.record(False)
+        raise
+    except Exception as e:
+        # Only upstream trouble counts against the host, not e.g. a 400 we caused
+        breaker.record(not is_retryable(e))
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    breaker.record(True)
+    _record_latency(policy.name, time.monotonic() - started)
+    return result
+
+
+async def _hedged_async(policy, attempt_func):
+    hedge_after = p95(policy.name) if policy.hedge else None
+    if hedge_after is None:
+        return await _attempt_async(policy, attempt_func)
+
+    primary = asyncio.ensure_future(_attempt_async(policy, attempt_func))
+    done, _ = await asyncio.wait({primary}, timeout=max(hedge_after, HEDGE_MIN_DELAY))
+    if done:
+        return primary.result()
+
+    logger.info("Hedging %s after %.0f ms.", policy.name, hedge_after * 1000)
+    hedge = asyncio.ensure_future(_attempt_async(policy, attempt_func))
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call_async(name, attempt_func):
+    """
+    Runs attempt_func(timeout) under the named endpoint's policy and returns its
+    result. attempt_func is called once per attempt with an aiohttp.ClientTimeout
+    and must return an awaitable; it should raise UpstreamError on a bad status.
+    """
+    policy = POLICIES[name]
+    for attempt in range(policy.retries + 1):
+        try:
+            return await _hedged_async(policy, attempt_func)
+        except Exception as e:
+            if attempt >= policy.retries or not is_retryable(e):
+                raise
+            delay = _backoff(attempt)
+            logger.warning("%s failed (%s); retrying in %.2fs.", name, e, delay)
+            await asyncio.sleep(delay)
+
+
+def _get_sync_executor():
+    global _sync_executor
+    if _sync_executor is None:
+        with _lock:
+            if _sync_executor is None:
+                _sync_executor = concurrent.futures.ThreadPoolExecutor(
+                    int(os.getenv("UPSTREAM_SYNC_THREADS", "32")),
+                    thread_name_prefix="snaptracks-upstream",
+                )
+    return _sync_executor
+
+
+def _attempt_sync(policy, attempt_func):
+    breaker = _breaker(policy.host)
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        metrics.count_upstream_response(policy.host, "circuit_open")
+        raise
+    started = time.monotonic()
+    try:
+        result = attempt_func(policy.deadline)
+    except Exception as e:
+        # Google API errors carry their HTTP status code
+        metrics.count_upstream_response(policy.host, getattr(e, "code", None) or type(e).__name__)
+        breaker.record(not is_retryable(e))
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    metrics.count_upstream_response(policy.host, "ok")
+    breaker.record(True)
+    _record_latency(policy.name, time.monotonic() - started)
+    return result
+
+
+def call_sync(name, attempt_func):
+    """
+    Blocking variant of call_async for SDK calls (Vision, Gemini). attempt_func is
+    called with the attempt deadline in seconds, which it should pass on to the
+    SDK where supported. Each attempt runs on a shared thread pool, so the caller
+    stops waiting at the deadline even if the SDK call does not.
+    """
+    policy = POLICIES[name]
+    executor = _get_sync_executor()
+    for attempt in range(policy.retries + 1):
+        try:
+            primary = executor.submit(_attempt_sync, policy, attempt_func)
+            futures = {primary}
+            hedge_after = p95(name) if policy.hedge else None
+            deadline = time.monotonic() + policy.deadline
+            if hedge_after is not None:
+                done, _ = concurrent.futures.wait(futures, timeout=max(hedge_after, HEDGE_MIN_DELAY))
+                if not done:
+                    logger.info("Hedging %s after %.0f ms.", name, hedge_after * 1000)
+                    futures.add(executor.submit(_attempt_sync, policy, attempt_func))
+
+            error = None
+            while futures:
+                done, futures = concurrent.futures.wait(
+                    futures, timeout=max(deadline - time.monotonic(), 0),
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                if not done:
+                    raise concurrent.futures.TimeoutError(f"{name} timed out after {policy.deadline:.0f}s")
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+            raise error
+        except Exception as e:
+            if attempt >= policy.retries or not is_retryable(e):
+                raise
+            delay = _backoff(attempt)
+            logger.warning("%s failed (%s); retrying in %.2fs.", name, e, delay)
+            time.sleep(delay)
+
+
+def stats():
+    """
+    Reports breaker state per host and p95 latency per endpoint.
+    """
+    with _lock:
+        hosts = list(_breakers)
+        names = list(_latencies)
+    return {
+        "breakers": {host: _breaker(host).state() for host in hosts},
+        "p95_ms": {name: round(p95(name) * 1000) if p95(name) is not None else None for name in names},
+    }
@@ -0,0 +1,502 @@
+import os
+import re
+import json
+import math
+import time
+import signal
+import asyncio
+import logging
+import sqlite3
+import multiprocessing
+
+import config
+import logs
+import music
+import jobs
+import clip_poller
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Speculative warm pool of finished tracks for common scenes. A generation takes
+# a minute or more end to end, but many snaps look alike: the same kind of
+# music, in the same weather, at the same time of day. Requests are grouped
+# into profiles of
+#
+#   (first genre tag of the lyrics, weather bucket, time-of-day bucket)
+#
+# and every /generate_music request bumps its profile's decayed request count.
+# A refiller (run alongside the job workers by `python jobs.py`) keeps enough
+# finished tracks for each popular profile to cover WARM_POOL_COVER_SECONDS of
+# its demand, up to WARM_POOL_MAX_PER_PROFILE, and only generates while the
+# upstreams are idle: no jobs waiting, few live requests, no overloaded or
+# failed requests lately, and at most WARM_POOL_MAX_PER_HOUR generations an
+# hour. The refiller runs in its own process, so everything it decides on is
+# read from the shared databases: the web workers record their overload and
+# upstream failure responses in the pressure table (note_pressure).
+#
+# When a request's profile has a ready track (same genre, and weather and time
+# of day differing in at most WARM_POOL_MAX_MISMATCH of the two), the track is
+# returned at once, marked "pooled", and the personalized generation is queued
+# as a job whose id is returned with it. The pooled track is claimed atomically,
+# so each one is served once.
+
+READY = "ready"
+GENERATING = "generating"
+CLAIMED = "claimed"
+FAILED = "failed"
+
+WARM_POOL_REQUESTS = metrics._register(metrics.Counter(
+    "snaptracks_warm_pool_requests_total", "Generation requests checked against the warm pool.", ("result",)))
+WARM_POOL_FILLS = metrics._register(metrics.Counter(
+    "snaptracks_warm_pool_fills_total", "Warm pool tracks generated.", ("result",)))
+
+# Matched against whole words, so inflected forms are listed explicitly ("ice"
+# must not match "nice", nor "sun" "Sunday"). First matching bucket wins, so
+# the more specific words come first.
+_WEATHER_BUCKETS = (
+    ("storm", ("storm", "storms", "stormy", "thunder", "thunderstorm", "thunderstorms", "lightning",
+               "hurricane")),
+    ("snow", ("snow", "snowy", "snowing", "snowfall", "sleet", "blizzard", "hail", "ice", "icy", "frost",
+              "frosty", "freezing")),
+    ("rain", ("rain", "rainy", "raining", "rainfall", "drizzle", "drizzly", "shower", "showers", "wet")),
+    ("fog", ("fog", "foggy", "mist", "misty", "haze", "hazy", "smog")),
+    ("cloudy", ("cloud", "clouds", "cloudy", "overcast", "grey", "gray", "dull")),
+    ("clear", ("sun", "sunny", "sunshine", "clear", "bright", "fair", "hot", "warm")),
+)
+_TIME_BUCKETS = (
+    ("afternoon", ("afternoon", "noon", "midday", "lunch", "lunchtime")),
+    ("evening", ("evening", "dusk", "sunset", "twilight")),
+    ("morning", ("morning", "dawn", "sunrise", "breakfast", "early")),
+    ("night", ("night", "nighttime", "tonight", "midnight", "late", "dark")),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pool_tracks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    profile TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    weather TEXT NOT NULL,
+    time_of_day TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    created_at REAL NOT NULL,
+    ready_at REAL
+);
+CREATE INDEX IF NOT EXISTS pool_tracks_match ON pool_tracks (genre, status, ready_at);
+CREATE INDEX IF NOT EXISTS pool_tracks_profile ON pool_tracks (profile, status);
+CREATE INDEX IF NOT EXISTS pool_tracks_created ON pool_tracks (created_at);
+CREATE TABLE IF NOT EXISTS profiles (
+    profile TEXT PRIMARY KEY,
+    genre TEXT NOT NULL,
+    weather TEXT NOT NULL,
+    time_of_day TEXT NOT NULL,
+    score REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    example TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS demand (
+    minute INTEGER PRIMARY KEY,
+    requests INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pressure (
+    minute INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (minute, kind)
+);
+"""
+
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(config.WARM_POOL_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(config.WARM_POOL_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if not _initialized:
+        conn.executescript(_SCHEMA)
+        _initialized = True
+    return conn
+
+
+def _bucket(text, buckets):
+    words = set(re.findall(r"[a-z]+", (text or "").lower()))
+    for name, bucket_words in buckets:
+        if words.intersection(bucket_words):
+            return name
+    return None
+
+
+def weather_bucket(weather):
+    return _bucket(weather, _WEATHER_BUCKETS) or "other"
+
+
+def time_bucket(time_of_day):
+    """
+    Buckets free text ("Middle of afternoon") or a clock time ("7:30 pm").
+    """
+    bucket = _bucket(time_of_day, _TIME_BUCKETS)
+    if bucket:
+        return bucket
+    text = (time_of_day or "").strip().lower()
+    try:
+        hour = int(text.split(":")[0].split()[0])
+    except (ValueError, IndexError):
+        return "other"
+    if "pm" in text and hour < 12:
+        hour += 12
+    elif "am" in text and hour == 12:
+        hour = 0
+    if 5 <= hour < 12:
+        return "morning"
+    if 12 <= hour < 17:
+        return "afternoon"
+    if 17 <= hour < 21:
+        return "evening"
+    return "night" if 0 <= hour < 24 else "other"
+
+
+def profile_for(genre_tags, weather, time_of_day):
+    """
+    Returns the (genre, weather, time of day) profile of a request, or None
+    when the lyrics came without a usable genre.
+    """
+    genre = next((tag.strip().lower() for tag in genre_tags or [] if tag and tag.strip()), None)
+    if not genre or genre == "unknown":
+        return None
+    return genre, weather_bucket(weather), time_bucket(time_of_day)
+
+
+def _key(profile):
+    return "|".join(profile)
+
+
+def _decayed(score, updated_at, now):
+    return score * math.exp(-(now - updated_at) / config.WARM_POOL_DECAY_SECONDS)
+
+
+def _rate(score, updated_at, now):
+    # A steady λ requests per second settles at a score of λ * DECAY_SECONDS
+    return _decayed(score, updated_at, now) * 3600 / config.WARM_POOL_DECAY_SECONDS
+
+
+def claim(genre_tags, weather, time_of_day):
+    """
+    Records a generation request against its profile and claims the closest
+    ready pooled track. Returns the track's /generate_music style result, or
+    None when nothing in the pool matches.
+    """
+    profile = profile_for(genre_tags, weather, time_of_day)
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        minute = int(now // 60)
+        conn.execute("INSERT INTO demand (minute, requests) VALUES (?, 1) "
+                     "ON CONFLICT (minute) DO UPDATE SET requests = requests + 1", (minute,))
+        if profile is None:
+            conn.execute("COMMIT")
+            WARM_POOL_REQUESTS.inc("unprofiled")
+            return None
+
+        genre, weather_name, time_name = profile
+        rows = conn.execute(
+            "UPDATE pool_tracks SET status = ? WHERE id = ("
+            "SELECT id FROM pool_tracks WHERE genre = ? AND status = ? AND ready_at > ? "
+            "AND (weather = ?) + (time_of_day = ?) >= ? "
+            "ORDER BY (weather = ?) + (time_of_day = ?) DESC, ready_at LIMIT 1) RETURNING result",
+            (CLAIMED, genre, READY, now - config.WARM_POOL_MAX_AGE,
+             weather_name, time_name, 2 - config.WARM_POOL_MAX_MISMATCH, weather_name, time_name),
+        ).fetchall()
+        row = rows[0] if rows else None
+
+        # The latest request of a profile is the example the refiller writes for
+        example = json.dumps({"genre_tags": genre_tags, "weather": weather, "time_of_day": time_of_day})
+        existing = conn.execute("SELECT score, updated_at FROM profiles WHERE profile = ?",
+                                (_key(profile),)).fetchone()
+        score = (_decayed(*existing, now) if existing else 0) + 1
+        conn.execute(
+            "INSERT INTO profiles (profile, genre, weather, time_of_day, score, updated_at, example, requests, hits) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?) ON CONFLICT (profile) DO UPDATE SET score = excluded.score, "
+            "updated_at = excluded.updated_at, example = excluded.example, requests = requests + 1, "
+            "hits = hits + excluded.hits",
+            (_key(profile), genre, weather_name, time_name, score, now, example, int(row is not None)),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    WARM_POOL_REQUESTS.inc("hit" if row else "miss")
+    if row is None:
+        return None
+    logger.info("Served a pooled track for profile %s.", _key(profile))
+    return json.loads(row[0])
+
+
+def _shortfalls(conn, now):
+    """
+    Returns [[rate, have, target, profile, example]] for the popular profiles
+    whose pool is below target.
+    """
+    have = dict(conn.execute(
+        "SELECT profile, COUNT(*) FROM pool_tracks WHERE status IN (?, ?) AND (ready_at IS NULL OR ready_at > ?) "
+        "GROUP BY profile", (GENERATING, READY, now - config.WARM_POOL_MAX_AGE)).fetchall())
+
+    popular = []
+    for profile, score, updated_at, example in conn.execute(
+            "SELECT profile, score, updated_at, example FROM profiles").fetchall():
+        rate = _rate(score, updated_at, now)
+        if rate >= config.WARM_POOL_MIN_RATE:
+            popular.append((rate, profile, example))
+    popular.sort(reverse=True)
+
+    shortfalls = []
+    for rate, profile, example in popular[:config.WARM_POOL_MAX_PROFILES]:
+        target = min(config.WARM_POOL_MAX_PER_PROFILE, math.ceil(rate * config.WARM_POOL_COVER_SECONDS / 3600))
+        if have.get(profile, 0) < target:
+            shortfalls.append([rate, have.get(profile, 0), target, profile, json.loads(example)])
+    return shortfalls
+
+
+def reserve(slots):
+    """
+    Picks up to `slots` tracks to generate, emptiest pools (relative to their
+    target) and busiest profiles first, and records them as generating.
+    Returns [(entry_id, profile, example)].
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        generated = conn.execute("SELECT COUNT(*) FROM pool_tracks WHERE created_at > ?",
+                                 (now - 3600,)).fetchone()[0]
+        slots = min(slots, config.WARM_POOL_MAX_PER_HOUR - generated)
+        shortfalls = _shortfalls(conn, now)
+        reserved = []
+        while len(reserved) < slots and shortfalls:
+            shortfalls.sort(key=lambda item: (item[1] / item[2], -item[0]))
+            item = shortfalls[0]
+            genre, weather, time_of_day = item[3].split("|")
+            entry_id = conn.execute(
+                "INSERT INTO pool_tracks (profile, genre, weather, time_of_day, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (item[3], genre, weather, time_of_day, GENERATING, now),
+            ).lastrowid
+            reserved.append((entry_id, item[3], item[4]))
+            item[1] += 1
+            if item[1] >= item[2]:
+                shortfalls.pop(0)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return reserved
+
+
+def _finish(entry_id, result):
+    """
+    Marks a reserved track ready with its result, or failed when result is None.
+    """
+    conn = _connect()
+    try:
+        if result is None:
+            conn.execute("UPDATE pool_tracks SET status = ? WHERE id = ?", (FAILED, entry_id))
+        else:
+            conn.execute("UPDATE pool_tracks SET status = ?, result = ?, ready_at = ? WHERE id = ?",
+                         (READY, json.dumps(result), time.time(), entry_id))
+    finally:
+        conn.close()
+
+
+def _sweep(reset=False):
+    """
+    Drops expired tracks, rows no longer needed for the hourly budget, old
+    demand counts and forgotten profiles. With reset, also drops tracks left
+    generating by a refiller that stopped.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if reset:
+            conn.execute("DELETE FROM pool_tracks WHERE status = ?", (GENERATING,))
+        conn.execute("DELETE FROM pool_tracks WHERE status IN (?, ?) AND created_at < ?",
+                     (CLAIMED, FAILED, now - 3600))
+        conn.execute("DELETE FROM pool_tracks WHERE status = ? AND ready_at < ?",
+                     (READY, now - config.WARM_POOL_MAX_AGE))
+        conn.execute("DELETE FROM demand WHERE minute < ?", (int(now // 60) - 10,))
+        conn.execute("DELETE FROM pressure WHERE minute < ?",
+                     (int((now - config.WARM_POOL_IDLE_QUIET_SECONDS) // 60) - 1,))
+        forgotten = [(profile,) for profile, score, updated_at in conn.execute(
+            "SELECT profile, score, updated_at FROM profiles").fetchall() if _decayed(score, updated_at, now) < 0.05]
+        conn.executemany("DELETE FROM profiles WHERE profile = ?", forgotten)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _recent_requests_per_minute():
+    minute = int(time.time() // 60)
+    conn = _connect()
+    try:
+        count = conn.execute("SELECT COALESCE(SUM(requests), 0) FROM demand WHERE minute >= ?",
+                             (minute - 1,)).fetchone()[0]
+    finally:
+        conn.close()
+    return count / 2
+
+
+def note_pressure(kind):
+    """
+    Records an overload ("overload") or upstream failure ("failure") response,
+    which keeps the refiller quiet for WARM_POOL_IDLE_QUIET_SECONDS.
+    """
+    conn = _connect()
+    try:
+        conn.execute("INSERT INTO pressure (minute, kind, count) VALUES (?, ?, 1) "
+                     "ON CONFLICT (minute, kind) DO UPDATE SET count = count + 1",
+                     (int(time.time() // 60), kind))
+    finally:
+        conn.close()
+
+
+def _recent_pressure():
+    conn = _connect()
+    try:
+        return dict(conn.execute(
+            "SELECT kind, SUM(count) FROM pressure WHERE minute >= ? GROUP BY kind",
+            (int((time.time() - config.WARM_POOL_IDLE_QUIET_SECONDS) // 60),),
+        ).fetchall())
+    finally:
+        conn.close()
+
+
+def _idle():
+    """
+    Returns True when speculative generation would not compete with users.
+    """
+    if jobs.count_active() > config.WARM_POOL_IDLE_MAX_JOBS:
+        return False
+    if _recent_requests_per_minute() > config.WARM_POOL_IDLE_MAX_REQUESTS:
+        return False
+    pressure = _recent_pressure()
+    if pressure:
+        logger.debug("Warm pool refill held back by recent pressure: %s", pressure)
+        return False
+    return True
+
+
+async def _wait_complete(clip_ids):
+    """
+    Polls the clips until both are complete; a warm track must be a finished
+    file, not a stream that is still being written.
+    """
+    deadline = time.monotonic() + config.CLIP_POLL_MAX_AGE
+    while True:
+        songs = await music.get_songs_data_async(clip_ids)
+        statuses = [(song["data"] or {}).get("status") for song in songs]
+        if any(status in clip_poller.FAILED_STATUSES for status in statuses):
+            raise ValueError(f"Clip generation failed: {statuses}.")
+        if all(status == "complete" for status in statuses):
+            return songs
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Clips {clip_ids} did not complete in {config.CLIP_POLL_MAX_AGE:.0f} s.")
+        await asyncio.sleep(config.CLIP_POLL_MAX_INTERVAL)
+
+
+async def _fill(entry_id, profile, example):
+    genre = profile.split("|")[0]
+    try:
+        # Fresh lyrics every time (no memo), so a profile's tracks differ
+        lyrics, title, _ = await music.request_music_prompt_async(
+            f"An ordinary day out and about, in a {genre} mood", "Anywhere",
+            example["weather"], example["time_of_day"],
+        )
+        if not all([lyrics, title]):
+            raise ValueError("Failed to generate lyrics or title.")
+        # The profile's own tags, so the track sounds like what it is served for
+        genre_tags = example["genre_tags"]
+        clip_ids = await music.get_generated_song_ids_async(lyrics, title, genre_tags)
+        songs = await _wait_complete(list(clip_ids))
+    except Exception as e:
+        logger.warning("Failed to generate a warm track for %s: %s", profile, e)
+        WARM_POOL_FILLS.inc("failed")
+        await asyncio.to_thread(_finish, entry_id, None)
+        await asyncio.to_thread(note_pressure, "failure")
+        return
+
+    result = {"lyrics": lyrics, "title": title, "genre_tags": genre_tags, "songs": songs}
+    await asyncio.to_thread(_finish, entry_id, result)
+    WARM_POOL_FILLS.inc("ready")
+    logger.info("Warm track %d for %s is ready.", entry_id, profile)
+
+
+async def _refill_main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    await asyncio.to_thread(_sweep, True)
+    filling = set()
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(_sweep)
+            slots = config.WARM_POOL_CONCURRENCY - len(filling)
+            if slots > 0 and await asyncio.to_thread(_idle):
+                for entry_id, profile, example in await asyncio.to_thread(reserve, slots):
+                    task = asyncio.create_task(_fill(entry_id, profile, example))
+                    filling.add(task)
+                    task.add_done_callback(filling.discard)
+        except Exception as e:
+            logger.exception("Warm pool refill failed: %s", e)
+        try:
+            await asyncio.wait_for(stop.wait(), config.WARM_POOL_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    for task in filling:
+        task.cancel()
+
+
+def refiller_process():
+    """
+    Entry point of the refiller process. Run exactly one per deployment.
+    """
+    logs.configure()
+    logger.info("Warm pool refiller started.")
+    asyncio.run(_refill_main())
+    logger.info("Warm pool refiller stopped.")
+
+
+def start_refiller():
+    process = multiprocessing.Process(target=refiller_process, name="snaptracks-warm-pool")
+    process.start()
+    return process
+
+
+def stats():
+    """
+    Reports pooled tracks by status and the number of profiles being pooled.
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        tracks = dict(conn.execute("SELECT status, COUNT(*) FROM pool_tracks GROUP BY status").fetchall())
+        popular = sum(1 for score, updated_at in conn.execute("SELECT score, updated_at FROM profiles").fetchall()
+                      if _rate(score, updated_at, now) >= config.WARM_POOL_MIN_RATE)
+    finally:
+        conn.close()
+    return {"tracks": tracks, "popular_profiles": min(popular, config.WARM_POOL_MAX_PROFILES)}